@@ -0,0 +1,177 @@
+#
+# alsagraph.py
+#  Reads the ALSA sequencer "graph" - the clients, their ports and the
+#  subscriptions (connections) between ports - and returns it as a MidiGraph
+#  object that midihub.py and update-participants.py can both use.
+#
+#  We talk to the sequencer directly using the alsa_midi library (the same
+#  one python/listener.py uses) so there is no need to run "aconnect -l" and
+#  pick the text apart. If alsa_midi isn't installed we fall back to doing
+#  exactly that so the hub still works.
+#
+#  Install with: pip3 install alsa-midi
+#
+
+import os
+import re
+from collections import namedtuple
+
+import metrics
+
+try:
+    import alsa_midi
+except ImportError:
+    alsa_midi = None
+
+#
+# Clients below this number belong to the kernel (System, Midi Through and
+# so on). Each MIDI daemon is allocated a client number from here upwards.
+#
+FIRST_USER_CLIENT = 128
+
+#
+# Each MIDI daemon has a "Network" port and a port for every other daemon
+# it discovers (they have "midiHub" in the name). Neither of those are
+# remote participants so we ignore them.
+#
+IGNORED_PORT_NAMES = ['Network', 'midiHub', 'Announce']
+HUB_CLIENT_MARKER = 'midiHub-'
+
+Address = namedtuple('Address', 'clientId portId')
+
+class HubClient:
+    def __init__(self, clientId, name):
+        self.clientId = clientId
+        self.name = name
+        self.ports = {}
+
+    #
+    # The part of the client name after "midiHub-" - this is the location
+    # and UDP port of the daemon, for example "Asia Pacific (Singapore)-5004".
+    # Empty if this client isn't one of our daemons.
+    #
+    @property
+    def hubName(self):
+        index = self.name.find(HUB_CLIENT_MARKER)
+        if index == -1: return ''
+        return self.name[index+len(HUB_CLIENT_MARKER):]
+
+    #
+    # Ports that belong to remote musicians - portId: name
+    #
+    @property
+    def participants(self):
+        result = {}
+        for portId, name in self.ports.items():
+            if any(ignored in name for ignored in IGNORED_PORT_NAMES): continue
+            result[portId] = name
+        return result
+
+class MidiGraph:
+    def __init__(self):
+        self.clients = {}
+        self.subscriptions = set()
+
+    #
+    # Only the clients that are MIDI daemons started by midihub.py
+    #
+    def hubClients(self):
+        return [client for client in self.clients.values() if client.hubName]
+
+    #
+    # Subscriptions where both ends are on the given client
+    #
+    def subscriptionsWithin(self, clientId):
+        return set(s for s in self.subscriptions if s[0].clientId == clientId and s[1].clientId == clientId)
+
+    def portName(self, address):
+        client = self.clients.get(address.clientId)
+        if not client: return None
+        return client.ports.get(address.portId)
+
+sequencer = None
+
+#
+# A sequencer client that we keep open for the life of the process. Opening
+# one is fairly cheap but there's no need to do it every time.
+#
+def openSequencer(name='hubGraph'):
+    global sequencer
+
+    if alsa_midi is None: return None
+    if sequencer is None:
+        sequencer = alsa_midi.SequencerClient(name)
+    return sequencer
+
+def readGraph(seq=None):
+    if alsa_midi is None: return readGraphFromAconnect()
+
+    if seq is None: seq = openSequencer()
+    graph = MidiGraph()
+
+    clientInfo = seq.query_next_client()
+    while clientInfo:
+        if clientInfo.client_id >= FIRST_USER_CLIENT:
+            client = HubClient(clientInfo.client_id, clientInfo.name)
+            graph.clients[client.clientId] = client
+
+            portInfo = seq.query_next_port(client.clientId)
+            while portInfo:
+                client.ports[portInfo.port_id] = portInfo.name.strip()
+                sender = Address(client.clientId, portInfo.port_id)
+                for subscriber in seq.list_port_subscribers(sender, alsa_midi.SubscriptionQueryType.READ):
+                    graph.subscriptions.add((sender, Address(subscriber.addr.client_id, subscriber.addr.port_id)))
+                portInfo = seq.query_next_port(client.clientId, portInfo)
+
+        clientInfo = seq.query_next_client(clientInfo)
+
+    return graph
+
+#
+# The output of "aconnect -l" looks like this:
+#
+#   client 128: 'rtpmidi midiHub-Sydney-5004' [type=user,pid=1234]
+#       0 'Network         '
+#       1 'Fred Out        '
+#           Connecting To: 128:2
+#       2 'Fred In         '
+#           Connected From: 128:1
+#
+# We only need "Connecting To" to find every subscription.
+#
+clientPattern = re.compile(r"^client (\d+): '(.*)'")
+portPattern = re.compile(r"^\s+(\d+) '(.*)'")
+connectingPattern = re.compile(r'^\s+Connecting To: (.*)')
+addressPattern = re.compile(r'(\d+):(\d+)')
+
+def readGraphFromAconnect():
+    graph = MidiGraph()
+    client = None
+    sender = None
+
+    metrics.subprocessInvocations.inc()
+    output = os.popen('aconnect -l').read().split('\n')
+    for line in output:
+        match = clientPattern.match(line)
+        if match:
+            clientId = int(match.group(1))
+            client = None
+            if clientId >= FIRST_USER_CLIENT:
+                client = HubClient(clientId, match.group(2))
+                graph.clients[clientId] = client
+            continue
+
+        if not client: continue
+
+        match = portPattern.match(line)
+        if match:
+            sender = Address(client.clientId, int(match.group(1)))
+            client.ports[sender.portId] = match.group(2).strip()
+            continue
+
+        match = connectingPattern.match(line)
+        if match and sender:
+            for dest in addressPattern.findall(match.group(1)):
+                graph.subscriptions.add((sender, Address(int(dest[0]), int(dest[1]))))
+
+    return graph
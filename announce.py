@@ -0,0 +1,111 @@
+#
+# announce.py
+#  Listens to the ALSA "System Announce" port so that midihub.py finds out
+#  about participants joining and leaving as soon as it happens rather than
+#  on the next periodic check.
+#
+#  Whenever a MIDI daemon gains or loses a participant it creates or removes
+#  an ALSA port; the sequencer tells everyone subscribed to System Announce
+#  about it. We read those events in a thread (reading from the sequencer
+#  blocks) and hand them to the main loop through a queue. A byte written to
+#  a pipe wakes the main loop's selector up.
+#
+
+import os
+import time
+import queue
+import logging
+import threading
+
+from alsagraph import alsa_midi, Address, FIRST_USER_CLIENT
+
+if alsa_midi:
+    INTERESTING_EVENTS = {alsa_midi.EventType.CLIENT_START:'client start',
+                          alsa_midi.EventType.CLIENT_EXIT:'client exit',
+                          alsa_midi.EventType.PORT_START:'port start',
+                          alsa_midi.EventType.PORT_EXIT:'port exit',
+                          alsa_midi.EventType.PORT_CHANGE:'port change'}
+
+class AnnounceEvent:
+    def __init__(self, kind, address):
+        self.kind = kind
+        self.address = address
+        self.received = time.monotonic()
+
+class AnnounceListener(threading.Thread):
+    def __init__(self, name='hubAnnounce'):
+        threading.Thread.__init__(self, daemon=True)
+        self.logger = logging.getLogger()
+        self.events = queue.SimpleQueue()
+
+        self.notifyPipe = os.pipe()
+        os.set_blocking(self.notifyPipe[0], False)
+        os.set_blocking(self.notifyPipe[1], False)
+
+        self.client = alsa_midi.SequencerClient(name)
+        self.port = self.client.create_port('announce', caps=alsa_midi.WRITE_PORT)
+        self.port.connect_from(alsa_midi.SYSTEM_ANNOUNCE)
+
+    #
+    # So that the listener itself can be registered with a selector
+    #
+    def fileno(self):
+        return self.notifyPipe[0]
+
+    def run(self):
+        while True:
+            try:
+                event = self.client.event_input()
+            except Exception as e:
+                self.logger.error(f'Failed to read announce event: {e}')
+                time.sleep(1)
+                continue
+
+            kind = INTERESTING_EVENTS.get(event.type)
+            if not kind: continue
+            if event.addr.client_id < FIRST_USER_CLIENT: continue
+
+            self.events.put(AnnounceEvent(kind, Address(event.addr.client_id, event.addr.port_id)))
+            try:
+                os.write(self.notifyPipe[1], b'\0')
+            except BlockingIOError:
+                pass # The main loop already has a wakeup waiting
+
+    #
+    # Called from the main loop - returns all of the events received since
+    # the last time we were called.
+    #
+    def drain(self):
+        try:
+            while os.read(self.notifyPipe[0], 512): pass
+        except BlockingIOError:
+            pass
+
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        return events
+
+#
+# Returns a running listener or None if we can't listen to announcements
+# (because alsa_midi isn't installed or the sequencer isn't available).
+#
+def startAnnounceListener():
+    logger = logging.getLogger()
+
+    if alsa_midi is None:
+        logger.info('alsa_midi not installed - not listening for announcements')
+        return None
+
+    try:
+        listener = AnnounceListener()
+    except Exception as e:
+        logger.warning(f'Cannot subscribe to System Announce: {e}')
+        return None
+
+    listener.start()
+    logger.info('Listening for participants joining and leaving')
+    return listener
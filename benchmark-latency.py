@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+
+#
+# benchmark-latency.py
+#  Measures how fast latency measurements can be pulled out of rtpmidid
+#  logs. Writes a synthetic log (and the same thing as grep would give it to
+#  us) to a temporary directory and runs each parser over it:
+#   benchmark-latency.py [lines] [latency lines per 100]
+#  Defaults are 1000000 lines with 5 in every 100 carrying a latency.
+#
+#  "lines" is the old line by line parser from update-latency.py (kept here
+#  as the baseline); "mmap" and "grep stream" are latencylog.py reading a
+#  log file and grep output. All three have to find the same measurements
+#  or we stop with an error - so this doubles as a check on the parser.
+#
+
+import os
+import io
+import sys
+import time
+import random
+import tempfile
+
+from latencylog import scanFile, scanGrepStream
+
+NAMES = ['Fred', 'Jo Bloggs', 'Studio: Left', 'Piano-2', 'Drums Out']
+NOISE = [b'[2024-01-01 10:00:00] [info] [rtppeer.cpp:123] Got CK from peer\n',
+         b'[2024-01-01 10:00:00] [debug] [rtpserver.cpp:456] Sending MIDI data to 3 peers\n',
+         b'[2024-01-01 10:00:00] [info] [rtpmidid.cpp:78] New connection from 10.0.0.1:5004\n']
+
+def makeLog(lineCount, latencyPercent):
+    rng = random.Random(42)
+    lines = []
+    for index in range(lineCount):
+        if rng.randrange(100) < latencyPercent:
+            name = rng.choice(NAMES)
+            lines.append(f'[2024-01-01 10:00:00] [info] [rtppeer.cpp:321] Latency {name}: {rng.uniform(1, 60):.2f}  ms\n'.encode())
+        else:
+            lines.append(rng.choice(NOISE))
+    return b''.join(lines)
+
+#
+# What update-latency.py did before latencylog.py, without the logging
+#
+def oldParser(lines):
+    found = []
+    for line in lines:
+        latencyMarker = line.find('Latency')
+        outputMarker = line.find('output')
+        msMarker = line.find(' ms')
+        if latencyMarker == -1 or outputMarker == -1 or msMarker == -1: continue
+
+        msNumber = line.index(':', latencyMarker)+2
+        logMarker = line.index('.log')
+        try:
+            clientName = line[latencyMarker+8:msNumber-2]
+            latencyValue = float(line[msNumber:msMarker-1])
+            portNumber = int(line[outputMarker+7:logMarker])
+        except Exception:
+            continue
+        found.append((portNumber, clientName, latencyValue))
+    return found
+
+def timeIt(label, lineCount, byteCount, function):
+    started = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter()-started
+    print(f'{label:12} {elapsed:8.3f}s {lineCount/elapsed:12,.0f} lines/s {byteCount/elapsed/1048576:8.1f} MB/s {len(result):9} found')
+    return result
+
+def main():
+    lineCount = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    latencyPercent = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    log = makeLog(lineCount, latencyPercent)
+    grepped = b''.join(b'output-5004.log:'+line+b'\n' for line in log.split(b'\n') if b'Latency' in line)
+    latencyCount = grepped.count(b'\n')
+    print(f'{lineCount} lines ({len(log)/1048576:.1f} MB), {latencyCount} with a latency')
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'output-5004.log')
+        with open(filename, 'wb') as logFile:
+            logFile.write(log)
+
+        # The old parser only ever saw grep's output, so that's what it gets
+        # here too - which flatters it
+        grepLines = grepped.decode().splitlines(True)
+        old = timeIt('lines', len(grepLines), len(grepped), lambda: oldParser(grepLines))
+        fromFile = timeIt('mmap', lineCount, len(log), lambda: scanFile(filename)[0])
+        fromGrep = timeIt('grep stream', len(grepLines), len(grepped), lambda: list(scanGrepStream(io.BytesIO(grepped))))
+
+    if [(name, value) for port, name, value in fromGrep] != fromFile:
+        sys.exit('mmap and grep stream parsers disagree')
+    #
+    # The old parser dropped the last digit of the number and couldn't cope
+    # with names with ": " in them
+    #
+    fromGrep = [(port, name, value) for port, name, value in fromGrep if ': ' not in name]
+    if len(old) != len(fromGrep) or any(oldPort != port or oldName != name or abs(oldValue-value) >= 0.1
+                                        for (oldPort, oldName, oldValue), (port, name, value) in zip(old, fromGrep)):
+        sys.exit('new and old parsers disagree')
+
+if __name__ == "__main__":
+    main()
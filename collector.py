@@ -0,0 +1,162 @@
+#
+# collector.py
+#  Publishes the participants and latency to DynamoDB from inside
+#  midihub.py, instead of cron starting update-participants.py and
+#  update-latency.py (two interpreters, two boto3 sessions and another
+#  aconnect) every minute.
+#
+#  The participants come straight from the ALSA graph the main loop has
+#  just read (updateParticipants()); the latency comes from the daemon logs
+#  the same way "update-latency.py --incremental" reads them (see
+#  latencyreader.py). Both tables are written through one boto3 client so
+#  they share its connections, and both are written in the same cycle from
+#  the same list of participants - the hub rollup in the history table has
+#  the participants in it too.
+#
+#  Everything happens in its own thread so a slow DynamoDB never holds up
+#  the main loop. The settings come from the "collector" section of
+#  midihub.json (read at startup):
+#   {"collector": {"interval": 60, "onChange": true, "minInterval": 5}}
+#  interval:    seconds between publishing. 0 turns the collector off.
+#  onChange:    publish the participants as soon as they change rather than
+#               waiting for the next interval...
+#  minInterval: ...but not more often than this.
+#  The table name comes from "dynamodbtable" in the running directory; if
+#  there isn't one the collector doesn't start.
+#
+
+import json
+import time
+import logging
+import threading
+
+from latencyreader import LatencyTail, historyItems
+from tablewriter import ChangeWriter, backendFor, historyTableName, HISTORY_KEY
+import metrics
+
+DEFAULT_INTERVAL = 60
+DEFAULT_MIN_INTERVAL = 5
+TABLE_FILE = 'dynamodbtable'
+PARTICIPANTS_DIGEST = 'participants-digest.json'
+
+class Collector(threading.Thread):
+    def __init__(self, tableName, interval=DEFAULT_INTERVAL, onChange=True, minInterval=DEFAULT_MIN_INTERVAL):
+        threading.Thread.__init__(self, daemon=True)
+        self.logger = logging.getLogger()
+        self.interval = interval
+        self.onChange = onChange
+        self.minInterval = minInterval
+
+        client = None
+        if not tableName.startswith(('sqlite:', 'memory:')):
+            import boto3
+            client = boto3.session.Session().client('dynamodb')
+        self.participantsWriter = ChangeWriter(backendFor(tableName, client=client), PARTICIPANTS_DIGEST)
+        self.historyWriter = ChangeWriter(backendFor(historyTableName(tableName), HISTORY_KEY, client), keyName=HISTORY_KEY)
+        self.tail = LatencyTail()
+
+        self.lock = threading.Lock()
+        self.participants = None
+        self.wakeup = threading.Event()
+        self.stopping = False
+
+    #
+    # Called from the main loop with port: [names] every time it reads the
+    # graph
+    #
+    def updateParticipants(self, participants):
+        with self.lock:
+            if participants == self.participants: return
+            self.participants = participants
+        if self.onChange: self.wakeup.set()
+
+    #
+    # Publish one last time and stop
+    #
+    def stop(self, timeout):
+        self.stopping = True
+        self.wakeup.set()
+        self.join(timeout)
+
+    def run(self):
+        nextPublish = time.monotonic()+self.interval
+        nextParticipants = 0
+        pending = False
+
+        while not self.stopping:
+            deadline = min(nextPublish, nextParticipants) if pending else nextPublish
+            if self.wakeup.wait(max(deadline-time.monotonic(), 0)):
+                self.wakeup.clear()
+                pending = True
+
+            now = time.monotonic()
+            if now >= nextPublish:
+                self.publish(latency=True)
+                nextPublish = now+self.interval
+            elif pending and now >= nextParticipants:
+                self.publish(latency=False)
+            else:
+                continue
+            nextParticipants = now+self.minInterval
+            pending = False
+
+        self.publish(latency=True)
+
+    def publish(self, latency):
+        with self.lock:
+            participants = self.participants
+
+        try:
+            failed = 0
+            if participants is not None:
+                self.participantsWriter.put({'clientId':'Participants', 'list':json.dumps(participants, sort_keys=True)})
+                failed += self.participantsWriter.flush()
+
+            if latency:
+                for item in historyItems(self.tail.read(), int(time.time()), participants=participants):
+                    self.historyWriter.put(item)
+                if self.historyWriter.flush():
+                    #
+                    # Read the same lines again next time rather than
+                    # letting the queue grow while DynamoDB is unhappy
+                    #
+                    failed += self.historyWriter.drop()
+                    self.tail.rewind()
+                else:
+                    self.tail.save()
+        except Exception as e:
+            self.logger.error(f'Collector failed to publish: {e}')
+            failed = 1
+
+        metrics.collectorPublishes.inc(result='failed' if failed else 'ok')
+
+#
+# Returns a running collector or None if it's turned off or can't start
+#
+def startCollector(config=None, tableFile=TABLE_FILE):
+    logger = logging.getLogger()
+    if config is None: config = {}
+
+    interval = float(config.get('interval', DEFAULT_INTERVAL))
+    if not interval: return None
+
+    try:
+        with open(tableFile) as ddbfile:
+            tableName = ddbfile.read().strip()
+    except FileNotFoundError:
+        logger.info(f'No {tableFile} file - not publishing participants and latency')
+        return None
+    except Exception as e:
+        logger.warning(f'Cannot read table name: {e}')
+        return None
+
+    try:
+        collector = Collector(tableName, interval, bool(config.get('onChange', True)),
+                              float(config.get('minInterval', DEFAULT_MIN_INTERVAL)))
+    except Exception as e:
+        logger.warning(f'Cannot start collector: {e}')
+        return None
+
+    collector.start()
+    logger.info(f'Publishing participants and latency to {tableName} every {interval:g}s')
+    return collector
@@ -0,0 +1,121 @@
+#
+# hubbus.py
+#  "Bus" mode for midihub.py (--bus on the command line).
+#
+#  Normally every sender on a daemon is connected directly to every receiver
+#  so a room with N participants can need N*N connections. In bus mode we
+#  create one port of our own for each daemon (the bus). Every sender is
+#  connected once to the bus and the bus is connected once to every
+#  receiver, so the number of connections only grows with the size of the
+#  room.
+#
+#  Events arriving on the bus are forwarded by a thread here. Rather than
+#  letting ALSA send them to everyone subscribed to the bus we send each
+#  event directly to the receivers that the routing policy says the sender
+#  should reach - in particular nobody ever hears themselves back (echo
+#  suppression) which would happen if the bus just sent to all subscribers.
+#
+#  If onEvent is set it is called with the sender's address for every event
+#  (loopguard.py uses this to count events).
+#
+
+import time
+import logging
+import threading
+
+from alsagraph import alsa_midi, Address
+
+class HubBus(threading.Thread):
+    def __init__(self, name='hubBus'):
+        threading.Thread.__init__(self, daemon=True)
+        self.logger = logging.getLogger()
+        self.client = alsa_midi.SequencerClient(name)
+        self.clientId = self.client.client_id
+        self.ports = {}
+        self.routes = {}
+        self.onEvent = None
+
+    #
+    # Addresses of all of the bus ports - reconcile uses these to know which
+    # connections to the bus belong to us.
+    #
+    def addresses(self):
+        return set(Address(self.clientId, port.port_id) for port in self.ports.values())
+
+    #
+    # Called from the main loop with the hub clients from the graph and the
+    # (source, destination) pairs the routing policy wants. Creates or closes
+    # bus ports to match the clients, updates the forwarding table and returns
+    # the connections that should exist to and from the bus.
+    #
+    def update(self, clients, desired):
+        current = set(client.clientId for client in clients)
+
+        for clientId in list(self.ports):
+            if clientId in current: continue
+            self.logger.info(f'Closing bus for client {clientId}')
+            self.ports.pop(clientId).close()
+
+        for client in clients:
+            if client.clientId in self.ports: continue
+            self.logger.info(f'Creating bus for client {client.clientId} ({client.hubName})')
+            self.ports[client.clientId] = self.client.create_port(f'bus {client.hubName}', caps=alsa_midi.RW_PORT)
+
+        routes = {}
+        connections = set()
+        for source, dest in desired:
+            port = self.ports.get(source.clientId)
+            if not port: continue
+            bus = Address(self.clientId, port.port_id)
+            routes.setdefault(port.port_id, {}).setdefault(source, []).append(tuple(dest))
+            connections.add((source, bus))
+            connections.add((bus, dest))
+
+        # Swapping the whole table is atomic as far as the forwarding thread
+        # is concerned so it never sees a half-built one
+        self.routes = routes
+        return connections
+
+    def run(self):
+        while True:
+            try:
+                event = self.client.event_input()
+            except Exception as e:
+                self.logger.error(f'Bus failed to read event: {e}')
+                time.sleep(1)
+                continue
+
+            if event.source is None or event.dest is None: continue
+            if self.onEvent: self.onEvent(Address(event.source.client_id, event.source.port_id))
+            table = self.routes.get(event.dest.port_id)
+            if not table: continue
+
+            destinations = table.get((event.source.client_id, event.source.port_id))
+            if not destinations: continue
+
+            try:
+                for dest in destinations:
+                    self.client.event_output(event, port=event.dest.port_id, dest=dest)
+                self.client.drain_output()
+            except Exception as e:
+                self.logger.warning(f'Bus failed to forward event from {event.source}: {e}')
+
+#
+# Returns a running bus or None if we can't create one
+#
+def startHubBus():
+    logger = logging.getLogger()
+
+    if alsa_midi is None:
+        logger.warning('alsa_midi not installed - cannot run in bus mode')
+        return None
+
+    try:
+        bus = HubBus()
+    except Exception as e:
+        logger.warning(f'Cannot create bus sequencer client: {e}')
+        return None
+
+    bus.start()
+    logger.info(f'Running in bus mode (client {bus.clientId})')
+    return bus
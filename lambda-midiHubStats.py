@@ -1,41 +1,94 @@
 import json
 import boto3
 import os
+import time
 import logging
 
 dynamodb = boto3.client('dynamodb')
 
-tableName = os.environ.get('TableName')
+historyTableName = os.environ.get('HistoryTableName')
+
+#
+# Not every item has all of these - "--control" only gives us the last
+# latency and the per port ("*") series don't have a last latency or jitter
+#
+LATENCY_FIELDS = ['averageLatency', 'maxLatency', 'minLatency', 'lastLatency',
+                  'p50Latency', 'p90Latency', 'p99Latency', 'jitter']
+HUB_SERIES = 'hub'
+DEFAULT_MINUTES = 60
+MAX_MINUTES = 7*1440
 
 logging.basicConfig()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+#
+# No parameters: everyone's current latency (from the latest hub rollup).
+# ?port=5004 or ?series=Fred-5004 (and optionally &minutes=N): the last N
+# minutes of that port or client. Either way it's a single Query.
+#
 def lambda_handler(event, context):
-    global logger, tableName
-    
-    if not tableName:
-        logger.error('TableName not set - stopping')
-        return {'statusCode':500, 'body':'TableName not set'}
+    global logger, historyTableName
+
+    if not historyTableName:
+        logger.error('HistoryTableName not set - stopping')
+        return {'statusCode':500, 'body':'HistoryTableName not set'}
+
+    parameters = event.get('queryStringParameters') or {}
+    series = parameters.get('series')
+    if parameters.get('port'): series = f'*-{parameters["port"]}'
+
+    if not series: return currentLatency()
+
+    try:
+        minutes = min(int(parameters.get('minutes', DEFAULT_MINUTES)), MAX_MINUTES)
+    except ValueError:
+        return {'statusCode':400, 'body':'minutes must be a number'}
+    return latencyTrend(series, minutes)
+
+def currentLatency():
+    global logger, historyTableName
+
+    response = dynamodb.query(TableName=historyTableName,
+                              KeyConditionExpression='series = :series',
+                              ExpressionAttributeValues={':series':{'S':HUB_SERIES}},
+                              ScanIndexForward=False, Limit=1)
+    if not response['Items']: return []
 
-    paginator = dynamodb.get_paginator('scan')
-    iterator = paginator.paginate(TableName=tableName)
+    try:
+        clients = json.loads(response['Items'][0]['clients']['S'])
+    except Exception as e:
+        logger.error(f'Cannot interpret rollup: {e}')
+        return {'statusCode':500, 'body':'Rollup JSON error'}
 
     output = []
-    for page in iterator:
-        for stat in page['Items']:
-            if stat['clientId']['S'] == 'Participants': continue
+    for id, stats in sorted(clients.items()):
+        (name,port) = id.rsplit('-', 1)
+        if name == '*': name = 'Everyone'
+
+        item = {'clientName':name, 'clientPort':port, 'timestamp':stats.get('timestamp')}
+        for field in LATENCY_FIELDS:
+            item[field] = stats.get(field, '-')
+        output.append(item)
+
+    return(output)
 
-            try:
-                (name,port) = stat['clientId']['S'].split('-')
+def latencyTrend(series, minutes):
+    global logger, historyTableName
 
-                item = {'clientName':name, 'clientPort':port, 'timestamp': stat['timestamp']['N'],
-                        'averageLatency':stat['averageLatency']['S'], 'maxLatency':stat['maxLatency']['S'],
-                        'minLatency':stat['minLatency']['S'], 'lastLatency':stat['lastLatency']['S']}
-            except:
-                logger.error(f'Cannot interpret item {stat}')
-                continue
- 
-            output.append(item)
+    fromMinute = int(time.time())//60-minutes
+    paginator = dynamodb.get_paginator('query')
+    iterator = paginator.paginate(TableName=historyTableName,
+                                  KeyConditionExpression='series = :series AND #minute >= :from',
+                                  ExpressionAttributeNames={'#minute':'minute'},
+                                  ExpressionAttributeValues={':series':{'S':series}, ':from':{'N':str(fromMinute)}})
+
+    points = []
+    for page in iterator:
+        for stat in page['Items']:
+            point = {'minute':int(stat['minute']['N'])}
+            for field in LATENCY_FIELDS:
+                point[field] = stat[field]['S'] if field in stat else '-'
+            points.append(point)
 
-    return(output) 
+    return({'series':series, 'minutes':minutes, 'points':points})
@@ -0,0 +1,86 @@
+#
+# latencylog.py
+#  Pulls latency measurements out of rtpmidid logs. Lines we want look like:
+#   ... Latency Fred: 12.3  ms ...
+#  and when they come from grep they have the log file name at the front:
+#   output-5004.log:... Latency Fred: 12.3  ms ...
+#
+#  Everything works on bytes with one compiled regular expression run over
+#  the whole buffer, so nothing is decoded and lines without a latency on
+#  them cost no more than the regex engine skipping past them. Log files are
+#  memory mapped rather than read in; a pipe is read in big chunks.
+#
+#  benchmark-latency.py measures this against the line by line parser it
+#  replaced.
+#
+
+import re
+import mmap
+
+CHUNK_SIZE = 1024*1024
+
+#
+# The number is followed by an optional character (rtpmidid leaves a gap
+# before "ms") - the client name is everything between "Latency " and the
+# last ": " before the number, so names can have ": " in them. Both start
+# with a literal so the regex engine can skip to candidate lines quickly.
+#
+LATENCY_PATTERN = re.compile(rb'Latency ([^\n]*): ([0-9]+(?:\.[0-9]*)?)[^\n0-9]? ms')
+GREP_PATTERN = re.compile(rb'output-([0-9]+)\.log:[^\n]*?Latency ([^\n]*): ([0-9]+(?:\.[0-9]*)?)[^\n0-9]? ms')
+
+#
+# The same few names turn up over and over so they're only decoded once
+#
+names = {}
+
+def clientName(name):
+    decoded = names.get(name)
+    if decoded is None:
+        if len(names) > 10000: names.clear()
+        decoded = names[name] = name.decode(errors='replace')
+    return decoded
+
+#
+# (clientName, latency) for each measurement in data[start:end]
+#
+def parseLatency(data, start=0, end=None):
+    if end is None: end = len(data)
+    return [(clientName(name), float(value)) for name, value in LATENCY_PATTERN.findall(data, start, end)]
+
+#
+# (port, clientName, latency) for each measurement in data[start:end] of
+# grep output
+#
+def parseGrepOutput(data, start=0, end=None):
+    if end is None: end = len(data)
+    return [(int(port), clientName(name), float(value)) for port, name, value in GREP_PATTERN.findall(data, start, end)]
+
+#
+# The measurements in the complete lines of a file after offset, and the
+# offset of the end of the last complete line (a line that's still being
+# written is left for next time).
+#
+def scanFile(filename, offset=0):
+    with open(filename, 'rb') as logFile:
+        size = logFile.seek(0, 2)
+        if size <= offset: return [], offset
+
+        with mmap.mmap(logFile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            end = data.rfind(b'\n', offset)+1
+            if end <= offset: return [], offset
+            return parseLatency(data, offset, end), end
+
+#
+# Reads a binary stream of grep output in chunks; a chunk is cut back to
+# its last newline and the rest carried into the next one.
+#
+def scanGrepStream(stream, chunkSize=CHUNK_SIZE):
+    carry = b''
+    while True:
+        chunk = stream.read(chunkSize)
+        if not chunk: break
+        data = carry+chunk
+        end = data.rfind(b'\n')+1
+        yield from parseGrepOutput(data, 0, end)
+        carry = data[end:]
+    if carry: yield from parseGrepOutput(carry)
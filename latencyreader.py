@@ -0,0 +1,227 @@
+#
+# latencyreader.py
+#  Turns rtpmidid latency measurements into items for the history table.
+#  Shared by update-latency.py (run from cron or by hand) and the collector
+#  in midihub.py (see collector.py).
+#
+#  Measurements are kept per client ("Fred-5004") in a LatencyWindow (see
+#  latencysketch.py). historyItems() gives the items to write for the
+#  clients that have new samples: one per client, one per port ("*-5004")
+#  with everyone on the port merged together, and a rollup for the whole
+#  hub ("hub") with everyone's current numbers in it. All of them are keyed
+#  by series and minute.
+#
+#  LatencyTail reads only what has been added to the daemon logs
+#  (output-{port}.log in the current directory) since it last looked. The
+#  inode and offset of each log are kept in OFFSETS_FILE and the windows in
+#  SKETCHES_FILE so that a restart carries on where it left off. If a log
+#  has been replaced (rotated) we finish reading the old one if it's still
+#  around and start the new one from the beginning; if it has been
+#  truncated we start again from the beginning.
+#
+
+import os
+import re
+import json
+import glob
+import logging
+
+from latencylog import scanFile, scanGrepStream
+from latencysketch import LatencySketch, LatencyWindow
+
+OFFSETS_FILE = 'latency-offsets.json'
+SKETCHES_FILE = 'latency-sketches.json'
+PORT_SUMMARY = '*'
+HUB_SERIES = 'hub'
+HISTORY_DAYS = 7
+LOG_PATTERN = 'output-*.log'
+
+def addLatency(latencyStats, clientName, portNumber, latencyValue):
+    id = f'{clientName}-{portNumber}'
+    if id not in latencyStats: latencyStats[id] = LatencyWindow()
+    latencyStats[id].add(latencyValue)
+
+#
+# Lines from grep look like "output-5004.log:... Latency Fred: 12.3 ms" -
+# the port number comes from the file name grep puts at the front. Lines
+# without a latency on them are skipped (see latencylog.py).
+#
+def readLogLatency(latencyStats, stream):
+    samples = 0
+    for portNumber, clientName, latencyValue in scanGrepStream(stream):
+        addLatency(latencyStats, clientName, portNumber, latencyValue)
+        samples += 1
+    if not samples: logging.getLogger().warning('No latency info found in input')
+
+def sketchItem(sketch):
+    return {'averageLatency':str(round(sketch.average(), 1)), 'minLatency':str(sketch.minimum),
+            'maxLatency':str(sketch.maximum), 'p50Latency':str(round(sketch.quantile(0.5), 1)),
+            'p90Latency':str(round(sketch.quantile(0.9), 1)), 'p99Latency':str(round(sketch.quantile(0.99), 1)),
+            'samples':sketch.count}
+
+#
+# Items for the history table. lastOnly is for "--control" where we only
+# have one sample per client. participants (port: [names]), if given, goes
+# into the rollup too so that the two always match.
+#
+def historyItems(latencyStats, now, lastOnly=False, participants=None):
+    updatedPorts = set(id.rsplit('-', 1)[-1] for id, window in latencyStats.items() if window.updated)
+    if not updatedPorts: return []
+
+    #
+    # Per port figures are all of the clients on the port merged together
+    #
+    portStats = {}
+    for id, window in latencyStats.items():
+        port = id.rsplit('-', 1)[-1]
+        if port not in portStats: portStats[port] = LatencySketch()
+        portStats[port].merge(window.summary())
+
+    minute = now//60
+    expiry = now+HISTORY_DAYS*86400
+    items = []
+    current = {}
+    for id, window in latencyStats.items():
+        # Need to store floats as strings because DynamoDB doesn't support
+        # float typess here
+        stats = {'timestamp':max(window.sketches, default=minute)*60, 'lastLatency':str(window.last)}
+        if not lastOnly:
+            stats.update(sketchItem(window.summary()))
+            stats['jitter'] = str(round(window.jitter, 1))
+        current[id] = stats
+        if window.updated: items.append(dict(stats, series=id, minute=minute, timestamp=now, expiryTime=expiry))
+
+    if not lastOnly:
+        for port, sketch in portStats.items():
+            stats = sketchItem(sketch)
+            current[f'{PORT_SUMMARY}-{port}'] = dict(stats, timestamp=now)
+            if port in updatedPorts:
+                items.append(dict(stats, series=f'{PORT_SUMMARY}-{port}', minute=minute, timestamp=now, expiryTime=expiry))
+
+    rollup = {'series':HUB_SERIES, 'minute':minute, 'timestamp':now, 'expiryTime':expiry,
+              'clients':json.dumps(current, sort_keys=True)}
+    if participants is not None: rollup['participants'] = json.dumps(participants, sort_keys=True)
+    items.append(rollup)
+    return items
+
+class LatencyTail:
+    def __init__(self, directory='.'):
+        self.logger = logging.getLogger()
+        self.directory = directory
+        self.offsetsFile = os.path.join(directory, OFFSETS_FILE)
+        self.sketchesFile = os.path.join(directory, SKETCHES_FILE)
+        self.latencyStats = self._loadSketches()
+        self.offsets = self._load(self.offsetsFile, 'starting from the beginning')
+        self.newOffsets = self.offsets
+
+    #
+    # Read what's new in the logs. The new offsets aren't used (or saved)
+    # until save() - if the results couldn't be written, call rewind() and
+    # the same lines are read again next time.
+    #
+    def read(self):
+        for window in self.latencyStats.values(): window.updated = False
+
+        newOffsets = {}
+        for filename in glob.glob(os.path.join(self.directory, LOG_PATTERN)):
+            match = re.search(r'output-(\d+)\.log$', filename)
+            if not match: continue
+            portNumber = int(match.group(1))
+            name = os.path.basename(filename)
+
+            try:
+                info = os.stat(filename)
+            except OSError:
+                continue
+            previous = self.offsets.get(name, {})
+            offset = previous.get('offset', 0)
+
+            if previous and previous.get('inode') != info.st_ino:
+                rotated = self._findByInode(previous.get('inode'))
+                if rotated:
+                    self.logger.info(f'{name} was rotated - finishing {rotated}')
+                    self._readLines(rotated, offset, portNumber)
+                else:
+                    self.logger.info(f'{name} was replaced - starting from the beginning')
+                offset = 0
+            elif info.st_size < offset:
+                self.logger.info(f'{name} was truncated - starting from the beginning')
+                offset = 0
+
+            offset = self._readLines(filename, offset, portNumber)
+            newOffsets[name] = {'inode':info.st_ino, 'offset':offset}
+
+        self.newOffsets = newOffsets
+        return self.latencyStats
+
+    def save(self):
+        self.offsets = self.newOffsets
+        self.latencyStats = {id: window for id, window in self.latencyStats.items() if window.prune()}
+        self._save(self.sketchesFile, {id: window.toDict() for id, window in self.latencyStats.items()})
+        self._save(self.offsetsFile, self.offsets)
+
+    #
+    # Forget what was read since the last save() - the windows go back to
+    # what was saved
+    #
+    def rewind(self):
+        self.newOffsets = self.offsets
+        self.latencyStats = self._loadSketches()
+
+    #
+    # Read the complete lines after offset and return the offset of the end
+    # of the last one - a line that is still being written is left for next
+    # time.
+    #
+    def _readLines(self, filename, offset, portNumber):
+        try:
+            samples, offset = scanFile(filename, offset)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f'Cannot read {filename}: {e}')
+            return offset
+
+        for clientName, latencyValue in samples:
+            addLatency(self.latencyStats, clientName, portNumber, latencyValue)
+        return offset
+
+    #
+    # A rotated log has been renamed (output-5004.log.1 or similar) so we
+    # look for it by inode among the files next to the logs.
+    #
+    def _findByInode(self, inode):
+        if inode is None: return None
+        for filename in glob.glob(os.path.join(self.directory, LOG_PATTERN+'*')):
+            try:
+                if os.stat(filename).st_ino == inode: return filename
+            except OSError:
+                continue
+        return None
+
+    #
+    # The windows from before - clients whose windows have emptied are
+    # forgotten
+    #
+    def _loadSketches(self):
+        latencyStats = {}
+        for id, data in self._load(self.sketchesFile, 'starting again').items():
+            window = LatencyWindow.fromDict(data)
+            if window.prune(): latencyStats[id] = window
+        return latencyStats
+
+    def _load(self, filename, action):
+        try:
+            with open(filename) as stateFile:
+                return json.load(stateFile)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            self.logger.warning(f'Cannot read {filename} - {action}: {e}')
+            return {}
+
+    def _save(self, filename, data):
+        try:
+            with open(filename+'.tmp', 'w') as stateFile:
+                json.dump(data, stateFile)
+            os.replace(filename+'.tmp', filename)
+        except OSError as e:
+            self.logger.warning(f'Cannot save {filename}: {e}')
@@ -0,0 +1,145 @@
+#
+# latencysketch.py
+#  Latency percentiles without keeping every sample.
+#
+#  LatencySketch is a histogram with logarithmic buckets (in the style of
+#  HDR histograms): each bucket is PRECISION (2%) wider than the one before
+#  so any percentile we report is within 2% of the real one. Samples are
+#  clamped to MIN_VALUE-MAX_VALUE ms, so there can never be more than a few
+#  hundred buckets whatever happens. Two sketches can be merged by adding
+#  their buckets together - which is how the sliding window and the per port
+#  figures are worked out.
+#
+#  LatencyWindow keeps one sketch per minute for the last WINDOW_MINUTES
+#  minutes of one client, plus the last sample and the jitter (smoothed
+#  difference between one sample and the next, as RTP does it in RFC 3550).
+#  Minutes that drop out of the window are thrown away so a session that
+#  runs for weeks uses no more memory than one that runs for a quarter of an
+#  hour.
+#
+#  Both can be turned into (and back from) plain dictionaries to be saved as
+#  JSON between runs of update-latency.py.
+#
+
+import math
+import time
+
+PRECISION = 0.02
+MIN_VALUE = 0.01
+MAX_VALUE = 60000.0
+WINDOW_MINUTES = 15
+JITTER_GAIN = 16
+
+LOG_BASE = math.log(1+PRECISION)
+MAX_BUCKET = int(math.ceil(math.log(MAX_VALUE/MIN_VALUE)/LOG_BASE))
+
+class LatencySketch:
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value):
+        value = min(max(value, MIN_VALUE), MAX_VALUE)
+        bucket = min(int(round(math.log(value/MIN_VALUE)/LOG_BASE)), MAX_BUCKET)
+        self.buckets[bucket] = self.buckets.get(bucket, 0)+1
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum: self.minimum = value
+        if self.maximum is None or value > self.maximum: self.maximum = value
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0)+count
+        self.count += other.count
+        self.total += other.total
+        if other.minimum is not None and (self.minimum is None or other.minimum < self.minimum): self.minimum = other.minimum
+        if other.maximum is not None and (self.maximum is None or other.maximum > self.maximum): self.maximum = other.maximum
+        return self
+
+    #
+    # The value below which a fraction q (0-1) of the samples fall. The
+    # smallest and largest are exact; everything else is a bucket's value.
+    #
+    def quantile(self, q):
+        if not self.count: return None
+        if q <= 0: return self.minimum
+        if q >= 1: return self.maximum
+
+        rank = max(1, int(math.ceil(q*self.count)))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(max(MIN_VALUE*(1+PRECISION)**bucket, self.minimum), self.maximum)
+        return self.maximum
+
+    def average(self):
+        if not self.count: return None
+        return self.total/self.count
+
+    def toDict(self):
+        return {'buckets': {str(bucket): count for bucket, count in self.buckets.items()},
+                'count': self.count, 'total': self.total, 'min': self.minimum, 'max': self.maximum}
+
+    @staticmethod
+    def fromDict(data):
+        sketch = LatencySketch()
+        sketch.buckets = {int(bucket): int(count) for bucket, count in data.get('buckets', {}).items()}
+        sketch.count = int(data.get('count', 0))
+        sketch.total = float(data.get('total', 0))
+        sketch.minimum = data.get('min')
+        sketch.maximum = data.get('max')
+        return sketch
+
+class LatencyWindow:
+    def __init__(self, minutes=WINDOW_MINUTES):
+        self.minutes = minutes
+        self.sketches = {}
+        self.last = None
+        self.jitter = 0.0
+        self.updated = False
+
+    def add(self, value, now=None):
+        minute = int((time.time() if now is None else now)//60)
+        sketch = self.sketches.get(minute)
+        if sketch is None:
+            sketch = LatencySketch()
+            self.sketches[minute] = sketch
+        sketch.add(value)
+
+        if self.last is not None: self.jitter += (abs(value-self.last)-self.jitter)/JITTER_GAIN
+        self.last = value
+        self.updated = True
+
+    #
+    # Throw away minutes that have dropped out of the window. Returns False
+    # if there is nothing left.
+    #
+    def prune(self, now=None):
+        oldest = int((time.time() if now is None else now)//60)-self.minutes+1
+        for minute in [minute for minute in self.sketches if minute < oldest]:
+            del self.sketches[minute]
+        return len(self.sketches) > 0
+
+    #
+    # Everything in the window as one sketch
+    #
+    def summary(self):
+        merged = LatencySketch()
+        for sketch in self.sketches.values(): merged.merge(sketch)
+        return merged
+
+    def toDict(self):
+        return {'sketches': {str(minute): sketch.toDict() for minute, sketch in self.sketches.items()},
+                'last': self.last, 'jitter': self.jitter}
+
+    @staticmethod
+    def fromDict(data, minutes=WINDOW_MINUTES):
+        window = LatencyWindow(minutes)
+        window.sketches = {int(minute): LatencySketch.fromDict(sketch) for minute, sketch in data.get('sketches', {}).items()}
+        window.last = data.get('last')
+        window.jitter = float(data.get('jitter', 0))
+        return window
@@ -0,0 +1,184 @@
+#
+# location.py
+#  Works out a "nice" display name for where this hub is running (e.g.
+#  "Oregon") which midihub.py puts in the name of each MIDI daemon. This is
+#  just window dressing but if there are a few of these running around the
+#  world it's nice to know which one you're connected to.
+#
+#  We find our AWS region from the instance metadata and look it up in a
+#  table of display names. Only if the region isn't in the table do we ask
+#  Lightsail (which has a nice mapping of region name to "human readable"
+#  name but isn't in every region). Every network call has a short timeout so
+#  that off EC2, or if the network is having a bad day, we carry on without a
+#  location rather than hanging.
+#
+#  The answer is saved in a cache file so normally startup doesn't wait for
+#  the network at all (see findLocation()).
+#
+
+import os
+import json
+import time
+import logging
+import threading
+
+#
+# Configuration:
+#  CACHE_FILE:
+#      Where the last answer is kept (in the running directory).
+#  CACHE_TTL:
+#      How long (seconds) a cached name is used without looking it up
+#      again first. If we can't get a new one when it expires we keep using
+#      the old one.
+#  METADATA_TIMEOUT:
+#      Connect and read timeouts (seconds) for the instance metadata service.
+#      It is local to the instance so it answers quickly or not at all.
+#  LIGHTSAIL_TIMEOUT:
+#      Connect and read timeouts (seconds) for the Lightsail API.
+#
+CACHE_FILE = 'location.json'
+CACHE_TTL = 7*24*60*60
+METADATA_TIMEOUT = (0.5, 1)
+LIGHTSAIL_TIMEOUT = (2, 3)
+
+METADATA_URL = 'http://169.254.169.254/latest'
+
+#
+# Same names that Lightsail uses for the regions it is in
+#
+REGION_NAMES = {
+    'us-east-1': 'Virginia',
+    'us-east-2': 'Ohio',
+    'us-west-1': 'California',
+    'us-west-2': 'Oregon',
+    'ca-central-1': 'Montreal',
+    'sa-east-1': 'Sao Paulo',
+    'eu-west-1': 'Ireland',
+    'eu-west-2': 'London',
+    'eu-west-3': 'Paris',
+    'eu-central-1': 'Frankfurt',
+    'eu-north-1': 'Stockholm',
+    'eu-south-1': 'Milan',
+    'ap-south-1': 'Mumbai',
+    'ap-southeast-1': 'Singapore',
+    'ap-southeast-2': 'Sydney',
+    'ap-southeast-3': 'Jakarta',
+    'ap-northeast-1': 'Tokyo',
+    'ap-northeast-2': 'Seoul',
+    'ap-northeast-3': 'Osaka',
+    'ap-east-1': 'Hong Kong',
+    'me-south-1': 'Bahrain',
+    'af-south-1': 'Cape Town',
+}
+
+#
+# Returns the display name or '' if we don't know where we are. A cached name
+# that is less than CACHE_TTL old is used without asking the network at all
+# so that starting up never waits on the metadata service. The region is
+# still checked in the background in case this is a copy of the instance
+# (or of its home directory) in another region - if it is, the cache is
+# updated for next time.
+#
+def findLocation(cacheFile=CACHE_FILE):
+    logger = logging.getLogger()
+
+    cached = readCache(cacheFile)
+    if cached and time.time()-cached.get('timestamp', 0) < CACHE_TTL:
+        logger.debug(f'Location {cached["displayName"]} ({cached["region"]}) found in cache')
+        threading.Thread(target=refreshLocation, args=(cacheFile, cached), daemon=True).start()
+        return cached['displayName']
+
+    return refreshLocation(cacheFile, cached)
+
+#
+# Look the location up and cache it. Returns the display name (or the old
+# one if we couldn't find a new one).
+#
+def refreshLocation(cacheFile, cached):
+    logger = logging.getLogger()
+    oldName = cached.get('displayName', '')
+
+    regionName = metadataRegion()
+    if not regionName:
+        logger.info('Did not get instance metadata - will not set location')
+        return oldName
+
+    if cached.get('region') == regionName and time.time()-cached.get('timestamp', 0) < CACHE_TTL: return oldName
+
+    displayName = REGION_NAMES.get(regionName) or lightsailRegionName(regionName)
+    if not displayName:
+        if cached.get('region') == regionName:
+            logger.info(f'Cannot look up {regionName} - using old name {oldName}')
+            return oldName
+        logger.info(f'Did not find printable name for {regionName}')
+        return ''
+
+    if cached.get('region') != regionName and oldName: logger.info(f'Now in {regionName} - location is {displayName} from now on')
+    writeCache(cacheFile, {'region':regionName, 'displayName':displayName, 'timestamp':time.time()})
+    return displayName
+
+#
+# The cache is {'region', 'displayName', 'timestamp'} for where we were last
+# time
+#
+def readCache(cacheFile):
+    try:
+        with open(cacheFile) as locationFile:
+            cache = json.load(locationFile)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logging.getLogger().warning(f'Cannot read location cache {cacheFile}: {e}')
+        return {}
+
+    if not isinstance(cache, dict) or not cache.get('region') or not cache.get('displayName'): return {}
+    return cache
+
+#
+# Written to a temporary file and renamed so that a reader never sees half
+# of it.
+#
+def writeCache(cacheFile, cached):
+    try:
+        with open(cacheFile+'.tmp', 'w') as locationFile:
+            json.dump(cached, locationFile)
+        os.replace(cacheFile+'.tmp', cacheFile)
+    except OSError as e:
+        logging.getLogger().warning(f'Cannot write location cache {cacheFile}: {e}')
+
+#
+# Ask the instance metadata service for our region. We try IMDSv2 (which
+# needs a session token) first and fall back to IMDSv1.
+#
+def metadataRegion():
+    import requests
+
+    headers = {}
+    try:
+        response = requests.put(f'{METADATA_URL}/api/token', headers={'X-aws-ec2-metadata-token-ttl-seconds':'60'}, timeout=METADATA_TIMEOUT)
+        if response.ok: headers['X-aws-ec2-metadata-token'] = response.text
+    except requests.exceptions.RequestException:
+        return None # Nothing there - we're not on EC2
+
+    try:
+        response = requests.get(f'{METADATA_URL}/dynamic/instance-identity/document', headers=headers, timeout=METADATA_TIMEOUT)
+        return json.loads(response.content).get('region')
+    except Exception:
+        return None
+
+def lightsailRegionName(regionName):
+    logger = logging.getLogger()
+
+    try:
+        import boto3
+        from botocore.config import Config
+
+        config = Config(connect_timeout=LIGHTSAIL_TIMEOUT[0], read_timeout=LIGHTSAIL_TIMEOUT[1], retries={'max_attempts':1})
+        regionInfo = boto3.client('lightsail', config=config).get_regions().get('regions', [])
+    except Exception as e:
+        logger.info(f'Cannot get Lightsail region info: {e}')
+        return None
+
+    for region in regionInfo:
+        if region['name'] == regionName: return region['displayName']
+    return None
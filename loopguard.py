@@ -0,0 +1,263 @@
+#
+# loopguard.py
+#  Looks out for MIDI feedback loops. With --connectall (or any routing that
+#  connects participants both ways) an instrument that echoes what it
+#  receives ("MIDI thru") sends it straight back to whoever sent it, they
+#  echo it again and so on - the room floods and rtpmidid pegs the CPU.
+#
+#  Two things are watched:
+#   - The connections the hub wants to make. Every group of participants
+#     that can reach each other in a circle (a strongly connected component
+#     of the connection graph) is a possible loop; we log them when they
+#     change so that when something does go wrong we know where to look.
+#   - How many events each participant sends. In bus mode (see hubbus.py)
+#     every event passes through us anyway; otherwise a "monitor" port is
+#     connected to every sender and simply counts what arrives.
+#
+#  A participant that sends more than STORM_RATE events a second for
+#  STORM_CHECKS checks in a row and is part of a loop is storming. We break
+#  the loop by removing its connection to the busiest participant in the
+#  same loop, log it, and keep that link out for BLOCK_TIME seconds.
+#
+
+import time
+import logging
+import threading
+
+from alsagraph import alsa_midi, Address
+import metrics
+
+#
+# Configuration:
+#  CHECK_INTERVAL:
+#      How often (seconds) to look at the event rates.
+#  STORM_RATE:
+#      Events per second from one participant that we consider a storm.
+#      Someone playing fast with a lot of controllers sends a few hundred.
+#  STORM_CHECKS:
+#      How many checks in a row the rate has to be over STORM_RATE.
+#  BLOCK_TIME:
+#      How long (seconds) a link we have broken stays broken.
+#
+CHECK_INTERVAL = 1
+STORM_RATE = 1000
+STORM_CHECKS = 2
+BLOCK_TIME = 300
+
+#
+# Strongly connected components of the graph given as a set of (source,
+# destination) pairs - only those with more than one member (ie loops).
+# This is Tarjan's algorithm without recursion so a big room can't run out
+# of stack.
+#
+def findLoops(connections):
+    edges = {}
+    for source, dest in connections:
+        edges.setdefault(source, []).append(dest)
+        edges.setdefault(dest, [])
+
+    index = {}
+    lowLink = {}
+    stack = []
+    onStack = set()
+    loops = []
+    counter = 0
+
+    for start in edges:
+        if start in index: continue
+        work = [(start, iter(edges[start]))]
+        index[start] = lowLink[start] = counter
+        counter += 1
+        stack.append(start)
+        onStack.add(start)
+
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowLink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    onStack.add(child)
+                    work.append((child, iter(edges[child])))
+                    break
+                if child in onStack: lowLink[node] = min(lowLink[node], index[child])
+            else:
+                work.pop()
+                if work: lowLink[work[-1][0]] = min(lowLink[work[-1][0]], lowLink[node])
+                if lowLink[node] == index[node]:
+                    component = set()
+                    while True:
+                        member = stack.pop()
+                        onStack.discard(member)
+                        component.add(member)
+                        if member == node: break
+                    if len(component) > 1: loops.append(component)
+    return loops
+
+class Room:
+    def __init__(self, hubName, participants, connections):
+        self.hubName = hubName
+        self.participants = participants
+        self.connections = connections
+        self.loops = findLoops(connections)
+        self.loopOf = {}
+        for loop in self.loops:
+            for address in loop: self.loopOf[address] = loop
+
+class LoopGuard:
+    def __init__(self):
+        self.logger = logging.getLogger()
+        self.counts = {}
+        self.lastCheck = time.monotonic()
+        self.rates = {}
+        self.overRate = {}
+        self.blocked = {}
+        self.rooms = {}
+        self.loopNames = {}
+
+    #
+    # Called from the bus or monitor thread for every event. Losing the odd
+    # count to a race with check() doesn't matter so there is no lock.
+    #
+    def count(self, source):
+        self.counts[source] = self.counts.get(source, 0)+1
+
+    #
+    # Takes the connections that routing wants for a client and removes any
+    # links we have broken. Also remembers the room so that check() knows
+    # who is connected to whom, and logs the loops in it if they've changed.
+    #
+    def filter(self, client, desired):
+        now = time.monotonic()
+        for key, until in list(self.blocked.items()):
+            if until > now: continue
+            self.logger.info(f'Loop guard: allowing {key[1]} -> {key[2]} in {key[0]} again')
+            del self.blocked[key]
+
+        participants = client.participants
+        allowed = set()
+        for source, dest in desired:
+            if (client.hubName, participants.get(source.portId), participants.get(dest.portId)) in self.blocked: continue
+            allowed.add((source, dest))
+
+        room = self.rooms.get(client.clientId)
+        if room and room.connections == allowed and room.participants == participants: return allowed
+
+        room = Room(client.hubName, participants, allowed)
+        self.rooms[client.clientId] = room
+
+        loopNames = sorted(sorted(participants.get(address.portId, '?') for address in loop) for loop in room.loops)
+        if loopNames != self.loopNames.get(client.hubName):
+            self.loopNames[client.hubName] = loopNames
+            for names in loopNames:
+                self.logger.info(f'Loop guard: possible feedback loop in {client.hubName}: {", ".join(names)}')
+
+        return allowed
+
+    #
+    # Forget rooms (daemons) that have gone away
+    #
+    def forgetClients(self, clientIds):
+        for clientId in list(self.rooms):
+            if clientId not in clientIds: del self.rooms[clientId]
+
+    #
+    # Called from the main loop every CHECK_INTERVAL. Returns True if we
+    # have broken a link - the connections need to be reconciled.
+    #
+    def check(self):
+        now = time.monotonic()
+        elapsed = max(now-self.lastCheck, 0.001)
+        counts, self.counts = self.counts, {}
+        self.lastCheck = now
+
+        self.rates = {source: total/elapsed for source, total in counts.items()}
+        for source in list(self.overRate):
+            if self.rates.get(source, 0) <= STORM_RATE: del self.overRate[source]
+
+        #
+        # The busiest sender goes first. Breaking one link in a loop is
+        # enough to stop it so we only break one per loop each time; the
+        # others in the loop were most likely only echoing.
+        #
+        brokenLoops = []
+        for source, rate in sorted(self.rates.items(), key=lambda item: -item[1]):
+            if rate <= STORM_RATE: continue
+            self.overRate[source] = self.overRate.get(source, 0)+1
+            if self.overRate[source] < STORM_CHECKS: continue
+
+            room = self.rooms.get(source.clientId)
+            loop = room.loopOf.get(source) if room else None
+            if any(loop is broken for broken in brokenLoops): continue
+            if self.breakLoop(room, source, rate): brokenLoops.append(loop)
+        return len(brokenLoops) > 0
+
+    def breakLoop(self, room, source, rate):
+        if not room: return False
+        sourceName = room.participants.get(source.portId, f'{source.clientId}:{source.portId}')
+
+        loop = room.loopOf.get(source)
+        if not loop:
+            if self.overRate[source] == STORM_CHECKS:
+                self.logger.warning(f'Loop guard: {sourceName} in {room.hubName} is sending {rate:.0f} events/s but is not in a loop - leaving it')
+            return False
+
+        candidates = [dest for s, dest in room.connections if s == source and dest in loop]
+        if not candidates: return False
+        dest = max(candidates, key=lambda address: self.rates.get(address, 0))
+        destName = room.participants.get(dest.portId, f'{dest.clientId}:{dest.portId}')
+
+        self.logger.warning(f'Loop guard: feedback storm in {room.hubName} - {sourceName} is sending {rate:.0f} events/s; '
+                            f'breaking link {sourceName} -> {destName} for {BLOCK_TIME}s')
+        self.blocked[(room.hubName, sourceName, destName)] = time.monotonic()+BLOCK_TIME
+        metrics.loopsBroken.inc()
+        self.overRate.pop(source, None)
+        return True
+
+#
+# A port that every sender is connected to (when we aren't running a bus)
+# so that we can count their events.
+#
+class MonitorPort(threading.Thread):
+    def __init__(self, guard, name='hubMonitor'):
+        threading.Thread.__init__(self, daemon=True)
+        self.logger = logging.getLogger()
+        self.guard = guard
+        self.client = alsa_midi.SequencerClient(name)
+        self.port = self.client.create_port('monitor', caps=alsa_midi.WRITE_PORT)
+        self.address = Address(self.client.client_id, self.port.port_id)
+
+    #
+    # The connections from each sender to us
+    #
+    def connections(self, desired):
+        return set((source, self.address) for source, dest in desired)
+
+    def run(self):
+        while True:
+            try:
+                event = self.client.event_input()
+            except Exception as e:
+                self.logger.error(f'Monitor failed to read event: {e}')
+                time.sleep(1)
+                continue
+
+            if event.source is None: continue
+            self.guard.count(Address(event.source.client_id, event.source.port_id))
+
+def startMonitor(guard):
+    logger = logging.getLogger()
+
+    if alsa_midi is None:
+        logger.warning('alsa_midi not installed - cannot watch event rates for feedback loops')
+        return None
+
+    try:
+        monitor = MonitorPort(guard)
+    except Exception as e:
+        logger.warning(f'Cannot create monitor sequencer client: {e}')
+        return None
+
+    monitor.start()
+    return monitor
@@ -0,0 +1,195 @@
+#
+# metrics.py
+#  A small Prometheus style metrics endpoint for midihub.py so that we can
+#  see (and alert on) what the hub is doing without reading its logs:
+#   curl http://127.0.0.1:9101/metrics
+#
+#  Counters, gauges and histograms are updated from the main loop (and a few
+#  other threads); the HTTP server runs in its own thread and only takes a
+#  lock long enough to copy the numbers, so serving a scrape never holds up
+#  the main loop.
+#
+#  The address and port come from the "metrics" section of midihub.json:
+#   {"metrics": {"address": "127.0.0.1", "port": 9101}}
+#  Set "port" to 0 to turn the endpoint off.
+#
+
+import time
+import logging
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_ADDRESS = '127.0.0.1'
+DEFAULT_PORT = 9101
+
+lock = threading.Lock()
+registry = []
+
+def labelText(labels):
+    if not labels: return ''
+    return '{'+','.join(f'{name}="{value}"' for name, value in zip(*labels))+'}'
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.values = {} if self.labelNames else {(): 0}
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelNames)
+
+    def samples(self):
+        return [(self.name, (self.labelNames, key), value) for key, value in self.values.items()]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with lock:
+            self.values[key] = self.values.get(key, 0)+amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    #
+    # function, if given, is called at scrape time for the (unlabelled) value
+    #
+    def __init__(self, name, help, labelNames=(), function=None):
+        Metric.__init__(self, name, help, labelNames)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with lock:
+            self.values[key] = value
+
+    #
+    # Replace all of the labelled values at once so that labels which have
+    # gone away (eg a port that has been removed) disappear too
+    #
+    def replace(self, values):
+        with lock:
+            self.values = {(str(label),): value for label, value in values.items()}
+
+    def samples(self):
+        if self.function: return [(self.name, None, self.function())]
+        return Metric.samples(self)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        Metric.__init__(self, name, help)
+        self.buckets = sorted(buckets)
+        self.counts = [0]*len(self.buckets)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        with lock:
+            for index, bound in enumerate(self.buckets):
+                if value <= bound: self.counts[index] += 1
+            self.total += value
+            self.count += 1
+
+    def samples(self):
+        samples = [(self.name+'_bucket', (('le',), (str(bound),)), count) for bound, count in zip(self.buckets, self.counts)]
+        samples.append((self.name+'_bucket', (('le',), ('+Inf',)), self.count))
+        samples.append((self.name+'_sum', None, self.total))
+        samples.append((self.name+'_count', None, self.count))
+        return samples
+
+#
+# The text exposition format
+#
+def render():
+    lines = []
+    with lock:
+        snapshot = [(metric, metric.samples()) for metric in registry if not isinstance(metric, Gauge) or not metric.function]
+    snapshot += [(metric, metric.samples()) for metric in registry if isinstance(metric, Gauge) and metric.function]
+
+    for metric, samples in snapshot:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, labels, value in samples:
+            lines.append(f'{name}{labelText(labels)} {value}')
+    return '\n'.join(lines)+'\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes every few seconds would drown out everything else
+
+class MetricsServer(threading.Thread):
+    def __init__(self, address, port):
+        threading.Thread.__init__(self, daemon=True)
+        self.server = ThreadingHTTPServer((address, port), MetricsHandler)
+        self.server.daemon_threads = True
+
+    def run(self):
+        self.server.serve_forever()
+
+#
+# Returns a running server or None if it's turned off or can't start
+#
+def startMetricsServer(config=None):
+    logger = logging.getLogger()
+    if config is None: config = {}
+
+    address = config.get('address', DEFAULT_ADDRESS)
+    port = int(config.get('port', DEFAULT_PORT))
+    if not port: return None
+
+    try:
+        server = MetricsServer(address, port)
+    except OSError as e:
+        logger.warning(f'Cannot start metrics endpoint on {address}:{port}: {e}')
+        return None
+
+    server.start()
+    logger.info(f'Metrics on http://{address}:{port}/metrics')
+    return server
+
+#
+# The metrics themselves - shared by everything in the hub process
+#
+participants = Gauge('midihub_participants', 'Remote participants on each port', ['port'])
+daemonUp = Gauge('midihub_daemon_up', 'Whether the MIDI daemon for each port is running', ['port'])
+reconcileSeconds = Histogram('midihub_reconcile_seconds', 'Time taken to read the graph and reconcile connections',
+                             [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5])
+connectionsAdded = Counter('midihub_connections_added_total', 'Connections made between participants')
+connectionsRemoved = Counter('midihub_connections_removed_total', 'Connections removed between participants')
+connectionsFailed = Counter('midihub_connections_failed_total', 'Connections that could not be made or removed')
+daemonRestarts = Counter('midihub_daemon_restarts_total', 'MIDI daemon restarts', ['port'])
+subprocessInvocations = Counter('midihub_subprocess_invocations_total', 'External commands run (aconnect and friends)')
+subprocessLastCycle = Gauge('midihub_subprocess_invocations_last_cycle', 'External commands run by the last participant check')
+loopsBroken = Counter('midihub_loop_links_broken_total', 'Links broken by the loop guard')
+collectorPublishes = Counter('midihub_collector_publishes_total', 'Participants and latency published by the collector', ['result'])
+
+lastGraphRead = None
+graphReadAge = Gauge('midihub_seconds_since_graph_read', 'Seconds since the ALSA graph (or aconnect) was last read successfully',
+                     function=lambda: round(time.monotonic()-lastGraphRead, 3) if lastGraphRead is not None else -1)
+
+def graphRead():
+    global lastGraphRead
+    lastGraphRead = time.monotonic()
+
+def subprocessCount():
+    return sum(subprocessInvocations.values.values())
@@ -15,10 +15,10 @@
 #
 #  To do this we can get Alsa to connect MIDI participants together as if
 #  they were local MIDI devices. This utility will join participants together
-#  if their names end in "In", "Out" or "Sen", "Rec". (See code in
-#  checkMidiParticipants().) The intention is to only send messages from MIDI
-#  "out" ports to MIDI "in ports". If the names don't match then no connection
-#  is made.
+#  if their names end in "In", "Out" or "Sen", "Rec". (See routing.py -
+#  other rules can be set in midihub.json.) The intention is to only send
+#  messages from MIDI "out" ports to MIDI "in ports". If the names don't match
+#  then no connection is made.
 #
 #  Essentially, this mimics a bunch of MIDI devices connected to each other
 #  via cables in the same room but this is over the internet.
@@ -28,6 +28,11 @@
 #  specifying '--connectall' at the command line. However this may result in
 #  undesirable feedback loops between connected instruments.
 #
+#  In large rooms the number of connections between participants grows very
+#  quickly. Specifying '--bus' at the command line connects each participant
+#  to a single "bus" port per MIDI client instead (see hubbus.py) which
+#  forwards their messages to everyone they would otherwise be connected to.
+#
 #  Prerequisite Ubuntu packages:
 #   cmake g++ pkt-config libavahi-client-dev libfmt-dev alsa-utils alsa-base
 #   libghc-alsa-core-dev avahi-utils linux-modules-extra-`uname -r`
@@ -38,21 +43,68 @@
 
 import sys
 import os
+import service
+
+#
+# We don't want more than one copy of this running at any one time - two
+# copies would fight over the daemons and their ports. Take the lock before
+# importing anything expensive so that finding out we're the second copy
+# costs next to nothing. The lock file lives next to this script rather than
+# in the running directory so that every copy finds it wherever it was
+# started from. (It is kept open for as long as we run; the kernel releases
+# it when we exit, however that happens.)
+#
+if __name__ == "__main__":
+    instanceLock = service.acquireLock(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'midihub.lock'))
+    if not instanceLock:
+        sys.stderr.write('INFO:root:This is the second copy - stopping\n')
+        sys.exit(0)
+
 import logging
 import signal
 import time
 import subprocess
-import re
-import boto3
-import requests
+import selectors
 import json
+import re
+
+from supervisor import Supervisor
+from announce import startAnnounceListener
+from hubbus import startHubBus
+from rtpmidictl import ControlHub, peers
+from location import findLocation
+from scheduling import SchedulingProfile
+from routing import Router
+from loopguard import LoopGuard, startMonitor
+import loopguard
+from metrics import startMetricsServer
+from collector import startCollector
+from profiling import PhaseTimers, installProfileSignal
+import metrics
+import alsagraph
+import reconcile
 
 #
 # Configuration:
 #  SLEEP_CHECK_INTERVAL:
-#      How often to check that the daemon(s) are running and when ned
-#      participants have joined. Default is five seconds which seems
-#      reasonable.
+#      How often to check when new participants have joined if we can't
+#      listen to ALSA announcements. Default is five seconds which seems
+#      reasonable. Daemons that exit are restarted as soon as we're told about
+#      it and don't wait for this.
+#  SAFETY_CHECK_INTERVAL:
+#      When we are told about participants joining and leaving as it happens
+#      we still check everything every so often just in case we missed
+#      something.
+#  STATUS_LOG_INTERVAL:
+#      How often to log the uptime and restart count of each daemon.
+#  HEALTH_CHECK_INTERVAL:
+#      How often to ask each daemon for its status over its control socket.
+#      A daemon that doesn't answer HEALTH_CHECK_FAILURES times in a row is
+#      restarted; one that has only just started (HEALTH_CHECK_GRACE) is
+#      given time to open its socket first.
+#  SHUTDOWN_TIMEOUT:
+#      How long to wait for the daemons to stop when we are asked to stop
+#      before killing them.
 #  MIDI_DAEMON:
 #      Path to the RTP MIDI daemon.
 #
@@ -63,85 +115,352 @@ import json
 #      directory called "midiports". Put a comma-seperate list of ports into
 #      the file and it will be read during startup or if SIGHUP is sent.
 #
+#  Options (--connectall, --bus) can be given on the command line or put in
+#  a file in the running directory called "midioptions" (separated by spaces
+#  or new lines). The file is also re-read on SIGHUP so the routing can be
+#  changed without restarting anything.
+#
+#  Settings that need more structure go in "midihub.json" in the running
+#  directory (also re-read on SIGHUP):
+#   "scheduling": CPU affinity and priorities - see scheduling.py
+#   "routing":    who is connected to whom - see routing.py
+#   "metrics":    where to serve metrics - see metrics.py (read at startup)
+#   "collector":  publishing participants and latency to DynamoDB - see
+#                 collector.py (read at startup)
+#
 SLEEP_CHECK_INTERVAL = 5
+SAFETY_CHECK_INTERVAL = 60
+STATUS_LOG_INTERVAL = 300
+HEALTH_CHECK_INTERVAL = 30
+HEALTH_CHECK_FAILURES = 3
+HEALTH_CHECK_GRACE = 10
+SHUTDOWN_TIMEOUT = 5
 MIDI_DAEMON = 'rtpmidid/build/src/rtpmidid'
 
 midiPorts = [5004, 5006]
+hubConfig = {}
 logger = None
 location = ''
 connectInAndOut = False
+busMode = False
+hubBus = None
+supervisor = None
+eventSelector = None
+wakeupPipe = None
+announcer = None
+controlHub = None
+healthFailures = {}
+healthAnswered = set()
+lastHealthProbe = 0
+allCpus = None
+schedulingProfile = None
+router = None
+loopGuard = LoopGuard()
+timers = PhaseTimers()
+monitor = None
+collector = None
+stopRequested = False
+reloadRequested = False
 
 #
 # Main loop which does a few startup checks and runs forever.
-# Checks to make sure all of the daemons are running which is important at
-# startup but also just in case they crash at some point.
-# After that, looks at the participants on each daemon and automatically
-# joins all of the MIDI sessions to each other - acting as a type of hub.
+# The daemons are started (and restarted if they crash) by the supervisor;
+# we hear about them exiting via SIGCHLD which wakes up the selector below
+# so there is no need to go looking for them.
+# When participants join or leave ALSA announces it and we look at the
+# participants on each daemon straight away, automatically joining all of the
+# MIDI sessions to each other - acting as a type of hub. We also do this every
+# SAFETY_CHECK_INTERVAL (or SLEEP_CHECK_INTERVAL if there are no
+# announcements) in case anything was missed.
+# When run by systemd (see midihub.service) we tell it once we are up and
+# keep pinging its watchdog from the main loop. SIGTERM or SIGINT stop the
+# daemons and exit cleanly.
+# Each part of the loop is timed (see profiling.py); the timings are logged
+# with the daemon status and SIGUSR1 starts and stops a full profile.
 #
 def main():
-    global logger
+    global logger, supervisor, eventSelector, wakeupPipe, announcer, hubBus, controlHub, monitor, collector
 
     signal.signal(signal.SIGINT, interrupted)
-    signal.signal(signal.SIGHUP, configure)
+    signal.signal(signal.SIGTERM, interrupted)
+    signal.signal(signal.SIGHUP, hangup)
+    installProfileSignal('midihub', timers)
 
-    configure('', '')
-
-    if alreadyRunning():
-        logger.info('This is the second copy - stopping')
-        sys.exit(0)
+    configure()
 
     if not checkPrerequisites():
         sys.exit(1)
 
-    logger.info('Entering main loop')
-    while True:
-        checkDaemon()
-        checkMidiParticipants()
+    #
+    # Signals write a byte to this pipe so that the selector wakes up as soon
+    # as a daemon exits rather than at the end of the current sleep.
+    #
+    wakeupPipe = os.pipe()
+    os.set_blocking(wakeupPipe[0], False)
+    os.set_blocking(wakeupPipe[1], False)
+    signal.set_wakeup_fd(wakeupPipe[1])
+    signal.signal(signal.SIGCHLD, childExited)
+
+    eventSelector = selectors.DefaultSelector()
+    eventSelector.register(wakeupPipe[0], selectors.EVENT_READ, signalWakeup)
+
+    supervisor = Supervisor(MIDI_DAEMON, daemonCommand, eventSelector, onRestart=daemonRestarted, prepareChild=prepareDaemon)
+    supervisor.adoptRunning(midiPorts)
+    applyScheduling()
+
+    controlHub = ControlHub()
+    controlHub.start()
+
+    startMetricsServer(hubConfig.get('metrics'))
+    collector = startCollector(hubConfig.get('collector'))
+
+    if busMode:
+        hubBus = startHubBus()
+        if hubBus: hubBus.onEvent = loopGuard.count
+    monitor = startMonitor(loopGuard)
+    checkInterval = SLEEP_CHECK_INTERVAL
+    announcer = startAnnounceListener()
+    if announcer:
+        eventSelector.register(announcer, selectors.EVENT_READ, participantsChanged)
+        checkInterval = SAFETY_CHECK_INTERVAL
+
+    watchdogInterval = service.watchdogInterval()
+    nextWatchdog = float('inf')
+    if watchdogInterval:
+        logger.info(f'Pinging systemd watchdog every {watchdogInterval:.1f}s')
+        nextWatchdog = 0
 
-        time.sleep(SLEEP_CHECK_INTERVAL)
+    logger.info('Entering main loop')
+    nextCheck = 0
+    nextStatus = time.monotonic()+STATUS_LOG_INTERVAL
+    nextHealthCheck = time.monotonic()+HEALTH_CHECK_GRACE
+    nextLoopCheck = time.monotonic()+loopguard.CHECK_INTERVAL
+    ready = False
+    while not stopRequested:
+        if reloadRequested:
+            reload()
+            nextCheck = 0
+
+        started = time.perf_counter()
+        for port in midiPorts:
+            supervisor.add(port)
+        supervisor.reap()
+        supervisor.startPending()
+        timers.record('supervise', time.perf_counter()-started)
+
+        now = time.monotonic()
+        if now >= nextCheck:
+            with timers.phase('participants'):
+                checkMidiParticipants()
+            nextCheck = time.monotonic()+checkInterval
+
+        if not ready:
+            service.notify(f'READY=1\nSTATUS=Running {len(midiPorts)} MIDI daemons')
+            ready = True
+
+        if now >= nextStatus:
+            logDaemonStatus()
+            nextStatus = now+STATUS_LOG_INTERVAL
+
+        if now >= nextHealthCheck:
+            with timers.phase('health'):
+                checkDaemonHealth()
+            nextHealthCheck = now+HEALTH_CHECK_INTERVAL
+
+        if now >= nextLoopCheck:
+            with timers.phase('loopGuard'):
+                if loopGuard.check(): nextCheck = 0 # Remove the link we just broke
+            nextLoopCheck = now+loopguard.CHECK_INTERVAL
+
+        if now >= nextWatchdog:
+            service.notify('WATCHDOG=1')
+            nextWatchdog = now+watchdogInterval
+
+        deadline = min(nextCheck, nextHealthCheck, nextWatchdog, nextLoopCheck)
+        pendingStart = supervisor.nextDeadline()
+        if pendingStart is not None: deadline = min(deadline, pendingStart)
+
+        for key, mask in eventSelector.select(max(deadline-time.monotonic(), 0)):
+            started = time.perf_counter()
+            key.data()
+            timers.record('events', time.perf_counter()-started)
+
+    shutdown()
 
 #
-# See if we have daemons running on the ports specified in the global
-# midiPorts list. If we don't find a process running with the name of
-# the daemon and the port number then we fork() and create one.
+# Stop all of the daemons and give them a little while to go before
+# killing them so that they can say goodbye to their participants.
 #
-def checkDaemon():
-    global logger, midiPorts
+def shutdown():
+    global logger, supervisor, collector
 
-    midiStatus = {}
+    logger.info('Stopping')
+    service.notify('STOPPING=1')
+
+    supervisor.stopAll(SHUTDOWN_TIMEOUT)
+    if collector: collector.stop(SHUTDOWN_TIMEOUT)
+    logger.info('Stopped')
+
+#
+# Arguments for a MIDI daemon listening on a specific port. The supervisor
+# forks and runs this whenever the daemon for that port isn't running.
+#
+def daemonCommand(port):
     daemonName = os.path.basename(MIDI_DAEMON)
 
-    stream = os.popen('/usr/bin/ps -ef')
-    psLine = stream.readline()
-    while psLine:
-        if psLine.find(daemonName) > -1:
-            for port in midiPorts:
-                if psLine.find(str(port)) > -1:
-                    midiStatus[port] = True
-                    break
-        psLine = stream.readline()
+    return [daemonName, '--port', str(port), '--control', f'control-{port}.sock', '--name', f'midiHub-{location}{port}']
 
-    for port in midiPorts:
-        if port in midiStatus: continue
-        logger.warning(f'Midi daemon on port {port} not running - starting')
-        if os.fork() == 0: # We are the child process
-            newStdOut = os.open(f'output-{port}.log', os.O_WRONLY|os.O_CREAT|os.O_APPEND)
-            os.dup2(newStdOut, sys.stdout.fileno())
-            os.close(newStdOut)
-            os.close(2) # Close STDERR
-            os.execlp(MIDI_DAEMON, daemonName, f'--port', str(port), '--control', f'control-{port}.sock', '--name', f'midiHub-{location}{port}')
+def daemonRestarted(port):
+    metrics.daemonRestarts.inc(port=port)
+
+#
+# Runs in the forked child just before it becomes the daemon. There's no
+# logger here - anything we have to say goes to the daemon's log file.
+#
+def prepareDaemon(port):
+    global schedulingProfile
+
+    if not schedulingProfile: return
+    try:
+        schedulingProfile.applyToDaemon(port)
+    except OSError as e:
+        os.write(1, f'midihub: cannot set scheduling for port {port}: {e}\n'.encode())
+
+#
+# Build the scheduling profile from the configuration, work out where each
+# daemon runs, say so, and apply it to ourselves and to any daemons that are
+# already running. On the first call we remember which CPUs we could use
+# before we pin ourselves to the housekeeping ones.
+#
+def applyScheduling():
+    global logger, hubConfig, midiPorts, allCpus, schedulingProfile, supervisor
+
+    if allCpus is None: allCpus = os.sched_getaffinity(0)
+
+    try:
+        profile = SchedulingProfile(hubConfig.get('scheduling'), allCpus)
+        profile.plan(midiPorts)
+    except (ValueError, TypeError) as e:
+        logger.warning(f'Bad scheduling configuration - ignoring: {e}')
+        return
+
+    profile.report()
+    schedulingProfile = profile
+
+    try:
+        profile.applyHousekeeping()
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning(f'Cannot set housekeeping scheduling: {e}')
+
+    if not supervisor: return
+    for port, status in supervisor.status().items():
+        if status['state'] != 'running': continue
+        try:
+            profile.applyToDaemon(port, status['pid'])
+        except OSError as e:
+            logger.warning(f'Cannot set scheduling for midi daemon on port {port}: {e}')
+
+#
+# Something has written to the wakeup pipe - most likely SIGCHLD because a
+# daemon has exited. Empty the pipe and let the supervisor work out which
+# of its daemons need restarting.
+#
+def signalWakeup():
+    global supervisor, wakeupPipe
+
+    try:
+        while os.read(wakeupPipe[0], 512): pass
+    except BlockingIOError:
+        pass
+
+    supervisor.reap()
+
+#
+# ALSA has told us that a client or port has come or gone. Rewire everything
+# straight away and log how long it took from the announcement to the new
+# participant being connected.
+#
+def participantsChanged():
+    global logger, announcer
+
+    events = announcer.drain()
+    if not events: return
+
+    for event in events:
+        logger.debug(f'Announce: {event.kind} {event.address.clientId}:{event.address.portId}')
+
+    graph = checkMidiParticipants()
+    if not graph: return
+
+    now = time.monotonic()
+    for event in events:
+        if event.kind != 'port start': continue
+        client = graph.clients.get(event.address.clientId)
+        if not client or not client.hubName: continue
+        name = client.participants.get(event.address.portId)
+        if not name: continue
+        logger.info(f'Participant {name} joined {client.hubName} - connected in {(now-event.received)*1000:.1f} ms')
+
+def childExited(signal, frame):
+    pass # Handled in signalWakeup() once the selector wakes up
 
 #
-# Using the aconnect command we can see all of the MIDI "ports" or "clients"
+# Look at the answers to the last round of status requests and send out the
+# next round. The requests happen in the background so a daemon that has
+# hung can't hold up the main loop. A daemon that keeps not answering is
+# restarted - but only if it has answered before, so that a version of the
+# daemon that doesn't understand us isn't restarted over and over.
+#
+def checkDaemonHealth():
+    global logger, supervisor, controlHub, healthFailures, healthAnswered, lastHealthProbe
+
+    metrics.daemonUp.replace({port: int(status['state'] == 'running') for port, status in supervisor.status().items()})
+
+    for port, status in supervisor.status().items():
+        if not lastHealthProbe: break
+        if status['state'] != 'running' or status['uptime'] < HEALTH_CHECK_GRACE:
+            healthFailures.pop(port, None)
+            continue
+
+        result = controlHub.results.get(port)
+        if result and result[0] >= lastHealthProbe and result[1] is not None:
+            healthFailures.pop(port, None)
+            healthAnswered.add(port)
+            continue
+        if port not in healthAnswered: continue
+
+        healthFailures[port] = healthFailures.get(port, 0)+1
+        logger.warning(f'Midi daemon on port {port} did not answer on its control socket ({healthFailures[port]} times)')
+        if healthFailures[port] >= HEALTH_CHECK_FAILURES:
+            healthFailures.pop(port)
+            controlHub.forget(port)
+            supervisor.restart(port)
+
+    lastHealthProbe = time.monotonic()
+    controlHub.probe(list(supervisor.status().keys()))
+
+def logDaemonStatus():
+    global logger, supervisor, controlHub, timers
+
+    for port, status in supervisor.status().items():
+        result = controlHub.results.get(port)
+        peerCount = len(peers(result[1])) if result and result[1] else 'unknown'
+        logger.info(f'Midi daemon on port {port}: {status["state"]} pid {status["pid"]} uptime {status["uptime"]}s restarts {status["restarts"]} peers {peerCount}')
+
+    timers.log(logger)
+
+#
+# We read the ALSA sequencer graph to see all of the MIDI "ports" or "clients"
 # that are open on this server; and all of the participants in those ports.
-# We're not interested in the low numbered prots (below 128) - when the MIDI
-# daemon starts it is allocated a port number from 128 upwards.
+# We're not interested in the low numbered clients (below 128) or in clients
+# that aren't one of our MIDI daemons - alsagraph takes care of that.
 #
-# Using the output we find all of the participants in the high numbered ports
-# and then join them all together. They could already be joined together but
-# aconnect doesn't care if we try to join two participants together that are
-# already joined to each other. We want to create a mesh between the
-# participants on each port/client; but not between ports/clients.
+# We find all of the participants in each daemon's client and work out which
+# of them should be joined together (see routing.py).
+# That is compared with the connections that already exist and only the
+# differences are made - so if nothing has changed we do nothing. We want to
+# create a mesh between the participants on each port/client; but not between
+# ports/clients.
 #
 # Each port/client from the MIDI daemon will already have a "Network"
 # participants with a participant number of zero. The daemon will also
@@ -152,85 +471,57 @@ def checkDaemon():
 # suitable for our purposes here.
 #
 def checkMidiParticipants():
-    global logger,connectInAndOut
+    global logger, router, loopGuard, monitor, timers, busMode, hubBus, collector
 
-    logger.debug('Getting output from aconnect')
+    logger.debug('Reading ALSA sequencer graph')
+    started = time.monotonic()
+    subprocesses = metrics.subprocessCount()
 
     try:
-        output = os.popen('aconnect -l').read().split('\n')
+        with timers.phase('readGraph'):
+            graph = alsagraph.readGraph()
     except Exception as e:
-        logger.error(f'Failed to get aconnect output: {e}')
-        return
-
-    for index in range(0,len(output)):
-        logger.debug(f' Line: {output[index]}')
-        if output[index].find('client ') == 0:
-            try:
-                clientNumber = re.findall(r'\d+', output[index])[0]
-            except:
-                logger.warning(f'  Did not see client id in {output[index]} - skipping')
-                continue
-            if int(clientNumber) < 128: continue
-
-            participants = {}
-            for search in range(index+1,len(output)):
-                logger.debug(f'  Search: {output[index]}')
-                if output[search].find('client') == 0: break
-                if output[search].find('Network') > -1: continue
-                if output[search].find('midiHub') > -1: continue
-                if output[search].find('Connect') > -1: continue
-                if not len(output[search]): continue
-
-                logger.debug(f'  Client details: {output[search]}')
-                try:
-                    participantNumber = re.findall(r'\d+', output[search])[0]
-                    participantName   = re.findall(r"'.+'", output[search])[0][1:-1].strip()
-                    participants[participantNumber] = participantName
-                except:
-                    logger.warning(f'Did not see participant info in {output[search]} - skipping')
-                    break
-
-            if len(participants) > 1:
-                logger.debug(f'  client {clientNumber}: {participants} connectAll={connectInAndOut}')
-                
-                if connectInAndOut:
-                    for sourceConnection in participants.keys():
-                        for destConnection in participants.keys():
-                            if sourceConnection == destConnection: continue
-                            logger.debug(f'  Adding connection in {clientNumber} for {sourceConnection} and {destConnection}')
-                            os.system(f'aconnect {clientNumber}:{sourceConnection} {clientNumber}:{destConnection} >/dev/null 2>&1')
-                else:
-                    midiIn = []
-                    midiOut = []
-                    for id in participants.keys():
-                        if participants[id][-2:].lower() == 'in' or participants[id][-3:].lower() == 'rec': midiIn.append(id)
-                        if participants[id][-3:].lower() == 'out' or participants[id][-3:].lower() == 'sen': midiOut.append(id)
-
-                    logger.debug(f'  midiIn {midiIn} midiOut {midiOut}')
-                    for inId in midiIn:
-                        for outId in midiOut:
-                            logger.debug(f'  Adding connection in {clientNumber} for {outId} to {inId}')
-                            os.system(f'aconnect {clientNumber}:{outId} {clientNumber}:{inId} >/dev/null 2>&1')
-
-#
-# Although it's not completely harmful we don't really want more than one
-# copy of this running at any one time. The worst that can happen is that
-# two copies of this script will try and run multiple copies of the daemon
-# on the same ports - but the UDP port can only be bound to a single process
-# so any subsequent daemon invocations will self-terminate. This script will
-# also try and connect MIDI participants to each other but additional
-# connection requests will be ignored if the connection already exists.
-#
-def alreadyRunning():
-    global logger
-
-    myName = os.path.basename(sys.argv[0])
+        logger.error(f'Failed to read ALSA sequencer graph: {e}')
+        return None
+    metrics.graphRead()
+
+    if collector:
+        collector.updateParticipants({client.hubName.rsplit('-', 1)[-1]: list(client.participants.values())
+                                      for client in graph.hubClients() if client.participants})
+
+    desired = set()
+    for client in graph.hubClients():
+        logger.debug(f'  client {client.clientId}: {client.participants}')
+        desired |= loopGuard.filter(client, router.desiredConnections(client))
+    loopGuard.forgetClients(set(client.clientId for client in graph.hubClients()))
+
+    #
+    # Connections to the bus and monitor ports are ours too - reconcile
+    # treats them like connections between participants.
+    #
+    busAddresses = set()
+    if busMode and hubBus:
+        desired = hubBus.update(graph.hubClients(), desired)
+        busAddresses = hubBus.addresses()
+    elif monitor:
+        desired |= monitor.connections(desired)
+    if monitor: busAddresses.add(monitor.address)
+
+    with timers.phase('reconcile'):
+        result = reconcile.reconcile(graph, desired, busAddresses=busAddresses)
+    if result.changed():
+        logger.info(f'Connections {result}')
+    else:
+        logger.debug(f'Connections {result}')
 
-    logger.debug('Checking to see if we are already running')
-    output = os.popen('/usr/bin/ps -e').read()
-    if output.count(myName) > 1: return True
+    metrics.participants.replace({client.hubName.rsplit('-', 1)[-1]: len(client.participants) for client in graph.hubClients()})
+    metrics.connectionsAdded.inc(result.added)
+    metrics.connectionsRemoved.inc(result.removed)
+    metrics.connectionsFailed.inc(result.failed)
+    metrics.subprocessLastCycle.set(metrics.subprocessCount()-subprocesses)
+    metrics.reconcileSeconds.observe(time.monotonic()-started)
 
-    return False
+    return graph
 
 #
 # There's no point trying to run the MIDI daemon if there aren't a few
@@ -260,32 +551,63 @@ def checkPrerequisites():
     return True
 
 #
-# A few things to do here.
-# First we look for our configuration file which (if it exists) contains a
-# comma-separated list of UDP ports that we are to listen to. If it's empty
-# or malformed then we go with the defaults set at the start of this file.
+# A few things to do at startup.
+# First we read our settings - see readSettings().
 # Next we try and set a "nice" display name for the ports that we're going to
-# create. This is just window dressing but if there are a few of these running
-# around the world it's nice to know which one you're connected to. We look
-# for the AWS instance metadata - if it doesn't exist, no "nice" name. No big
-# deal. If it exists then we get a list of regions from Lightsail - because it
-# has a nice mapping of AWS region name to "human readable" name. But Lightsail
-# isn't in every AWS region so this might fail - if it does, again, not "nice"
-# name.
-# This is also called if we're sent SIGHUP mainly so that we can re-read the
-# ports configuration file.
-#
-def configure(singal, frame):
-    global logger, location, midiPorts, connectInAndOut
+# create (see location.py). If we can't work out where we are there's no
+# "nice" name - no big deal. This is cached and every network call it makes
+# has a short timeout so it can't hold up startup.
+#
+def configure():
+    global logger, location
 
     logging.basicConfig()
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
 
-    for arg in sys.argv[1:]:
-        if arg == '--connectall':
-          connectInAndOut = True
-          logger.info('Cross-connecting all in and out ports')
+    readSettings()
+    applyRouting()
+    logger.info(f'MIDI ports: {midiPorts}')
+
+    displayName = findLocation()
+    if displayName:
+        location = displayName+'-'
+        logger.info(f'Location set to {displayName}')
+
+#
+# Look for our configuration files. "midiports" (if it exists) contains a
+# comma-separated list of UDP ports that we are to listen to. If it's empty
+# or malformed then we keep the ports we already have (at startup, the
+# defaults set at the start of this file). "midioptions" holds extra
+# command line options and "midihub.json" everything else.
+# This is quick - it only reads a few small files - so that it can also be done
+# on SIGHUP without holding up the main loop.
+#
+def readSettings():
+    global logger, midiPorts, hubConfig, connectInAndOut, busMode
+
+    options = sys.argv[1:]
+    try:
+        with open('midioptions') as optionsFile:
+            options = options+optionsFile.read().split()
+    except FileNotFoundError: # No options file - that's fine too
+        pass
+    except Exception as e:
+        logger.warning(f'Got error {e} reading options file')
+
+    for arg in options:
+        if arg not in ('--connectall', '--bus'):
+            logger.warning(f'Unknown option {arg} - ignoring')
+
+    if ('--connectall' in options) != connectInAndOut:
+        connectInAndOut = not connectInAndOut
+        if connectInAndOut: logger.info('Cross-connecting all in and out ports')
+        else: logger.info('Connecting out ports to in ports only')
+
+    if ('--bus' in options) != busMode:
+        busMode = not busMode
+        if busMode: logger.info('Connecting participants through a bus')
+        else: logger.info('Connecting participants directly')
 
     try:
         with open('midiports') as portsFile:
@@ -301,40 +623,84 @@ def configure(singal, frame):
     except Exception as e:
         logger.warning(f'Got error {e} - ports file badly formatted?')
 
-    logger.info(f'MIDI ports: {midiPorts}')
-
     try:
-        response = requests.get('http://169.254.169.254/latest/dynamic/instance-identity/document')
-        instanceInfo = json.loads(response.content)
-    except:
-        logger.info('Did not get instance metadata - will not set location')
-        return
+        with open('midihub.json') as configFile:
+            newConfig = json.load(configFile)
+        if not isinstance(newConfig, dict): raise ValueError('not a JSON object')
+        hubConfig = newConfig
+    except FileNotFoundError:
+        hubConfig = {}
+    except Exception as e:
+        logger.warning(f'Got error {e} - midihub.json badly formatted? Keeping previous settings')
 
-    regionName = instanceInfo.get('region')
-    if not regionName:
-        logger.warning('No region name in instance metadata - will not set location')
-        return
+#
+# Called from the main loop after SIGHUP. Daemons are only started for ports
+# that have been added and stopped for ports that have been removed; rooms
+# on the other ports aren't touched. Routing changes are picked up by the
+# participant check straight after this.
+#
+def reload():
+    global logger, midiPorts, busMode, hubBus, supervisor, controlHub, healthFailures, healthAnswered, reloadRequested
+
+    reloadRequested = False
+    started = time.monotonic()
+
+    oldPorts = set(midiPorts)
+    readSettings()
+
+    for port in midiPorts:
+        if port not in oldPorts: logger.info(f'Adding port {port}') # Started by the main loop
+
+    for port in oldPorts-set(midiPorts):
+        logger.info(f'Removing port {port}')
+        supervisor.remove(port)
+        controlHub.forget(port)
+        healthFailures.pop(port, None)
+        healthAnswered.discard(port)
+
+    #
+    # Turning the bus off closes all of its ports, which also removes every
+    # connection to and from them; the participants are then connected
+    # directly by the next check.
+    #
+    if busMode and not hubBus:
+        hubBus = startHubBus()
+        if hubBus: hubBus.onEvent = loopGuard.count
+    elif not busMode and hubBus:
+        hubBus.update([], set())
+
+    applyScheduling()
+    applyRouting()
+
+    logger.info(f'Reloaded configuration in {(time.monotonic()-started)*1000:.1f} ms - MIDI ports: {midiPorts}')
+
+#
+# The rules are compiled here (once per load) so a mistake in them is
+# reported straight away - and we keep the rules we had.
+#
+def applyRouting():
+    global logger, hubConfig, connectInAndOut, router
 
-    lightsail = boto3.client('lightsail')
     try:
-        regionInfo = lightsail.get_regions().get('regions')
-    except Exception as e:
-        logger.info(f'Cannot get Lightsail region info - will not set location: {e}')
-        return
+        router = Router(hubConfig.get('routing'), connectInAndOut)
+    except (ValueError, TypeError, re.error) as e:
+        logger.warning(f'Bad routing configuration - ignoring: {e}')
+        if not router: router = Router(None, connectInAndOut)
 
-    for region in regionInfo:
-        if region['name'] == regionName:
-            location = region['displayName']+'-'
-            logger.info(f'Location set to {region["displayName"]}')
-            break
-    else:
-        logger.info(f'Did not find printable name for {regionName}')
+def hangup(signal, frame):
+    global reloadRequested
+
+    reloadRequested = True # Handled in the main loop
 
+#
+# SIGINT or SIGTERM (which is how systemd stops us). We only note it here -
+# the signal also wakes up the main loop which then shuts down properly.
+#
 def interrupted(signal, frame):
-    global logger
+    global logger, stopRequested
 
     logger.info('Interrupt - stopping')
-    sys.exit(0)
+    stopRequested = True
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,151 @@
+#
+# profiling.py
+#  Finding out where the time goes in a running hub without restarting it.
+#
+#  PhaseTimers keeps the last few hundred durations of each "phase" of a
+#  loop (reading the ALSA graph, forwarding a packet and so on) in a ring
+#  buffer and can report percentiles for them. Recording a sample is a
+#  perf_counter() call and a list assignment so it can stay switched on all
+#  of the time, even in packet loops:
+#
+#   started = time.perf_counter()
+#   ...
+#   timers.record('forward', time.perf_counter()-started)
+#
+#  or, where the overhead of a context manager doesn't matter:
+#
+#   with timers.phase('reconcile'):
+#       ...
+#
+#  installProfileSignal() makes SIGUSR1 a switch: the first one starts
+#  cProfile and tracemalloc, the second stops them and writes out
+#  profile-<name>-<pid>-<time>.pstats (look at it with "python3 -m pstats")
+#  and a .txt file with the phase percentiles and the top memory users.
+#
+
+import os
+import time
+import signal
+import logging
+
+DEFAULT_SAMPLES = 512
+TOP_ALLOCATIONS = 30
+
+class PhaseTimer:
+    def __init__(self, size):
+        self.samples = [0.0]*size
+        self.size = size
+        self.index = 0
+        self.count = 0
+
+    def record(self, seconds):
+        self.samples[self.index] = seconds
+        self.index = (self.index+1)%self.size
+        self.count += 1
+
+    #
+    # Percentiles (in seconds) of the samples we still have
+    #
+    def percentiles(self, wanted=(50, 90, 99)):
+        samples = sorted(self.samples[:min(self.count, self.size)])
+        if not samples: return {}
+        result = {p: samples[min(len(samples)-1, len(samples)*p//100)] for p in wanted}
+        result['max'] = samples[-1]
+        return result
+
+class Phase:
+    def __init__(self, timers, name):
+        self.timers = timers
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.timers.record(self.name, time.perf_counter()-self.started)
+
+class PhaseTimers:
+    def __init__(self, size=DEFAULT_SAMPLES):
+        self.size = size
+        self.timers = {}
+
+    def record(self, name, seconds):
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = PhaseTimer(self.size)
+            self.timers[name] = timer
+        timer.record(seconds)
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    #
+    # One line per phase: count and percentiles in milliseconds
+    #
+    def summary(self):
+        lines = []
+        for name in sorted(self.timers):
+            timer = self.timers[name]
+            values = ' '.join(f'{"p"+str(p) if p != "max" else p} {seconds*1000:.3f}' for p, seconds in timer.percentiles().items())
+            lines.append(f'{name}: count {timer.count} {values} ms')
+        return lines
+
+    def log(self, logger=None):
+        if logger is None: logger = logging.getLogger()
+        for line in self.summary():
+            logger.info(f'Timing {line}')
+
+#
+# The SIGUSR1 switch described at the top of this file. cProfile and
+# tracemalloc are only imported the first time it is used.
+#
+class ProfileCapture:
+    def __init__(self, name, timers=None, directory='.'):
+        self.logger = logging.getLogger()
+        self.name = name
+        self.timers = timers
+        self.directory = directory
+        self.profile = None
+
+    def toggle(self, signum=None, frame=None):
+        if self.profile is None: self.start()
+        else: self.stop()
+
+    def start(self):
+        import cProfile
+        import tracemalloc
+
+        self.profile = cProfile.Profile()
+        tracemalloc.start()
+        self.profile.enable()
+        self.started = time.time()
+        self.logger.info('Profiling started - send SIGUSR1 again to stop and write the results')
+
+    def stop(self):
+        import tracemalloc
+
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        baseName = os.path.join(self.directory, f'profile-{self.name}-{os.getpid()}-{int(self.started)}')
+        try:
+            self.profile.dump_stats(baseName+'.pstats')
+            with open(baseName+'.txt', 'w') as reportFile:
+                reportFile.write(f'Profiled for {time.time()-self.started:.1f}s\n\n')
+                if self.timers:
+                    reportFile.write('Phase timings:\n')
+                    for line in self.timers.summary(): reportFile.write(f'  {line}\n')
+                    reportFile.write('\n')
+                reportFile.write('Top memory allocations:\n')
+                for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                    reportFile.write(f'  {stat}\n')
+            self.logger.info(f'Profile written to {baseName}.pstats and {baseName}.txt')
+        except OSError as e:
+            self.logger.error(f'Cannot write profile {baseName}: {e}')
+        self.profile = None
+
+def installProfileSignal(name, timers=None, directory='.'):
+    capture = ProfileCapture(name, timers, directory)
+    signal.signal(signal.SIGUSR1, capture.toggle)
+    return capture
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+#
+# benchmark-encoder.py
+#  Compares rtpencoder.py with packets.MIDIPacket.create() for the packets
+#  we send:
+#   benchmark-encoder.py [packets]
+#  Default is 20000 packets of each size (1, 3 and 10 commands).
+#
+#  Every packet rtpencoder.py makes is also read back with pymidi's parser
+#  and has to come out as the commands that went in (including running
+#  status and delta times) or we stop with an error. The proper checks are
+#  in test_rtpencoder.py.
+#
+
+import sys
+import time
+import random
+
+from pymidi import packets
+
+from rtpencoder import PacketEncoder, midiCommand, NOTE_ON, NOTE_OFF, AFTERTOUCH, CONTROL_CHANGE
+
+SSRC = 0x12345678
+SIZES = [1, 3, 10]
+
+def makeCommands(rng, count):
+    commands = []
+    channel = rng.randrange(16)
+    for index in range(count):
+        kind = rng.choice([NOTE_ON, NOTE_ON, NOTE_OFF, AFTERTOUCH, CONTROL_CHANGE])
+        commands.append((rng.randrange(100) if index else 0, kind | channel, (rng.randrange(128), rng.randrange(128))))
+    return commands
+
+#
+# The same commands as the dicts MIDIPacket.create() wants
+#
+PYMIDI_NAMES = {NOTE_ON:('note_on', 'key', 'velocity'), NOTE_OFF:('note_off', 'key', 'velocity'),
+                AFTERTOUCH:('aftertouch', 'key', 'touch'), CONTROL_CHANGE:('control_mode_change', 'controller', 'value')}
+
+def pymidiCommands(commands):
+    midiList = []
+    for deltaTime, status, data in commands:
+        name, first, second = PYMIDI_NAMES[status & 0xf0]
+        midiList.append({'delta_time':deltaTime, '__next':0x80, 'command':name, 'command_byte':status,
+                         'channel':status & 0x0f, 'params':{first:data[0], second:data[1]}})
+    return midiList
+
+#
+# Our pymidi has MIDIPacket.create(); upstream only has construct's build()
+#
+def createPacket(commands, sequenceNumber, timestamp):
+    midiList = pymidiCommands(commands)
+    length = 3+4*(len(midiList)-1)
+    create = getattr(packets.MIDIPacket, 'create', None) or (lambda **fields: packets.MIDIPacket.build(fields))
+    return create(
+        header={'rtp_header':{'flags':{'v':2, 'p':0, 'x':0, 'cc':0, 'm':1, 'pt':0x61}, 'sequence_number':sequenceNumber},
+                'timestamp':timestamp, 'ssrc':SSRC},
+        command={'flags':{'b':1 if length > 15 else 0, 'j':0, 'z':0, 'p':0, 'len':length}, 'midi_list':midiList},
+        journal='')
+
+def checkRoundTrip(packet, commands, sequenceNumber, timestamp):
+    parsed = packets.MIDIPacket.parse(bytes(packet))
+    if parsed.header.rtp_header.sequence_number != sequenceNumber or parsed.header.timestamp != timestamp or parsed.header.ssrc != SSRC:
+        return f'header {parsed.header}'
+
+    found = [midiCommand(command) for command in parsed.command.midi_list]
+    if len(found) != len(commands): return f'{len(found)} commands instead of {len(commands)}'
+    for index, (want, got) in enumerate(zip(commands, found)):
+        if (want[0] if index else 0, want[1], list(want[2])) != (got[0] if index else 0, got[1], list(got[2])):
+            return f'command {index} is {got} instead of {want}'
+    return None
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rng = random.Random(42)
+    timestamp = 123456
+
+    for size in SIZES:
+        commandLists = [makeCommands(rng, size) for index in range(count)]
+
+        encoder = PacketEncoder(SSRC)
+        for index, commands in enumerate(commandLists[:1000]):
+            packet = encoder.encode(commands, timestamp)
+            problem = checkRoundTrip(packet, commands, index, timestamp)
+            if problem:
+                print(f'Round trip failed for {commands}: {problem}')
+                sys.exit(1)
+
+        started = time.perf_counter()
+        for sequenceNumber, commands in enumerate(commandLists):
+            createPacket(commands, sequenceNumber, timestamp)
+        createTime = time.perf_counter()-started
+
+        started = time.perf_counter()
+        for commands in commandLists:
+            encoder.encode(commands, timestamp)
+        encodeTime = time.perf_counter()-started
+
+        print(f'{size:3d} commands: MIDIPacket.create {createTime/count*1e6:8.1f}us  rtpencoder {encodeTime/count*1e6:6.2f}us  ({createTime/encodeTime:.0f}x)')
+
+    print('Round trip OK')
+
+if __name__ == '__main__':
+    main()
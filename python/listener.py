@@ -16,13 +16,18 @@ import threading
 import pymidi.server
 from pymidi.protocol import DataProtocol
 from pymidi.protocol import ControlProtocol
-from pymidi import packets
-from pymidi.utils import get_timestamp
+
+from rtpencoder import PacketEncoder, CommandBatcher, NOTE_ON, NOTE_OFF, AFTERTOUCH, CONTROL_CHANGE, PITCH_BEND
 
 logger = None
 outputSocket = None
 remoteAddr = None
-sequenceNumber = 0
+batcher = None
+
+#
+# How long (seconds) to wait for more ALSA events to put in the same packet
+#
+BATCH_WINDOW = 0.002
 
 class midiHandler(pymidi.server.Handler):
     def __init__(self, alsa):
@@ -69,86 +74,73 @@ class myThread(threading.Thread):
     def run(self):
         getAlsaInput(self.alsaClient)
 
-def sendRtpCommand(event):
-    global logger, sequenceNumber
+#
+# Events that arrive within the batch window of each other go in one packet
+# (see CommandBatcher in rtpencoder.py)
+#
+def queueRtpCommand(status, data):
+    global logger
 
     if not remoteAddr:
         logger.info('No-one is connected - not sending')
         return 
 
-    header = {'rtp_header': {'flags': { 'v': 0x2,
-                                        'p': 0,
-                                        'x': 0,
-                                        'cc': 0,
-                                        'm': 0x1,
-                                        'pt': 0x61,},
-                             'sequence_number': sequenceNumber},
-             'timestamp': get_timestamp(),
-             'ssrc': outputSocket.ssrc}
-
-    command = {'flags': {'b': 0,
-                         'j': 0,
-                         'z': 0,
-                         'p': 0,
-                         'len': 3},
-               'midi_list': [event]}
-
     try:
-        packet = packets.MIDIPacket.create(header=header, command=command, journal='')
+        batcher.add(status, data)
     except Exception as e:
         logger.error(f'Failed to create packet: {e}')
-        return
+
+def sendRtpPacket(packet):
+    global logger
 
     try:
         outputSocket.sendto(packet, (remoteAddr[0], remoteAddr[1]+1))
-        sequenceNumber += 1
     except Exception as e:
         logger.error(f'sendto failed: {e}')
 
+def flushRtpCommands():
+    global logger
+
+    try:
+        batcher.flush()
+    except Exception as e:
+        logger.error(f'Failed to create packet: {e}')
+
 def getAlsaInput(client):
     global logger
 
     while True:
-        event = client.event_input()
-
-        midi = {}
-        midi['delta_time'] = 0
-        midi['__next'] = 0x80
-        try:
-            midi['channel'] = event.channel
-        except:
-            pass # Ignore this if the event doens't have a channel number
+        #
+        # A timeout of 0 means wait forever so a batch that's due goes now
+        # (and we ask for the timeout once so it can't become due between
+        # looking and waiting)
+        #
+        timeout = batcher.timeout()
+        if timeout is not None and timeout <= 0:
+            flushRtpCommands()
+            timeout = None
+        event = client.event_input(timeout=timeout)
+        if event is None:
+            flushRtpCommands()
+            continue
 
         if event.type == alsa_midi.EventType.NOTEON:
             print(f'NoteOn note {event.note} velocity {event.velocity} channel {event.channel}')
-            midi['command'] = 'note_on'
-            midi['command_byte'] = packets.COMMAND_NOTE_ON | (event.channel &0xf)
-            midi['params'] = {'key':event.note, 'velocity':event.velocity}
-            sendRtpCommand(midi)
+            queueRtpCommand(NOTE_ON | (event.channel & 0xf), (event.note, event.velocity))
         elif event.type == alsa_midi.EventType.NOTEOFF:
             print(f'NoteOff note {event.note} velocity {event.velocity} channel {event.channel}')
-            midi['command'] = 'note_off'
-            midi['command_byte'] = packets.COMMAND_NOTE_OFF | (event.channel &0xf)
-            midi['params'] = {'key':event.note, 'velocity':event.velocity}
-            sendRtpCommand(midi)
+            queueRtpCommand(NOTE_OFF | (event.channel & 0xf), (event.note, event.velocity))
         elif event.type == alsa_midi.EventType.CHANPRESS:
             print(f'KeyPressure note {event.note} velocity {event.velocity} channel {event.channel}')
-            midi['command'] = 'aftertouch'
-            midi['command_byte'] = packets.COMMAND_AFTERTOUCH | (event.channel &0xf)
-            midi['params'] = {'key':event.note, 'velocity':event.velocity}
-            sendRtpCommand(midi)
+            queueRtpCommand(AFTERTOUCH | (event.channel & 0xf), (event.note, event.velocity))
         elif event.type == alsa_midi.EventType.PITCHBEND:
             print(f'PitchBend value {event.value} channel {event.channel}')
-            midi['command'] = 'pitch_bend_change'
-            midi['command_byte'] = packets.COMMAND_PITCH_BEND_CHANGE | (event.channel &0xf)
-            midi['params'] = {'lsb':event.value%256, 'msb':int(event.value/256)}
-            sendRtpCommand(midi)
+            # ALSA's value is -8192 to 8191, MIDI's is two seven bit halves of 0 to 16383
+            value = event.value+0x2000
+            queueRtpCommand(PITCH_BEND | (event.channel & 0xf), (value & 0x7f, value >> 7))
         elif event.type == alsa_midi.EventType.CONTROLLER:
             print(f'Controller param {event.param} value {event.value} channel {event.channel}')
-            midi['command'] = 'control_mode_change'
-            midi['command_byte'] = packets.COMMAND_CONTROL_MODE_CHANGE | (event.channel &0xf)
-            midi['params'] = {'controller':event.param, 'value':event.value}
-            sendRtpCommand(midi)
+            queueRtpCommand(CONTROL_CHANGE | (event.channel & 0xf), (event.param, event.value))
         elif event.type == alsa_midi.EventType.PORT_SUBSCRIBED:
             print(f'Connect: {event}')
         elif event.type == alsa_midi.EventType.PORT_UNSUBSCRIBED:
@@ -160,7 +152,7 @@ def getAlsaInput(client):
             logger.warning(event)
 
 def main():
-    global logger, outputSocket
+    global logger, outputSocket, batcher
 
     signal.signal(signal.SIGINT, interrupted)
 
@@ -168,18 +160,16 @@ def main():
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
 
-    if len(sys.argv) != 2:
-        print(f'Usage: {sys.argv[0]} <UDP port>')
+    if len(sys.argv) not in (2, 3):
+        print(f'Usage: {sys.argv[0]} <UDP port> [batch window ms]')
         sys.exit(0)
 
     myPort = int(sys.argv[1])
+    batchWindow = float(sys.argv[2])/1000 if len(sys.argv) == 3 else BATCH_WINDOW
 
     alsaClient = alsa_midi.SequencerClient(f'rawhub-{myPort}')
     port = alsaClient.create_port(f'rawhub-{myPort}')
 
-    alsaThread = myThread(alsaClient)
-    alsaThread.start()
-
     rtpServer = pymidi.server.Server.from_bind_addrs([f'0.0.0.0:{myPort}'])
     rtpServer.add_handler(midiHandler(alsaClient))
     rtpServer._init_protocols()
@@ -187,6 +177,10 @@ def main():
     for socket in rtpServer.socket_map:
         if type(rtpServer.socket_map[socket]) is pymidi.protocol.DataProtocol:
             outputSocket = rtpServer.socket_map[socket]
+    batcher = CommandBatcher(PacketEncoder(outputSocket.ssrc), sendRtpPacket, batchWindow)
+
+    alsaThread = myThread(alsaClient)
+    alsaThread.start()
 
     while True:
         rtpServer._loop_once(timeout=0)
@@ -5,30 +5,46 @@
 from builtins import bytes
 
 import logging
-import select
+import selectors
+import threading
+import queue
 import socket
 import sys
 import os
 import signal
 import json
+import time
 import boto3
 
 import pymidi.server
 from pymidi.protocol import DataProtocol
 from pymidi.protocol import ControlProtocol
-from pymidi import packets
-from pymidi.utils import get_timestamp
+
+from rtpencoder import PacketEncoder, midiCommand, NOTE_OFF
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from profiling import PhaseTimers, installProfileSignal
 
 logger = None
+timers = PhaseTimers()
 
 midiPorts = {'GroupOne': [5140, 5142], 'GroupTwo': [5150, 5152]}
 transmitPeers = {}
+receiveHandlers = {}
 
 sqs = boto3.client('sqs')
 queueUrl = 'https://sqs.ap-southeast-1.amazonaws.com/995179897743/midihubRaw-SIN'
 
 portRanges = {'Low':range(0, 43), 'Mid':range(43, 86), 'High':range(86, 127), 'All':range(0, 127)}
 
+#
+# How long (seconds) each SQS receive waits for a message. The receive
+# happens in its own thread so this is only how often we make a request
+# when there's nothing to do.
+#
+SQS_WAIT_TIME = 20
+DATAGRAM_SIZE = 1024
+
 class midiHandler(pymidi.server.Handler):
     #
     # task = receive | send
@@ -42,7 +58,7 @@ class midiHandler(pymidi.server.Handler):
         self.task = task
         self.transmitSocket = None
         self.peer = None
-        self.sequenceNumber = 10000
+        self.encoder = PacketEncoder(0, 10000)
 
         if task == 'receive':
             previousPort = 0
@@ -55,6 +71,7 @@ class midiHandler(pymidi.server.Handler):
 
     def on_peer_connected(self, peer):
         self.peer = peer
+        self.encoder.ssrc = peer.ssrc
         self.logger.info(f'Peer connected: {peer}')
 
     def on_peer_disconnected(self, peer):
@@ -62,87 +79,48 @@ class midiHandler(pymidi.server.Handler):
 
     def on_midi_commands(self, peer, midi_packet):
         if self.task == 'receive':
+            #
+            # pymidi reads delta times of 128 or more backwards (see
+            # rtpencoder.py) so long gaps between the commands in one packet
+            # are passed on wrongly; the commands themselves are fine
+            #
+            started = time.perf_counter()
             for command in midi_packet.command.midi_list:
                 print(command)
-                sendCommand(self, self.transmitSocket, command)
-
-def sendCommand(handlerInfo, socket, command):
-    header = { 'rtp_header': { 'flags': { 'v': 0x2,
-                                          'p': 0,
-                                          'x': 0,
-                                          'cc': 0,
-                                          'm': 0x1,
-                                          'pt': 0x61
-                                        },
-                               'sequence_number': handlerInfo.sequenceNumber
-                             },
-               'timestamp': get_timestamp(),
-               'ssrc': handlerInfo.peer.ssrc,
-             }
-
-    newcommand = {
-            'flags': {
-                'b': 0,
-                'j': 0,
-                'z': 0,
-                'p': 0,
-                'len': 3,
-            },
-            'midi_list': [
-                {
-                    'delta_time': 0,
-                    '__next': 0x80,
-                    'command': 'note_on',
-                    'command_byte': pymidi.packets.COMMAND_NOTE_ON | (0 & 0xF),
-                    'channel': 0,
-                    'params': {
-                        'key': 64,
-                        'velocity': 64,
-                    },
-                }
-            ],
-        }
+            sendCommands(self, self.transmitSocket, [midiCommand(command) for command in midi_packet.command.midi_list])
+            timers.record('forward', time.perf_counter()-started)
+
+#
+# commands are (deltaTime, statusByte, dataBytes) - see rtpencoder.py. They
+# go in as few packets as will fit in the MTU.
+#
+def sendCommands(handlerInfo, socket, commands):
+    if not handlerInfo.peer:
+        logger.info('No-one is connected - not sending')
+        return
 
+    started = time.perf_counter()
     try:
-        packet = packets.MIDIPacket.create(header=header, command=newcommand, journal='')
+        for packet in handlerInfo.encoder.encodeAll(commands):
+            encoded = time.perf_counter()
+            timers.record('encode', encoded-started)
+            try:
+                socket.sendto(packet, (handlerInfo.peer.addr[0], handlerInfo.peer.addr[1]+1))
+            except Exception as e:
+                logger.error(f'sendto failed: {e}') 
+            started = time.perf_counter()
     except Exception as e:
         logger.error(f'Packet create failed: {e}') 
-        return
 
-    print(socket)
-    print(type(socket))
-    try:
-        socket.sendto(packet, (handlerInfo.peer.addr[0], handlerInfo.peer.addr[1]+1))
-        print('transmitted')
-        handlerInfo.sequenceNumber += 1
-        print(f'new seq {handlerInfo.sequenceNumber}')
-    except Exception as e:
-        logger.error(f'sendto failed: {e}') 
-
-def sendNoteOff(socketInfo, note, channel, velocity=0):
-    command = { 'flags': { 'b': 0,
-                           'j': 0,
-                           'z': 0,
-                           'p': 0,
-                           'len': 3,
-                         },
-                'midi_list': [ { 'delta_time': 0,
-                                 '__next': 0x80,
-                                 'command': 'note_off',
-                                 'command_byte': pymidi.packets.COMMAND_NOTE_OFF | (channel & 0xF),
-                                 'channel': channel,
-                                 'params': { 'key': note,
-                                             'velocity': velocity,
-                                           },
-                               } ],
-              }
-
-    sendCommand(socketInfo, command)
+def sendNotesOff(handlerInfo, notes, channels=range(0, 16), velocity=0):
+    sendCommands(handlerInfo, handlerInfo.transmitSocket,
+                 [(0, NOTE_OFF | (channel & 0xf), (note, velocity)) for channel in channels for note in notes])
 
 def main():
     global logger
 
     signal.signal(signal.SIGINT, interrupted)
+    installProfileSignal('midihub-raw', timers)
 
     logging.basicConfig()
     logger = logging.getLogger()
@@ -165,45 +143,90 @@ def main():
 
         print(f'Setting up {midiPorts[group][0]}')
         servers[group][0] = pymidi.server.Server.from_bind_addrs([f'0.0.0.0:{midiPorts[group][0]}'])
-        servers[group][0].add_handler(midiHandler('receive', servers[group][1]))
+        receiveHandlers[group] = midiHandler('receive', servers[group][1])
+        servers[group][0].add_handler(receiveHandlers[group])
         servers[group][0]._init_protocols()
 
+    #
+    # Every control and data socket of every group is registered once and we
+    # sleep until one of them has a datagram for us (this is what each
+    # server's _loop_once() does, but for all of them at once). SQS messages
+    # arrive from sqsReceiver() through a queue; it writes to wakeupPipe so
+    # that we notice them straight away.
+    #
+    eventSelector = selectors.DefaultSelector()
+    for group in servers:
+        for server in servers[group]:
+            for serverSocket, protocol in server.socket_map.items():
+                eventSelector.register(serverSocket, selectors.EVENT_READ, protocol)
+
+    messages = queue.Queue()
+    wakeupPipe = os.pipe()
+    os.set_blocking(wakeupPipe[0], False)
+    eventSelector.register(wakeupPipe[0], selectors.EVENT_READ, None)
+    threading.Thread(target=sqsReceiver, args=(messages, wakeupPipe[1]), daemon=True).start()
+
     logger.info('Entering main loop')
-    loopCounter = 0
     while True:
-        for group in servers:
+        for key, mask in eventSelector.select():
+            if key.data is None:
+                os.read(wakeupPipe[0], 512)
+                continue
+
             try:
-                servers[group][0]._loop_once(timeout=0)
-                servers[group][1]._loop_once(timeout=0)
+                buffer, addr = key.fileobj.recvfrom(DATAGRAM_SIZE)
+                key.data.handle_message(bytes(buffer), addr)
             except Exception as e:
                 logger.error(f'Main loop failed: {e}')
 
-        loopCounter += 1
-        if loopCounter%50: continue
+        while not messages.empty():
+            handleMessage(servers, messages.get())
 
+#
+# Runs in its own thread: long polls SQS and hands messages to the main loop
+#
+def sqsReceiver(messages, wakeupFd):
+    global logger
+
+    while True:
+        started = time.perf_counter()
         try:
-           messageList = sqs.receive_message(QueueUrl=queueUrl, WaitTimeSeconds=0, MaxNumberOfMessages=1).get('Messages', [])
+            messageList = sqs.receive_message(QueueUrl=queueUrl, WaitTimeSeconds=SQS_WAIT_TIME, MaxNumberOfMessages=1).get('Messages', [])
         except Exception as e:
             logger.error(f'SQS receive failed: {e}')
+            time.sleep(SQS_WAIT_TIME)
             continue
+        finally:
+            timers.record('sqs', time.perf_counter()-started)
 
         for message in messageList:
-            body = json.loads(message['Body'])
+            messages.put(message)
+        if messageList: os.write(wakeupFd, b'\0')
 
-            resetRange = body['range']
-            port = int(body['port'])
+def handleMessage(servers, message):
+    global logger
 
-            logger.info(f'Sending NoteOff to {port} for {portRanges[resetRange]}')
+    body = json.loads(message['Body'])
 
-            for midiNote in portRanges[resetRange]:
-                for channel in range(0, 16):
-                    # Figure out the right socket to use here
-                    sendNoteOff(servers[group][1], midiNote, channel)
+    resetRange = body['range']
+    port = int(body['port'])
 
-            try:
-                sqs.delete_message(QueueUrl=queueUrl, ReceiptHandle=message['ReceiptHandle'])
-            except Exception as e:
-                logger.error(f'SQS delete failed: {e}')
+    #
+    # The group the port belongs to - or the last one, which is what we
+    # always used to send to
+    #
+    group = list(servers)[-1]
+    for name in servers:
+        if port in midiPorts[name]: group = name
+
+    logger.info(f'Sending NoteOff to {port} for {portRanges[resetRange]}')
+
+    sendNotesOff(receiveHandlers[group], portRanges[resetRange])
+
+    try:
+        sqs.delete_message(QueueUrl=queueUrl, ReceiptHandle=message['ReceiptHandle'])
+    except Exception as e:
+        logger.error(f'SQS delete failed: {e}')
 
 def alreadyRunning():
     global logger
@@ -0,0 +1,390 @@
+#!/usr/bin/python3
+
+#
+# relay.py
+#  An RTP MIDI relay for any number of rooms in one process, built on
+#  asyncio rather than a loop around pymidi's _loop_once().
+#
+#  Each room listens on a pair of UDP ports (control and control+1 for
+#  data) and speaks just enough of the AppleMIDI session protocol for
+#  rtpmidid, macOS and rtpMIDI on Windows to connect to it: invitations
+#  (IN/OK), goodbyes (BY) and clock sync (CK). MIDI from one participant
+#  is sent on to the other participants in the room ("echo") and/or to
+#  everyone in other rooms ("forwardTo") - which is how midihub-raw.py's
+#  receive and send ports work.
+#
+#  Every participant has its own task which starts a clock sync every
+#  CLOCK_SYNC_INTERVAL seconds (so we know their latency, and they know we
+#  are still here) and ends the session if we haven't heard anything from
+#  them for SESSION_TIMEOUT seconds. Nothing polls: the sockets are asyncio
+#  datagram endpoints and the timers are tasks sleeping until they are due.
+#  The SQS queue that asks for stuck notes to be turned off is just another
+#  task.
+#
+#  Rooms come from "relay.json" in the running directory:
+#   {"rooms": {"GroupOne": {"port": 5140, "forwardTo": ["GroupOneOut"], "echo": false},
+#              "GroupOneOut": {"port": 5142}},
+#    "queueUrl": "https://sqs..."}
+#  Without it the groups in "midiports" (as used by midihub-raw.py) are
+#  used: the first port of each group forwards to the second.
+#
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import struct
+import asyncio
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from profiling import PhaseTimers, installProfileSignal
+from rtpencoder import PacketEncoder, rtpClock, sessionClock, RTP_HEADER, RTP_VERSION, RTP_MIDI_PAYLOAD, MARKER, NOTE_OFF
+
+#
+# Configuration:
+#  CLOCK_SYNC_INTERVAL:
+#      How often (seconds) we start a clock sync with each participant.
+#  SESSION_TIMEOUT:
+#      How long (seconds) a participant can be silent - no MIDI and no clock
+#      sync - before we end their session.
+#  SQS_WAIT_TIME:
+#      How long each SQS receive waits for a message.
+#
+CLOCK_SYNC_INTERVAL = 10
+SESSION_TIMEOUT = 60
+SQS_WAIT_TIME = 20
+ROOM_NAME_PREFIX = 'midiHub'
+
+SIGNATURE = 0xffff
+PROTOCOL_VERSION = 2
+EXCHANGE = struct.Struct('>H2sIII')
+CLOCK_SYNC = struct.Struct('>H2sIB3xQQQ')
+
+logger = None
+timers = PhaseTimers()
+
+class Peer:
+    def __init__(self, name, ssrc, token, controlAddr):
+        self.name = name
+        self.ssrc = ssrc
+        self.token = token
+        self.controlAddr = controlAddr
+        self.dataAddr = None
+        self.lastSeen = time.monotonic()
+        self.latency = None
+        self.sequenceNumber = random.randrange(0x10000)
+        self.task = None
+
+    def __str__(self):
+        return f'{self.name} ({self.controlAddr[0]}:{self.controlAddr[1]})'
+
+#
+# One of these for each socket; all it does is hand datagrams to the room
+#
+class RoomProtocol(asyncio.DatagramProtocol):
+    def __init__(self, room, isData):
+        self.room = room
+        self.isData = isData
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            self.room.received(self, data, addr)
+        except Exception as e:
+            self.room.logger.error(f'{self.room.name}: failed to handle datagram from {addr}: {e}')
+
+    def error_received(self, exc):
+        self.room.logger.warning(f'{self.room.name}: {exc}')
+
+class Room:
+    def __init__(self, relay, name, port, forwardTo=None, echo=True):
+        self.logger = logging.getLogger()
+        self.relay = relay
+        self.name = name
+        self.port = port
+        self.forwardTo = forwardTo or []
+        self.echo = echo
+        self.ssrc = random.randrange(1, 0xffffffff)
+        self.sessionName = f'{ROOM_NAME_PREFIX}-{name}'.encode()
+        self.encoder = PacketEncoder(self.ssrc)
+        self.peers = {}
+        self.dataPeers = {}
+        self.control = None
+        self.data = None
+
+    async def start(self, loop):
+        transport, self.control = await loop.create_datagram_endpoint(lambda: RoomProtocol(self, False), local_addr=('0.0.0.0', self.port))
+        transport, self.data = await loop.create_datagram_endpoint(lambda: RoomProtocol(self, True), local_addr=('0.0.0.0', self.port+1))
+        self.logger.info(f'Room {self.name} listening on {self.port}/{self.port+1}')
+
+    def received(self, protocol, data, addr):
+        if len(data) >= 4 and data[0] == 0xff and data[1] == 0xff:
+            self.exchangeReceived(protocol, data, addr)
+        elif protocol.isData and len(data) > RTP_HEADER.size and data[1] & 0x7f == RTP_MIDI_PAYLOAD:
+            self.midiReceived(data, addr)
+
+    #
+    # AppleMIDI session packets
+    #
+    def exchangeReceived(self, protocol, data, addr):
+        command = data[2:4]
+
+        if command == b'CK':
+            if len(data) < CLOCK_SYNC.size: return
+            signature, command, ssrc, count, ts1, ts2, ts3 = CLOCK_SYNC.unpack_from(data)
+            self.clockSyncReceived(ssrc, count, ts1, ts2, ts3, addr)
+            return
+
+        if command == b'RS': return # Receiver feedback - we don't keep a journal so there's nothing to trim
+
+        if len(data) < EXCHANGE.size: return
+        signature, command, version, token, ssrc = EXCHANGE.unpack_from(data)
+
+        if command == b'IN':
+            name = data[EXCHANGE.size:].split(b'\0', 1)[0].decode(errors='replace')
+            self.invitationReceived(protocol, name, token, ssrc, addr)
+        elif command == b'BY':
+            peer = self.peers.get(ssrc)
+            if peer: self.endSession(peer, 'said goodbye', sendGoodbye=False)
+
+    def invitationReceived(self, protocol, name, token, ssrc, addr):
+        peer = self.peers.get(ssrc)
+        if not protocol.isData:
+            if peer: self.endSession(peer, 'invited us again', sendGoodbye=False)
+            self.peers[ssrc] = Peer(name, ssrc, token, addr)
+        elif not peer:
+            self.sendExchange(protocol, b'NO', token, addr)
+            return
+        else:
+            peer.dataAddr = addr
+            self.dataPeers[addr] = peer
+            if not peer.task: peer.task = asyncio.ensure_future(self.session(peer))
+            self.logger.info(f'{self.name}: {peer} joined')
+
+        self.sendExchange(protocol, b'OK', token, addr)
+
+    def sendExchange(self, protocol, command, token, addr):
+        packet = EXCHANGE.pack(SIGNATURE, command, PROTOCOL_VERSION, token, self.ssrc)
+        if command in (b'IN', b'OK'): packet += self.sessionName+b'\0'
+        protocol.transport.sendto(packet, addr)
+
+    def clockSyncReceived(self, ssrc, count, ts1, ts2, ts3, addr):
+        peer = self.peers.get(ssrc)
+        if not peer: return
+        peer.lastSeen = time.monotonic()
+
+        now = sessionClock()
+        if count == 0:
+            self.data.transport.sendto(CLOCK_SYNC.pack(SIGNATURE, b'CK', self.ssrc, 1, ts1, now, 0), addr)
+        elif count == 1:
+            # The answer to one we started
+            self.data.transport.sendto(CLOCK_SYNC.pack(SIGNATURE, b'CK', self.ssrc, 2, ts1, ts2, now), addr)
+            peer.latency = (now-ts1)/20
+        elif count == 2:
+            peer.latency = (ts3-ts1)/20
+
+    #
+    # Runs for as long as a participant is here
+    #
+    async def session(self, peer):
+        try:
+            while True:
+                await asyncio.sleep(CLOCK_SYNC_INTERVAL)
+                if time.monotonic()-peer.lastSeen > SESSION_TIMEOUT:
+                    self.endSession(peer, f'silent for {SESSION_TIMEOUT}s')
+                    return
+                self.data.transport.sendto(CLOCK_SYNC.pack(SIGNATURE, b'CK', self.ssrc, 0, sessionClock(), 0, 0), peer.dataAddr)
+                if peer.latency is not None: self.logger.debug(f'{self.name}: latency {peer}: {peer.latency:.1f} ms')
+        except asyncio.CancelledError:
+            pass
+
+    def endSession(self, peer, reason, sendGoodbye=True):
+        self.logger.info(f'{self.name}: {peer} left - {reason}')
+        if sendGoodbye: self.sendExchange(self.control, b'BY', peer.token, peer.controlAddr)
+        self.peers.pop(peer.ssrc, None)
+        if peer.dataAddr: self.dataPeers.pop(peer.dataAddr, None)
+        if peer.task and peer.task is not asyncio.current_task(): peer.task.cancel()
+
+    def midiReceived(self, data, addr):
+        peer = self.dataPeers.get(addr)
+        if not peer: return
+        peer.lastSeen = time.monotonic()
+
+        started = time.perf_counter()
+        packet = bytearray(RTP_HEADER.size)+midiPayload(data)
+        if self.echo: self.sendPacket(packet, exclude=peer)
+        for roomName in self.forwardTo:
+            room = self.relay.rooms.get(roomName)
+            if room: room.sendPacket(packet)
+        timers.record('forward', time.perf_counter()-started)
+
+    #
+    # packet is a whole RTP MIDI packet (a bytearray or a view of one); the
+    # header is written again for each participant with their sequence
+    # number and our SSRC
+    #
+    def sendPacket(self, packet, exclude=None):
+        timestamp = rtpClock()
+        for peer in list(self.peers.values()):
+            if peer is exclude or not peer.dataAddr: continue
+            RTP_HEADER.pack_into(packet, 0, RTP_VERSION, MARKER | RTP_MIDI_PAYLOAD, peer.sequenceNumber, timestamp, self.ssrc)
+            peer.sequenceNumber = (peer.sequenceNumber+1) & 0xffff
+            self.data.transport.sendto(packet, peer.dataAddr)
+
+    #
+    # As few packets as the NoteOffs for every channel will fit in (see
+    # encodeAll() in rtpencoder.py)
+    #
+    def sendNotesOff(self, notes):
+        commands = [(0, NOTE_OFF | channel, (note, 0)) for channel in range(16) for note in notes]
+        for packet in self.encoder.encodeAll(commands):
+            self.sendPacket(packet)
+
+    async def stop(self):
+        for peer in list(self.peers.values()):
+            self.endSession(peer, 'relay stopping')
+
+#
+# The MIDI command section of an RTP MIDI packet without the recovery
+# journal - we give the packet our own sequence numbers so the sender's
+# journal would be talking about packets the receiver never saw.
+#
+def midiPayload(data):
+    flags = data[RTP_HEADER.size]
+    if flags & 0x80:
+        length = ((flags & 0x0f) << 8 | data[RTP_HEADER.size+1])+2
+    else:
+        length = (flags & 0x0f)+1
+    payload = bytearray(data[RTP_HEADER.size:RTP_HEADER.size+length])
+    payload[0] &= ~0x40 # No journal
+    return bytes(payload)
+
+class Relay:
+    def __init__(self):
+        self.logger = logging.getLogger()
+        self.rooms = {}
+        self.tasks = []
+
+    def addRoom(self, name, port, forwardTo=None, echo=True):
+        self.rooms[name] = Room(self, name, port, forwardTo, echo)
+
+    def roomForPort(self, port):
+        for room in self.rooms.values():
+            if room.port == port: return room
+        return None
+
+    #
+    # Extra inputs (like the SQS queue) are coroutines taking the relay
+    #
+    async def run(self, inputs=()):
+        loop = asyncio.get_running_loop()
+        for room in self.rooms.values():
+            await room.start(loop)
+
+        stopping = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopping.set)
+
+        self.tasks = [asyncio.ensure_future(task(self)) for task in inputs]
+        self.logger.info(f'Relaying for {len(self.rooms)} rooms')
+        await stopping.wait()
+
+        self.logger.info('Stopping')
+        for task in self.tasks: task.cancel()
+        for room in self.rooms.values():
+            await room.stop()
+
+#
+# Requests to turn off stuck notes: {"port": 5142, "range": "Low"}
+#
+PORT_RANGES = {'Low':range(0, 43), 'Mid':range(43, 86), 'High':range(86, 127), 'All':range(0, 127)}
+
+def sqsInput(queueUrl):
+    async def receive(relay):
+        import boto3
+
+        loop = asyncio.get_running_loop()
+        sqs = boto3.client('sqs')
+        while True:
+            started = time.perf_counter()
+            try:
+                response = await loop.run_in_executor(None, lambda: sqs.receive_message(QueueUrl=queueUrl, WaitTimeSeconds=SQS_WAIT_TIME, MaxNumberOfMessages=1))
+            except Exception as e:
+                relay.logger.error(f'SQS receive failed: {e}')
+                await asyncio.sleep(SQS_WAIT_TIME)
+                continue
+            finally:
+                timers.record('sqs', time.perf_counter()-started)
+
+            for message in response.get('Messages', []):
+                try:
+                    body = json.loads(message['Body'])
+                    room = relay.roomForPort(int(body['port']))
+                    notes = list(PORT_RANGES[body['range']])
+                except Exception as e:
+                    relay.logger.error(f'Bad SQS message {message.get("Body")}: {e}')
+                    room = None
+
+                if room:
+                    relay.logger.info(f'Sending NoteOff to {room.name} for {body["range"]}')
+                    room.sendNotesOff(notes)
+
+                try:
+                    await loop.run_in_executor(None, lambda: sqs.delete_message(QueueUrl=queueUrl, ReceiptHandle=message['ReceiptHandle']))
+                except Exception as e:
+                    relay.logger.error(f'SQS delete failed: {e}')
+    return receive
+
+def configure(relay):
+    global logger
+
+    try:
+        with open('relay.json') as configFile:
+            config = json.load(configFile)
+    except FileNotFoundError:
+        config = None
+    except Exception as e:
+        logger.error(f'Cannot read relay.json: {e}')
+        sys.exit(1)
+
+    if config is None:
+        try:
+            with open('midiports') as portsFile:
+                groups = json.load(portsFile)
+        except Exception as e:
+            logger.warning(f'No relay.json and cannot read midiports ({e}) - using defaults')
+            groups = {'GroupOne': [5140, 5142], 'GroupTwo': [5150, 5152]}
+        config = {'rooms': {}}
+        for group, (receivePort, sendPort) in groups.items():
+            config['rooms'][group] = {'port': receivePort, 'forwardTo': [f'{group}-send'], 'echo': False}
+            config['rooms'][f'{group}-send'] = {'port': sendPort}
+
+    for name, room in config.get('rooms', {}).items():
+        relay.addRoom(name, int(room['port']), room.get('forwardTo'), room.get('echo', True))
+    return config
+
+def main():
+    global logger
+
+    logging.basicConfig()
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+
+    installProfileSignal('relay', timers)
+
+    relay = Relay()
+    config = configure(relay)
+
+    inputs = []
+    if config.get('queueUrl'): inputs.append(sqsInput(config['queueUrl']))
+
+    asyncio.run(relay.run(inputs))
+
+if __name__ == '__main__':
+    main()
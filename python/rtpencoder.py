@@ -0,0 +1,257 @@
+#
+# rtpencoder.py
+#  Builds RTP MIDI packets (RFC 6295) straight into a bytearray, for the
+#  places that send MIDI: packets.MIDIPacket.create() takes a nest of dicts
+#  for every message and construct is by far the slowest thing we do per
+#  event (see benchmark-encoder.py).
+#
+#  A command is (deltaTime, statusByte, dataBytes):
+#   encoder = PacketEncoder(ssrc)
+#   packet = encoder.encode([(0, NOTE_ON | channel, (60, 100)), (10, NOTE_ON | channel, (64, 100))])
+#   socket.sendto(packet, addr)
+#  The first command's delta time is ignored (there is no Z flag). Channel
+#  messages with the same status byte as the one before are sent with
+#  running status. encode() returns a memoryview of the encoder's buffer, so
+#  send it before encoding the next one.
+#
+#  encodeAll() splits a long list of commands into as many packets as it
+#  takes to keep each one under an MTU budget, and CommandBatcher collects
+#  commands as they arrive (ALSA events, say) for a few milliseconds and
+#  sends them as one packet with the delta times between them.
+#
+#  Delta times are the RFC 6295 (MIDI file style) variable length: seven
+#  bits to a byte, most significant first, which is what rtpmidid, macOS
+#  and rtpMIDI expect. pymidi reads them least significant first, which only
+#  gives the same answer for delta times under 128 - so a pymidi based peer
+#  (one of our own scripts, say) gets longer gaps wrong. The order of the
+#  commands and the commands themselves always come through. See
+#  test_rtpencoder.py (python3 -m unittest test_rtpencoder).
+#
+
+import time
+import struct
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+AFTERTOUCH = 0xa0
+CONTROL_CHANGE = 0xb0
+PROGRAM_CHANGE = 0xc0
+CHANNEL_PRESSURE = 0xd0
+PITCH_BEND = 0xe0
+
+RTP_HEADER = struct.Struct('>BBHII')
+RTP_VERSION = 0x80
+RTP_MIDI_PAYLOAD = 0x61
+MARKER = 0x80
+
+LONG_HEADER = struct.Struct('>H')
+SHORT_LIST = 15
+MAX_LIST = 0xfff
+MAX_PACKET_SIZE = 8192
+
+#
+# Ethernet MTU less the IP, UDP, RTP and command section headers
+#
+DEFAULT_BUDGET = 1500-28-RTP_HEADER.size-2
+DEFAULT_WINDOW = 0.002
+
+#
+# The names pymidi gives the parameters of each kind of channel message,
+# in the order they go on the wire
+#
+PARAMETERS = {NOTE_OFF:('key', 'velocity'), NOTE_ON:('key', 'velocity'), AFTERTOUCH:('key', 'touch'),
+              CONTROL_CHANGE:('controller', 'value'), PROGRAM_CHANGE:('program',),
+              CHANNEL_PRESSURE:('pressure',), PITCH_BEND:('lsb', 'msb')}
+NOTE_NAMES = {'C':0, 'Cs':1, 'D':2, 'Ds':3, 'E':4, 'F':5, 'Fs':6, 'G':7, 'Gs':8, 'A':9, 'As':10, 'B':11}
+
+#
+# RTP MIDI timestamps are in units of 100us. They have to be on the same
+# clock as the one the session answers clock sync (CK) with - pymidi uses
+# the time of day - because that's what the other end calibrates against.
+# sessionClock() is the whole 64 bit CK timestamp, rtpClock() the 32 bits
+# that go in the RTP header.
+#
+def sessionClock():
+    return int(time.time()*10000)
+
+def rtpClock():
+    return sessionClock() & 0xffffffff
+
+#
+# pymidi's note names ("B6", "Csn1") as note numbers
+#
+def noteNumber(key):
+    if not isinstance(key, str) or key.isdigit(): return int(key)
+    octave = key.lstrip('ABCDEFGs')
+    return NOTE_NAMES[key[:len(key)-len(octave)]]+12*(int(octave.replace('n', '-'))+1)
+
+#
+# A command from pymidi (a parsed Container or the dicts we used to give
+# MIDIPacket.create()) as (deltaTime, statusByte, dataBytes)
+#
+def midiCommand(command):
+    status = command['command_byte']
+    params = command['params']
+    names = PARAMETERS.get(status & 0xf0)
+    if names is None: return (command.get('delta_time') or 0, status, bytes(params.get('unknown', b'')))
+
+    data = [params[name] for name in names]
+    if names[0] == 'key': data[0] = noteNumber(data[0])
+    return (command.get('delta_time') or 0, status, data)
+
+#
+# The most a command can take up in a command list (assuming no running
+# status)
+#
+def commandSize(command):
+    deltaTime = command[0]
+    if deltaTime < 0x80: deltaBytes = 1
+    elif deltaTime < 0x4000: deltaBytes = 2
+    elif deltaTime < 0x200000: deltaBytes = 3
+    else: deltaBytes = 4
+    return deltaBytes+1+len(command[2])
+
+def encodeDeltaTime(buffer, offset, deltaTime):
+    if deltaTime < 0x80:
+        buffer[offset] = deltaTime
+        return offset+1
+
+    groups = []
+    while deltaTime:
+        groups.append(deltaTime & 0x7f)
+        deltaTime >>= 7
+    for index in range(len(groups)-1, 0, -1):
+        buffer[offset] = groups[index] | 0x80
+        offset += 1
+    buffer[offset] = groups[0]
+    return offset+1
+
+class PacketEncoder:
+    def __init__(self, ssrc, sequenceNumber=0):
+        self.ssrc = ssrc
+        self.sequenceNumber = sequenceNumber
+        self.buffer = bytearray(MAX_PACKET_SIZE)
+        self.view = memoryview(self.buffer)
+
+    #
+    # journal (already encoded) goes after the command list with the J flag
+    # set. Raises ValueError if it doesn't all fit in one packet.
+    #
+    def encode(self, commands, timestamp=None, journal=b''):
+        buffer = self.buffer
+
+        #
+        # Commands go in after room for a long (two byte) command section
+        # header and move up a byte if it turns out we only need a short one
+        #
+        start = RTP_HEADER.size+2
+        offset = start
+        end = start+MAX_LIST
+        lastStatus = None
+        for deltaTime, status, data in commands:
+            # Four bytes of delta time at most and a status byte
+            if offset+5+len(data) > end: raise ValueError('Too many commands for one packet')
+            if offset > start: offset = encodeDeltaTime(buffer, offset, deltaTime)
+            if status != lastStatus or status >= 0xf0:
+                buffer[offset] = status
+                offset += 1
+                lastStatus = status if status < 0xf0 else None
+            buffer[offset:offset+len(data)] = bytes(data)
+            offset += len(data)
+
+        length = offset-start
+        if offset+len(journal) > len(buffer): raise ValueError('Journal too big for one packet')
+
+        flags = 0x40 if journal else 0
+        if length > SHORT_LIST:
+            LONG_HEADER.pack_into(buffer, start-2, 0x8000 | flags << 8 | length)
+            headerStart = RTP_HEADER.size
+        else:
+            buffer[start-1] = flags | length
+            headerStart = RTP_HEADER.size+1
+
+        RTP_HEADER.pack_into(buffer, headerStart-RTP_HEADER.size, RTP_VERSION, MARKER | RTP_MIDI_PAYLOAD,
+                             self.sequenceNumber, rtpClock() if timestamp is None else timestamp, self.ssrc)
+        self.sequenceNumber = (self.sequenceNumber+1) & 0xffff
+
+        if journal:
+            buffer[offset:offset+len(journal)] = journal
+            offset += len(journal)
+        return self.view[headerStart-RTP_HEADER.size:offset]
+
+    #
+    # Packets for all of the commands, as few as will fit in budget bytes of
+    # command list each. Each packet is a view of the same buffer so send it
+    # before asking for the next one.
+    #
+    def encodeAll(self, commands, timestamp=None, budget=DEFAULT_BUDGET):
+        if timestamp is None: timestamp = rtpClock()
+
+        batch = []
+        size = 0
+        for command in commands:
+            needed = commandSize(command)
+            if batch and size+needed > budget:
+                yield self.encode(batch, timestamp & 0xffffffff)
+                # The next packet starts at the time of its first command
+                timestamp += sum(deltaTime for deltaTime, status, data in batch[1:])+command[0]
+                command = (0, command[1], command[2])
+                batch = []
+                size = 0
+            batch.append(command)
+            size += needed
+        if batch: yield self.encode(batch, timestamp & 0xffffffff)
+
+#
+# Collects commands for up to window seconds (or until they would go over
+# budget) and hands them to send() as one packet:
+#  batcher = CommandBatcher(encoder, lambda packet: socket.sendto(packet, addr))
+#  batcher.add(NOTE_ON | channel, (60, 100))
+#  ... wait for up to batcher.timeout() for more ...
+#  batcher.flush()
+# add() sends the batch itself once the window is over, but only when
+# another command arrives - whoever is waiting for commands should wait no
+# longer than timeout() and then flush().
+#
+class CommandBatcher:
+    def __init__(self, encoder, send, window=DEFAULT_WINDOW, budget=DEFAULT_BUDGET):
+        self.encoder = encoder
+        self.send = send
+        self.window = window
+        self.budget = budget
+        self.commands = []
+        self.size = 0
+        self.timestamp = 0
+        self.lastTime = 0
+        self.deadline = None
+
+    def add(self, status, data, now=None):
+        if now is None: now = rtpClock()
+
+        if self.commands:
+            command = ((now-self.lastTime) & 0xffffffff, status, data)
+            if self.size+commandSize(command) > self.budget: self.flush()
+
+        if not self.commands:
+            command = (0, status, data)
+            self.timestamp = now
+            self.deadline = time.monotonic()+self.window
+
+        self.commands.append(command)
+        self.size += commandSize(command)
+        self.lastTime = now
+        if self.timeout() == 0: self.flush()
+
+    #
+    # Seconds until the batch has to go (None if there isn't one)
+    #
+    def timeout(self):
+        if not self.commands: return None
+        return max(self.deadline-time.monotonic(), 0)
+
+    def flush(self):
+        if not self.commands: return
+        commands = self.commands
+        self.commands = []
+        self.size = 0
+        self.send(self.encoder.encode(commands, self.timestamp))
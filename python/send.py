@@ -8,51 +8,15 @@ import copy
 import time
 import select
 
+from rtpencoder import PacketEncoder, noteNumber
+
 remoteAddresses = []
 
 def sendPacket(command, remoteAddr):
     channel = 0
 
-    packet = packets.MIDIPacket.create(
-        header={
-            'rtp_header': {
-                'flags': {
-                    'v': 0x2,
-                    'p': 0,
-                    'x': 0,
-                    'cc': 0,
-                    'm': 0x1,
-                    'pt': 0x61
-                },
-                'sequence_number': ord('K')
-            },
-            'timestamp': int(time.time()),
-            'ssrc': outputSocket.ssrc
-        },
-        command={
-            'flags': {
-                'b': 0,
-                'j': 0,
-                'z': 0,
-                'p': 0,
-                'len': 3,
-            },
-            'midi_list': [
-                {
-                    'delta_time': 0,
-                    '__next': 0x80,
-                    'command': 'note_on' if command == packets.COMMAND_NOTE_ON else 'note_off',
-                    'command_byte': command | (channel & 0xF),
-                    'channel': channel,
-                    'params': {
-                        'key': 'B6',
-                        'velocity': 80,
-                    }
-                }
-            ]
-        },
-        journal='',
-    )
+    encoder.sequenceNumber = ord('K')
+    packet = encoder.encode([(0, command | (channel & 0xf), (noteNumber('B6'), 80))], int(time.time()))
 
     outputSocket.sendto(packet, remoteAddr)
 
@@ -92,6 +56,7 @@ myServer._init_protocols()
 for socket in myServer.socket_map:
     if type(myServer.socket_map[socket]) is pymidi.protocol.DataProtocol:
         outputSocket = myServer.socket_map[socket]
+encoder = PacketEncoder(outputSocket.ssrc)
 
 while True:
     nonBusyLoop(myServer, timeout=0.1)
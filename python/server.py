@@ -1,60 +1,65 @@
 #!/usr/bin/python3
 
 from pymidi import server
-from pymidi import packets
-from pymidi.utils import get_timestamp
 import pymidi
 import logging
-import copy
+import select
+import struct
 import time
 import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from profiling import PhaseTimers, installProfileSignal
+from rtpencoder import rtpClock
 
 remoteAddresses = []
-sequenceNumber = 0
+sequenceNumbers = {}
+timers = PhaseTimers()
+
+#
+# Forwarding only changes the RTP sequence number, timestamp and SSRC of
+# the datagram we received; the MIDI commands and journal go through as they
+# are, so there's nothing to encode however many people are connected.
+#
+DATAGRAM_SIZE = 1024
+RTP_HEADER_SIZE = 12
+RTP_PATCH = struct.Struct('>HII')
+RTP_SSRC = struct.Struct('>I')
+
+buffer = bytearray(DATAGRAM_SIZE)
+view = memoryview(buffer)
 
 logging.basicConfig()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def sendPacket(midiPacket, remoteAddr):
-    global sequenceNumber
-
-    length = 3+4*(len(midiPacket.command.midi_list)-1) if len(midiPacket.command.midi_list) else 0
-
-    try:
-        packet = packets.MIDIPacket.create(
-            header={
-                'rtp_header': {
-                    'flags': {
-                        'v': midiPacket.header.rtp_header.flags.v,
-                        'p': midiPacket.header.rtp_header.flags.p,
-                        'x': midiPacket.header.rtp_header.flags.x,
-                        'cc': midiPacket.header.rtp_header.flags.cc,
-                        'm': midiPacket.header.rtp_header.flags.m,
-                        'pt': 0x61
-                    },
-                    'sequence_number': sequenceNumber
-                },
-                'timestamp': get_timestamp(),
-                'ssrc': outputSocket.ssrc
-            },
-            command={
-                'flags': {
-                    'b': midiPacket.command.flags.b,
-                    'j': midiPacket.command.flags.j,
-                    'z': midiPacket.command.flags.z,
-                    'p': midiPacket.command.flags.p,
-                    'len': length
-                },
-                'midi_list': midiPacket.command.midi_list,
-            },
-            journal = midiPacket.journal
-        )
-    except Exception as e:
-        print(f'---> {e}')
-        print(midiPacket)
-    else:
-        outputSocket.sendto(packet, remoteAddr)
+def forwardPacket(length, sourceAddr):
+    peer = outputSocket.peers_by_ssrc.get(RTP_SSRC.unpack_from(buffer, 8)[0])
+    if not peer: return
+
+    started = time.perf_counter()
+    packet = view[:length]
+
+    #
+    # The sender's timestamp is on the sender's clock, which the people we
+    # forward to have never synced with. They synced with pymidi's clock
+    # (the time of day, see handle_timestamp()) and rtpClock() is the same.
+    #
+    timestamp = rtpClock()
+    for remote in remoteAddresses:
+        if remote == sourceAddr: continue
+
+        sequenceNumber = sequenceNumbers.get(remote, 0)
+        RTP_PATCH.pack_into(buffer, 2, sequenceNumber, timestamp, outputSocket.ssrc)
+        sequenceNumbers[remote] = (sequenceNumber+1) & 0xffff
+
+        sent = time.perf_counter()
+        outputSocket.sendto(packet, remote)
+        timers.record('send', time.perf_counter()-sent)
+    timers.record('forward', time.perf_counter()-started)
+
+    logger.debug(f'{peer.name} sent {length} bytes - forwarded to {len(remoteAddresses)-1} peers')
 
 class MyHandler(server.Handler):
     def on_peer_connected(self, peer):
@@ -67,21 +72,10 @@ class MyHandler(server.Handler):
         dataAddress = (peer.addr[0], peer.addr[1]+1)
         if dataAddress in remoteAddresses:
             remoteAddresses.remove(dataAddress)
+        sequenceNumbers.pop(dataAddress, None)
         print('Peer disconnected: {}'.format(peer))
 
-    def on_midi_commands(self, peer, midi_packet):
-        global sequenceNumber
-
-        tempAddresses = copy.copy(remoteAddresses)
-        tempAddresses.remove(peer.addr)
-
-        if not len(tempAddresses): return
-
-        print(f'{peer.name} sent {midi_packet.command.midi_list[0].command} - forwarding to {tempAddresses}')
-        for remote in tempAddresses:
-            sendPacket(midi_packet, remote)
-
-        sequenceNumber += len(midi_packet.command.midi_list)
+installProfileSignal('server', timers)
 
 myServer = server.Server([('0.0.0.0', 5040)])
 myServer.add_handler(MyHandler())
@@ -91,5 +85,16 @@ for socket in myServer.socket_map:
     if type(myServer.socket_map[socket]) is pymidi.protocol.DataProtocol:
         outputSocket = myServer.socket_map[socket]
 
+#
+# pymidi's _loop_once() but with MIDI data going to forwardPacket() instead
+# of being parsed; session messages (0xffff...) still go to pymidi
+#
 while True:
-    myServer._loop_once()
+    readable, _, _ = select.select(list(myServer.socket_map), [], [])
+    for readySocket in readable:
+        length, addr = readySocket.recvfrom_into(buffer)
+        protocol = myServer.socket_map[readySocket]
+        if protocol is outputSocket and length > RTP_HEADER_SIZE and buffer[0] != 0xff:
+            forwardPacket(length, addr)
+        else:
+            protocol.handle_message(bytes(view[:length]), addr)
@@ -0,0 +1,160 @@
+#
+# test_rtpencoder.py
+#  Checks rtpencoder.py against pymidi's parser (which is what reads the
+#  packets on our side) and against RFC 6295 for delta times:
+#   cd python && python3 -m unittest test_rtpencoder
+#  The pymidi tests are skipped if pymidi isn't installed.
+#
+
+import random
+import unittest
+
+from rtpencoder import (PacketEncoder, CommandBatcher, midiCommand, encodeDeltaTime, DEFAULT_BUDGET,
+                        NOTE_ON, NOTE_OFF, AFTERTOUCH, CONTROL_CHANGE, RTP_HEADER)
+
+try:
+    from pymidi import packets
+except ImportError:
+    packets = None
+
+SSRC = 0x12345678
+
+def randomCommands(rng, count, maxDelta=127):
+    channel = rng.randrange(16)
+    return [(rng.randrange(maxDelta+1) if index else 0, rng.choice([NOTE_ON, NOTE_OFF, AFTERTOUCH, CONTROL_CHANGE]) | channel,
+             (rng.randrange(128), rng.randrange(128))) for index in range(count)]
+
+#
+# RFC 6295 / MIDI file delta time: seven bits to a byte, most significant
+# first
+#
+def decodeDeltaTime(data, offset):
+    value = 0
+    while True:
+        value = value << 7 | data[offset] & 0x7f
+        offset += 1
+        if not data[offset-1] & 0x80: return value, offset
+
+class DeltaTimeTest(unittest.TestCase):
+    # The examples from the Standard MIDI File specification
+    EXAMPLES = {0x00:'00', 0x40:'40', 0x7f:'7f', 0x80:'8100', 0x2000:'c000', 0x3fff:'ff7f', 0x4000:'818000',
+                0x100000:'c08000', 0x1fffff:'ffff7f', 0x200000:'81808000', 0x8000000:'c0808000', 0xfffffff:'ffffff7f'}
+
+    def testEncoding(self):
+        for value, expected in self.EXAMPLES.items():
+            buffer = bytearray(4)
+            length = encodeDeltaTime(buffer, 0, value)
+            self.assertEqual(buffer[:length].hex(), expected, f'delta time {value:#x}')
+            self.assertEqual(decodeDeltaTime(buffer, 0), (value, length))
+
+    def testPacket(self):
+        commands = [(0, NOTE_ON, (60, 100)), (300, NOTE_ON, (64, 100)), (0x4000, NOTE_OFF, (60, 0))]
+        packet = bytes(PacketEncoder(SSRC).encode(commands, 0))
+        data = packet[RTP_HEADER.size+1:]
+
+        self.assertEqual(data[:3], bytes([NOTE_ON, 60, 100]))
+        deltaTime, offset = decodeDeltaTime(data, 3)
+        self.assertEqual(deltaTime, 300)
+        self.assertEqual(data[offset:offset+2], bytes([64, 100])) # Running status
+        deltaTime, offset = decodeDeltaTime(data, offset+2)
+        self.assertEqual(deltaTime, 0x4000)
+        self.assertEqual(data[offset:], bytes([NOTE_OFF, 60, 0]))
+
+@unittest.skipUnless(packets, 'pymidi is not installed')
+class PymidiRoundTripTest(unittest.TestCase):
+    def parse(self, packet):
+        return packets.MIDIPacket.parse(bytes(packet))
+
+    def assertCommands(self, parsed, commands):
+        found = [midiCommand(command) for command in parsed.command.midi_list]
+        self.assertEqual(len(found), len(commands))
+        for index, (want, got) in enumerate(zip(commands, found)):
+            self.assertEqual((want[0] if index else 0, want[1], list(want[2])), (got[0] if index else 0, got[1], list(got[2])))
+
+    def testRoundTrip(self):
+        rng = random.Random(1)
+        encoder = PacketEncoder(SSRC, 65530)
+        for count in [1, 2, 5, 6, 50, 300]:
+            for attempt in range(20):
+                commands = randomCommands(rng, count)
+                sequenceNumber = encoder.sequenceNumber
+                parsed = self.parse(encoder.encode(commands, 0x89abcdef))
+
+                self.assertEqual(parsed.header.rtp_header.flags.pt, 0x61)
+                self.assertEqual(parsed.header.rtp_header.sequence_number, sequenceNumber)
+                self.assertEqual(parsed.header.timestamp, 0x89abcdef)
+                self.assertEqual(parsed.header.ssrc, SSRC)
+                self.assertEqual(parsed.command.flags.b, parsed.command.flags.len > 15)
+                self.assertCommands(parsed, commands)
+        self.assertLess(encoder.sequenceNumber, 65530) # Wrapped
+
+    #
+    # pymidi reads delta times least significant byte first (construct's
+    # VarInt) so a delta time of 128 or more comes out as something else.
+    # Anything we send to a pymidi based peer with long delta times is read
+    # wrongly there - this is here to tell us if pymidi changes.
+    #
+    def testLongDeltaTimes(self):
+        commands = [(0, NOTE_ON, (60, 100)), (200, NOTE_ON, (64, 100)), (20, NOTE_ON, (67, 100))]
+        parsed = self.parse(PacketEncoder(SSRC).encode(commands, 0))
+
+        self.assertEqual([int(command.params.key) for command in parsed.command.midi_list], [60, 64, 67])
+        self.assertEqual(parsed.command.midi_list[1].delta_time, 0x01 | 0x48 << 7) # Our 0x81 0x48 backwards
+        self.assertEqual(parsed.command.midi_list[2].delta_time, 20)
+
+    def testJournal(self):
+        journal = bytes([0x00, 0x12, 0x34]) # No chapters, checkpoint 0x1234
+        parsed = self.parse(PacketEncoder(SSRC).encode([(0, NOTE_ON, (60, 100))], 0, journal))
+        self.assertTrue(parsed.command.flags.j)
+        self.assertEqual(parsed.journal.checkpoint_seqnum, 0x1234)
+
+    def testEncodeAll(self):
+        rng = random.Random(2)
+        commands = randomCommands(rng, 2000, maxDelta=10)
+        found = []
+        timestamps = []
+        for packet in PacketEncoder(SSRC).encodeAll(commands, 1000):
+            self.assertLessEqual(len(packet), RTP_HEADER.size+2+DEFAULT_BUDGET)
+            parsed = self.parse(packet)
+            timestamps.append(parsed.header.timestamp)
+            found.extend(midiCommand(command) for command in parsed.command.midi_list)
+
+        self.assertGreater(len(timestamps), 1)
+        self.assertEqual([(status, list(data)) for deltaTime, status, data in found],
+                         [(status, list(data)) for deltaTime, status, data in commands])
+
+        #
+        # Each packet's timestamp is the time of its first command
+        #
+        times = []
+        now = 1000
+        for index, (deltaTime, status, data) in enumerate(commands):
+            if index: now += deltaTime
+            times.append(now)
+        starts = []
+        index = 0
+        for packet in PacketEncoder(SSRC).encodeAll(commands, 1000):
+            starts.append(times[index])
+            index += len(self.parse(packet).command.midi_list)
+        self.assertEqual(timestamps, starts)
+
+    def testBatcher(self):
+        sent = []
+        batcher = CommandBatcher(PacketEncoder(SSRC), lambda packet: sent.append(self.parse(packet)), window=60)
+        for index in range(5):
+            batcher.add(NOTE_ON, (60+index, 100), now=5000+index*7)
+        self.assertEqual(sent, [])
+        self.assertGreater(batcher.timeout(), 0)
+
+        batcher.flush()
+        self.assertEqual(len(sent), 1)
+        self.assertIsNone(batcher.timeout())
+        self.assertEqual(sent[0].header.timestamp, 5000)
+        self.assertEqual([command.delta_time or 0 for command in sent[0].command.midi_list], [0, 7, 7, 7, 7])
+
+        batcher.window = 0
+        batcher.add(NOTE_OFF, (60, 0))
+        self.assertEqual(len(sent), 2)
+
+if __name__ == '__main__':
+    unittest.main()
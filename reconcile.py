@@ -0,0 +1,103 @@
+#
+# reconcile.py
+#  Compares the connections (ALSA subscriptions) that should exist between
+#  the participants on each MIDI daemon (see routing.py) with the
+#  connections that actually exist and makes only the changes needed.
+#
+#  Previously we ran "aconnect" for every pair of participants every few
+#  seconds whether or not they were already connected. Now nothing happens
+#  at all unless someone has joined, left or been renamed.
+#
+#  We consider ourselves to own every connection between two participants
+#  on the same daemon and between a participant and our own bus ports.
+#  Connections involving anything else (the daemon's Network port, other
+#  daemons, other clients) are left alone.
+#
+
+import os
+import logging
+
+from alsagraph import alsa_midi, openSequencer
+import metrics
+
+class ReconcileResult:
+    def __init__(self):
+        self.added = 0
+        self.removed = 0
+        self.unchanged = 0
+        self.failed = 0
+
+    def changed(self):
+        return self.added or self.removed or self.failed
+
+    def __str__(self):
+        return f'added {self.added} removed {self.removed} unchanged {self.unchanged} failed {self.failed}'
+
+#
+# Connections that currently exist between participants on this client, or
+# between its participants and one of our bus ports (see hubbus.py) - these
+# are the ones we manage.
+#
+def managedConnections(graph, client, busAddresses=()):
+    participants = client.participants
+    managed = set()
+    for source, dest in graph.subscriptions:
+        if source.clientId == client.clientId and source.portId in participants:
+            if dest in busAddresses or (dest.clientId == client.clientId and dest.portId in participants):
+                managed.add((source, dest))
+        elif source in busAddresses and dest.clientId == client.clientId and dest.portId in participants:
+            managed.add((source, dest))
+    return managed
+
+#
+# desired is a set of (source, destination) address pairs across all of the
+# hub's clients. Anything we manage that isn't in there is removed; anything
+# in there that doesn't exist yet is added.
+#
+def reconcile(graph, desired, result=None, busAddresses=()):
+    logger = logging.getLogger()
+    if result is None: result = ReconcileResult()
+
+    actual = set()
+    for client in graph.hubClients():
+        actual |= managedConnections(graph, client, busAddresses)
+
+    toAdd = desired-actual
+    toRemove = actual-desired
+    result.unchanged += len(desired & actual)
+
+    for source, dest in toRemove:
+        logger.debug(f'  Removing connection {source[0]}:{source[1]} to {dest[0]}:{dest[1]}')
+        if disconnect(source, dest): result.removed += 1
+        else: result.failed += 1
+
+    for source, dest in toAdd:
+        logger.debug(f'  Adding connection {source[0]}:{source[1]} to {dest[0]}:{dest[1]}')
+        if connect(source, dest): result.added += 1
+        else: result.failed += 1
+
+    return result
+
+def connect(source, dest):
+    if alsa_midi is None:
+        metrics.subprocessInvocations.inc()
+        return os.system(f'aconnect {source[0]}:{source[1]} {dest[0]}:{dest[1]} >/dev/null 2>&1') == 0
+
+    try:
+        openSequencer().subscribe_port(tuple(source), tuple(dest))
+    except Exception as e:
+        logging.getLogger().warning(f'Failed to connect {source[0]}:{source[1]} to {dest[0]}:{dest[1]}: {e}')
+        return False
+    return True
+
+def disconnect(source, dest):
+    if alsa_midi is None:
+        metrics.subprocessInvocations.inc()
+        return os.system(f'aconnect -d {source[0]}:{source[1]} {dest[0]}:{dest[1]} >/dev/null 2>&1') == 0
+
+    try:
+        openSequencer().unsubscribe_port(tuple(source), tuple(dest))
+    except Exception as e:
+        logging.getLogger().warning(f'Failed to disconnect {source[0]}:{source[1]} from {dest[0]}:{dest[1]}: {e}')
+        return False
+    return True
@@ -0,0 +1,183 @@
+#
+# routing.py
+#  Decides which participants in a room (one MIDI daemon) are connected to
+#  which. The rules come from the "routing" section of midihub.json:
+#
+#   {"routing": {
+#      "policy": "suffix",
+#      "rules": [{"from": "*Drums*", "to": "*", "action": "deny", "priority": 20},
+#                {"from": "re:^Teacher", "to": "*In", "priority": 10}],
+#      "deny": [["Alice Out", "Bob In"]],
+#      "rooms": {"5006": {"policy": "all"},
+#                "5008": {"policy": "rules", "rules": [...]}}}}
+#
+#  policy:   The rules every room starts with. "suffix" (the default)
+#            connects participants whose names end in "Out" or "Sen" to
+#            participants whose names end in "In" or "Rec"; "all" connects
+#            everyone to everyone else (the same as --connectall, which
+#            changes the default); "rules" starts with nothing.
+#  rules:    "from" and "to" are shell style patterns (case insensitive) or
+#            regular expressions if they start with "re:"; either can be a
+#            list. "action" is "allow" (the default) or "deny". The highest
+#            priority matching rule decides; deny wins a tie. The policy's
+#            own rules have priority 0 and other rules default to 10.
+#  allow, deny: Explicit [from, to] pairs of participant names. These
+#            override everything else.
+#  rooms:    Per room settings keyed by UDP port (or the full name after
+#            "midiHub-"). A room's policy replaces the hub's; its rules,
+#            allow and deny are added to the hub's.
+#
+#  Patterns are compiled once when the configuration is loaded. For each
+#  participant name we work out (once) which rules it matches as a sender
+#  and as a receiver and keep that as a bitmask, so deciding whether two
+#  participants are connected is a single AND. The connections for a room
+#  are kept until the participants in it change.
+#
+
+import re
+import fnmatch
+import logging
+
+from alsagraph import Address
+
+DEFAULT_PRIORITY = 10
+EXPLICIT_PRIORITY = 1000000
+MAX_CACHED_NAMES = 10000
+
+POLICY_RULES = {
+    'suffix': [{'from': ['*out', '*sen'], 'to': ['*in', '*rec'], 'priority': 0}],
+    'all': [{'from': '*', 'to': '*', 'priority': 0}],
+    'rules': [],
+}
+
+class Rule:
+    def __init__(self, config):
+        if not isinstance(config, dict): raise ValueError(f'Rule must be an object: {config}')
+
+        self.sources = compilePatterns(config.get('from', '*'))
+        self.destinations = compilePatterns(config.get('to', '*'))
+        self.priority = int(config.get('priority', DEFAULT_PRIORITY))
+        self.action = config.get('action', 'allow')
+        if self.action not in ('allow', 'deny'): raise ValueError(f'Unknown rule action {self.action}')
+
+    def matchesSource(self, name):
+        return any(pattern.fullmatch(name) for pattern in self.sources)
+
+    def matchesDestination(self, name):
+        return any(pattern.fullmatch(name) for pattern in self.destinations)
+
+#
+# Shell style patterns are turned into regular expressions so everything is
+# matched the same way. Names are matched in full, ignoring case.
+#
+def compilePatterns(patterns):
+    if isinstance(patterns, str): patterns = [patterns]
+    compiled = []
+    for pattern in patterns:
+        if not isinstance(pattern, str): raise ValueError(f'Pattern must be a string: {pattern}')
+        if pattern.startswith('re:'):
+            compiled.append(re.compile(pattern[3:], re.IGNORECASE))
+        else:
+            compiled.append(re.compile(fnmatch.translate(pattern), re.IGNORECASE))
+    return compiled
+
+#
+# The rules for one room, sorted so that the first matching rule is the one
+# that decides. Each participant name maps to two bitmasks of the rules it
+# matches - bit n set means it matches rule n.
+#
+class RoomPolicy:
+    def __init__(self, rules):
+        self.rules = sorted(rules, key=lambda rule: (-rule.priority, rule.action != 'deny'))
+        self.names = {}
+        self.participants = None
+        self.connections = set()
+
+    def masks(self, name):
+        masks = self.names.get(name)
+        if masks: return masks
+
+        if len(self.names) >= MAX_CACHED_NAMES: self.names.clear()
+        sourceMask = 0
+        destinationMask = 0
+        for index, rule in enumerate(self.rules):
+            if rule.matchesSource(name): sourceMask |= 1 << index
+            if rule.matchesDestination(name): destinationMask |= 1 << index
+        masks = (sourceMask, destinationMask)
+        self.names[name] = masks
+        return masks
+
+    def allowed(self, sourceName, destName):
+        matches = self.masks(sourceName)[0] & self.masks(destName)[1]
+        if not matches: return False
+        return self.rules[(matches & -matches).bit_length()-1].action == 'allow'
+
+    #
+    # (source, destination) address pairs for a client. Only worked out again
+    # if the participants have changed since last time.
+    #
+    def desiredConnections(self, client):
+        participants = client.participants
+        key = (client.clientId, frozenset(participants.items()))
+        if key == self.participants: return self.connections
+
+        desired = set()
+        for sourceId, sourceName in participants.items():
+            for destId, destName in participants.items():
+                if sourceId == destId: continue
+                if self.allowed(sourceName, destName):
+                    desired.add((Address(client.clientId, sourceId), Address(client.clientId, destId)))
+
+        self.participants = key
+        self.connections = desired
+        return desired
+
+class Router:
+    #
+    # config is the "routing" section of the configuration; connectAll is
+    # --connectall which makes "all" the default policy
+    #
+    def __init__(self, config=None, connectAll=False):
+        self.logger = logging.getLogger()
+        if config is None: config = {}
+        if not isinstance(config, dict): raise ValueError('routing must be an object')
+
+        self.defaultPolicy = config.get('policy', 'all' if connectAll else 'suffix')
+        self.hubRules = self._rules(config)
+
+        self.roomConfigs = config.get('rooms', {})
+        if not isinstance(self.roomConfigs, dict): raise ValueError('rooms must be an object')
+        for roomName, roomConfig in self.roomConfigs.items():
+            self._rules(roomConfig) # Check it now rather than when someone joins
+
+        self.rooms = {}
+
+    def policyFor(self, hubName):
+        policy = self.rooms.get(hubName)
+        if policy: return policy
+
+        roomConfig = self.roomConfigs.get(hubName) or self.roomConfigs.get(hubName.rsplit('-', 1)[-1]) or {}
+        policyName = roomConfig.get('policy', self.defaultPolicy)
+        rules = [Rule(rule) for rule in POLICY_RULES[policyName]]+self.hubRules+self._rules(roomConfig)
+
+        policy = RoomPolicy(rules)
+        self.rooms[hubName] = policy
+        self.logger.info(f'Routing for {hubName}: policy {policyName} with {len(rules)} rules')
+        return policy
+
+    def desiredConnections(self, client):
+        return self.policyFor(client.hubName).desiredConnections(client)
+
+    def _rules(self, config):
+        if not isinstance(config, dict): raise ValueError(f'Routing settings must be an object: {config}')
+        policyName = config.get('policy', self.defaultPolicy)
+        if policyName not in POLICY_RULES: raise ValueError(f'Unknown routing policy {policyName}')
+
+        rules = [Rule(rule) for rule in config.get('rules', [])]
+        for action in ('allow', 'deny'):
+            for pair in config.get(action, []):
+                if not isinstance(pair, (list, tuple)) or len(pair) != 2:
+                    raise ValueError(f'{action} entries must be [from, to] pairs: {pair}')
+                rules.append(Rule({'from': re.escape(pair[0]).join(['re:^', '$']), 'to': re.escape(pair[1]).join(['re:^', '$']),
+                                   'action': action, 'priority': EXPLICIT_PRIORITY}))
+        return rules
@@ -0,0 +1,205 @@
+#
+# rtpmidictl.py
+#  Client for the control socket that each rtpmidid daemon opens (midihub.py
+#  starts them with "--control control-{port}.sock").
+#
+#  The daemon speaks JSON over a Unix socket - one request per line:
+#   {"method": "status", "params": [], "id": 1}
+#  and replies with one line:
+#   {"id": 1, "result": {...}}
+#  The status result tells us the daemon's version, its peers (remote
+#  participants) and the latency to each of them - which is a lot easier
+#  (and cheaper) than finding the same information with ps, aconnect or by
+#  grepping the daemon's logs.
+#
+#  ControlClient is asyncio based and keeps its connection open between
+#  calls. ControlHub runs a set of them (one per daemon) in a background
+#  thread for long running processes like midihub.py; queryStatus() is a
+#  one-shot helper for scripts.
+#
+
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+
+#
+# Configuration:
+#  CONTROL_TIMEOUT:
+#      How long (seconds) to wait to connect to a daemon and for each reply.
+#
+CONTROL_TIMEOUT = 2
+
+class ControlError(Exception):
+    pass
+
+def socketPath(port, directory='.'):
+    return os.path.join(directory, f'control-{port}.sock')
+
+#
+# The same comma-separated list of ports that midihub.py reads
+#
+def portsFromFile(filename, default=[]):
+    try:
+        with open(filename) as portsFile:
+            return [int(port) for port in portsFile.read().split(',') if port.strip()]
+    except (OSError, ValueError):
+        return default
+
+class ControlClient:
+    def __init__(self, path, timeout=CONTROL_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.lock = None
+        self.requestId = 0
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_unix_connection(self.path), self.timeout)
+
+    async def close(self):
+        if not self.writer: return
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+        self.reader = None
+        self.writer = None
+
+    #
+    # Send a request and wait for the reply. If the connection has gone away
+    # (for example the daemon was restarted) we reconnect and try once more.
+    #
+    async def call(self, method, params=None):
+        if self.lock is None: self.lock = asyncio.Lock()
+
+        async with self.lock:
+            for attempt in range(2):
+                try:
+                    if not self.writer: await self.connect()
+
+                    self.requestId += 1
+                    request = {'method':method, 'params':params if params is not None else [], 'id':self.requestId}
+                    self.writer.write(json.dumps(request).encode()+b'\n')
+                    await self.writer.drain()
+
+                    line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+                    if not line: raise ConnectionError('control socket closed')
+                    response = json.loads(line)
+                    break
+                except (OSError, ConnectionError, asyncio.TimeoutError, ValueError) as e:
+                    await self.close()
+                    if attempt: raise ControlError(f'{self.path}: {e}')
+
+        if response.get('error'):
+            raise ControlError(f'{self.path}: {response["error"]}')
+        return response.get('result')
+
+    async def status(self):
+        return await self.call('status')
+
+#
+# Pull the peers out of a status reply. Newer versions of rtpmidid list them
+# under "router" with the details in "peer" (the router also lists local
+# things like the ALSA listener, which have no remote end and are skipped);
+# older ones under "peers". Either way we return a list of
+# {'name', 'status', 'latency'} with latency in ms (or None if the daemon
+# hasn't measured it yet).
+#
+def peers(status):
+    result = []
+    if not isinstance(status, dict): return result
+
+    if 'router' in status:
+        items = [item.get('peer') for item in status['router'] if isinstance(item, dict)]
+    else:
+        items = status.get('peers', [])
+
+    for peer in items:
+        if not isinstance(peer, dict): continue
+        remote = peer.get('remote') if isinstance(peer.get('remote'), dict) else {}
+
+        name = remote.get('name') or peer.get('name')
+        if not name: continue
+
+        latency = peer.get('latency_ms')
+        try:
+            latency = float(latency) if latency is not None else None
+        except (TypeError, ValueError):
+            latency = None
+
+        result.append({'name':name, 'status':peer.get('status', ''), 'latency':latency})
+    return result
+
+#
+# One-shot status query of several daemons at once. Returns port: status
+# with None for any daemon that didn't answer.
+#
+def queryStatus(ports, directory='.', timeout=CONTROL_TIMEOUT):
+    async def queryOne(port):
+        client = ControlClient(socketPath(port, directory), timeout)
+        try:
+            return await client.status()
+        except ControlError as e:
+            logging.getLogger().warning(f'No status from daemon on port {port}: {e}')
+            return None
+        finally:
+            await client.close()
+
+    async def queryAll():
+        results = await asyncio.gather(*[queryOne(port) for port in ports])
+        return dict(zip(ports, results))
+
+    return asyncio.run(queryAll())
+
+#
+# Runs an asyncio loop in a thread with a persistent ControlClient for each
+# daemon. probe() doesn't block - the results turn up in self.results as
+# port: (time, status) with status None if the daemon didn't answer.
+#
+class ControlHub(threading.Thread):
+    def __init__(self, directory='.', timeout=CONTROL_TIMEOUT):
+        threading.Thread.__init__(self, daemon=True)
+        self.directory = directory
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.clients = {}
+        self.results = {}
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def call(self, port, method, params=None):
+        future = asyncio.run_coroutine_threadsafe(self._call(port, method, params), self.loop)
+        return future.result(self.timeout*2+1)
+
+    def probe(self, ports):
+        for port in ports:
+            asyncio.run_coroutine_threadsafe(self._probe(port), self.loop)
+
+    def forget(self, port):
+        asyncio.run_coroutine_threadsafe(self._forget(port), self.loop)
+        self.results.pop(port, None)
+
+    async def _call(self, port, method, params):
+        client = self.clients.get(port)
+        if not client:
+            client = ControlClient(socketPath(port, self.directory), self.timeout)
+            self.clients[port] = client
+        return await client.call(method, params)
+
+    async def _probe(self, port):
+        try:
+            status = await self._call(port, 'status', None)
+        except ControlError:
+            status = None
+        self.results[port] = (time.monotonic(), status)
+
+    async def _forget(self, port):
+        client = self.clients.pop(port, None)
+        if client: await client.close()
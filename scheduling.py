@@ -0,0 +1,157 @@
+#
+# scheduling.py
+#  Where and how urgently the rtpmidid daemons run compared with everything
+#  else on the hub (midihub.py itself, the cron jobs, the rest of the OS).
+#
+#  The profile comes from the "scheduling" section of midihub.json:
+#   {"scheduling": {"cpus": "auto", "policy": "fifo", "priority": 10,
+#                   "housekeepingNice": 10, "housekeepingIoClass": "idle"}}
+#
+#  cpus:               "auto" spreads the daemons across the CPUs we are
+#                      allowed to use, keeping the first one for
+#                      housekeeping; a dictionary of port: [cpus] pins them
+#                      by hand; "none" leaves them to float.
+#  housekeepingCpus:   CPUs for midihub.py itself (default: the one "auto"
+#                      kept back, or anywhere).
+#  policy, priority:   "other" (normal), "fifo" or "rr" with a real-time
+#                      priority of 1-99 for the daemons.
+#  daemonNice:         nice value for the daemons (default 0).
+#  housekeepingNice:   nice value for midihub.py.
+#  housekeepingIoClass: "best-effort" or "idle" I/O class for midihub.py.
+#
+#  The daemons are forked from midihub.py so they inherit its settings;
+#  applyToDaemon() runs in the child just before it starts the daemon and
+#  puts back what the daemon should have. The daemons do almost no disk I/O
+#  of their own (their logs are written back by the kernel) so we don't
+#  bother resetting the I/O class.
+#
+#  Real-time scheduling and lowering the nice value need CAP_SYS_NICE (see
+#  midihub.service). Without it those settings are reported and ignored
+#  rather than half applied.
+#
+
+import os
+import logging
+import subprocess
+
+import metrics
+
+POLICIES = {'other': os.SCHED_OTHER, 'fifo': os.SCHED_FIFO, 'rr': os.SCHED_RR}
+IO_CLASSES = {'best-effort': '2', 'idle': '3'}
+CAP_SYS_NICE = 23
+
+class SchedulingProfile:
+    #
+    # config is the "scheduling" section of the configuration; cpus is the
+    # set of CPUs we may use (default: whatever we are allowed to run on now)
+    #
+    def __init__(self, config=None, cpus=None):
+        self.logger = logging.getLogger()
+        if config is None: config = {}
+        if not isinstance(config, dict): raise ValueError('scheduling must be an object')
+
+        self.available = sorted(cpus if cpus is not None else os.sched_getaffinity(0))
+        self.cpus = config.get('cpus', 'auto')
+        if self.cpus not in ('auto', 'none') and not isinstance(self.cpus, dict):
+            raise ValueError(f'cpus must be "auto", "none" or an object, not {self.cpus}')
+
+        self.housekeepingCpus = config.get('housekeepingCpus')
+        if self.housekeepingCpus is not None: self.housekeepingCpus = self._cpuList(self.housekeepingCpus)
+
+        self.policy = config.get('policy', 'other')
+        if self.policy not in POLICIES: raise ValueError(f'Unknown scheduling policy {self.policy}')
+        self.priority = int(config.get('priority', 10 if self.policy != 'other' else 0))
+        if self.policy != 'other' and not 1 <= self.priority <= 99:
+            raise ValueError(f'Real-time priority must be 1-99, not {self.priority}')
+
+        self.daemonNice = int(config.get('daemonNice', 0))
+        self.housekeepingNice = config.get('housekeepingNice')
+        if self.housekeepingNice is not None: self.housekeepingNice = int(self.housekeepingNice)
+        self.housekeepingIoClass = config.get('housekeepingIoClass')
+        if self.housekeepingIoClass is not None and self.housekeepingIoClass not in IO_CLASSES:
+            raise ValueError(f'Unknown I/O class {self.housekeepingIoClass}')
+
+        #
+        # Anything we aren't allowed to do is turned off here so that the
+        # daemons don't end up with some settings and not others.
+        #
+        privileged = hasSysNice()
+        if self.policy != 'other' and not privileged:
+            self.logger.warning(f'No CAP_SYS_NICE - not using {self.policy} scheduling for midi daemons')
+            self.policy = 'other'
+            self.priority = 0
+        if self.housekeepingNice is not None and self.housekeepingNice > self.daemonNice and not privileged:
+            self.logger.warning('No CAP_SYS_NICE - daemons could not undo housekeeping nice value so not setting it')
+            self.housekeepingNice = None
+
+        self.layout = {}
+        self.defaultCpus = self.available
+
+    #
+    # Work out which CPUs each port's daemon (and midihub.py) runs on
+    #
+    def plan(self, ports):
+        self.layout = {}
+        daemonCpus = self.available
+
+        if self.cpus == 'auto' and len(self.available) > 1:
+            if self.housekeepingCpus is None: self.housekeepingCpus = self.available[:1]
+            daemonCpus = [cpu for cpu in self.available if cpu not in self.housekeepingCpus] or self.available
+            for index, port in enumerate(sorted(ports)):
+                self.layout[port] = [daemonCpus[index%len(daemonCpus)]]
+        elif isinstance(self.cpus, dict):
+            for port in ports:
+                cpus = self.cpus.get(str(port))
+                if cpus is not None: self.layout[port] = self._cpuList(cpus)
+
+        self.defaultCpus = daemonCpus
+
+    def daemonCpus(self, port):
+        return self.layout.get(port, self.defaultCpus)
+
+    #
+    # pid 0 means the calling process - which is how this is used in the
+    # child before it runs the daemon. Raises OSError if the kernel says no.
+    #
+    def applyToDaemon(self, port, pid=0):
+        os.sched_setaffinity(pid, self.daemonCpus(port))
+        os.sched_setscheduler(pid, POLICIES[self.policy], os.sched_param(self.priority))
+        if self.policy == 'other': os.setpriority(os.PRIO_PROCESS, pid, self.daemonNice)
+
+    def applyHousekeeping(self):
+        if self.housekeepingCpus:
+            os.sched_setaffinity(0, self.housekeepingCpus)
+        if self.housekeepingNice is not None:
+            os.setpriority(os.PRIO_PROCESS, 0, self.housekeepingNice)
+        if self.housekeepingIoClass:
+            metrics.subprocessInvocations.inc()
+            subprocess.run(['ionice', '-c', IO_CLASSES[self.housekeepingIoClass], '-p', str(os.getpid())], check=True)
+
+    def report(self):
+        self.logger.info(f'Scheduling: daemons {self.policy} priority {self.priority} nice {self.daemonNice}; '
+                         f'housekeeping CPUs {self.housekeepingCpus or "any"} nice {self.housekeepingNice} I/O {self.housekeepingIoClass or "default"}')
+        for port in sorted(self.layout):
+            self.logger.info(f'  port {port}: CPUs {self.layout[port]}')
+        if not self.layout:
+            self.logger.info(f'  all ports: CPUs {self.defaultCpus}')
+
+    def _cpuList(self, cpus):
+        if isinstance(cpus, int): cpus = [cpus]
+        cpus = [int(cpu) for cpu in cpus]
+        for cpu in cpus:
+            if cpu not in self.available: raise ValueError(f'CPU {cpu} is not available (have {self.available})')
+        return cpus
+
+#
+# Are we allowed to use real-time scheduling and lower nice values?
+#
+def hasSysNice():
+    if os.geteuid() == 0: return True
+    try:
+        with open('/proc/self/status') as statusFile:
+            for line in statusFile:
+                if line.startswith('CapEff:'):
+                    return bool(int(line.split()[1], 16) & (1 << CAP_SYS_NICE))
+    except (OSError, ValueError):
+        pass
+    return False
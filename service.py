@@ -0,0 +1,62 @@
+#
+# service.py
+#  Bits and pieces for running midihub.py as a long running (systemd) service
+#  rather than having cron start it every minute.
+#
+#  acquireLock() makes sure only one copy runs. It uses flock() on a file so
+#  it costs a single system call and the lock goes away by itself if the
+#  process dies - no stale pid files to clean up. This module deliberately
+#  only imports things that are already loaded when Python starts so that it
+#  can be used before anything expensive is imported.
+#
+#  notify() sends status messages to systemd (see sd_notify(3)) when we are
+#  started by it with Type=notify; if we aren't it does nothing.
+#
+
+import os
+import socket
+import fcntl
+
+#
+# Returns the open lock file (keep hold of it - closing it releases the
+# lock) or None if another process already has the lock.
+#
+def acquireLock(filename):
+    lockFile = open(filename, 'a')
+    try:
+        fcntl.flock(lockFile, fcntl.LOCK_EX|fcntl.LOCK_NB)
+    except OSError:
+        lockFile.close()
+        return None
+
+    lockFile.truncate(0)
+    lockFile.write(f'{os.getpid()}\n')
+    lockFile.flush()
+    return lockFile
+
+def notify(state):
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address: return False
+
+    if address[0] == '@': address = '\0'+address[1:] # Abstract namespace socket
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notifySocket:
+            notifySocket.sendto(state.encode(), address)
+    except OSError:
+        return False
+    return True
+
+#
+# How often (in seconds) we should tell systemd we're still alive, or None
+# if the watchdog isn't enabled for us. systemd wants to hear from us within
+# WATCHDOG_USEC; we ping at half that to be safe.
+#
+def watchdogInterval():
+    usec = os.environ.get('WATCHDOG_USEC')
+    if not usec: return None
+
+    watchdogPid = os.environ.get('WATCHDOG_PID')
+    if watchdogPid and int(watchdogPid) != os.getpid(): return None
+
+    return int(usec)/1000000/2
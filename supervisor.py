@@ -0,0 +1,341 @@
+#
+# supervisor.py
+#  Keeps track of the rtpmidid processes that midihub.py starts so that we
+#  don't have to go looking for them with "ps" every few seconds.
+#
+#  Each daemon is forked from here so we know its process id. When it exits
+#  the kernel sends us SIGCHLD; the main loop wakes up, calls reap() and we
+#  restart the daemon straight away. If a daemon keeps dying we back off
+#  exponentially and if it dies too many times in a short period we decide
+#  it is in a crash loop and leave it alone for a while rather than burning
+#  CPU restarting it.
+#
+#  Daemons that were already running when we started (for example if
+#  midihub.py itself was restarted) are "adopted" - they aren't our children
+#  so we can't wait for them; instead we watch them with a pidfd where the
+#  kernel supports it or check every ADOPTED_POLL_INTERVAL seconds that they
+#  are still there.
+#
+
+import os
+import sys
+import time
+import logging
+import selectors
+
+#
+# Configuration:
+#  RESTART_BACKOFF_START:
+#      Delay (in seconds) before the second and subsequent restarts of a
+#      daemon that keeps failing. The first restart is always immediate.
+#  RESTART_BACKOFF_MAX:
+#      Upper limit for the exponential backoff.
+#  STABLE_RUN_TIME:
+#      A daemon that has been running for this long is considered healthy
+#      again and its backoff is reset.
+#  CRASH_LOOP_COUNT, CRASH_LOOP_WINDOW:
+#      If a daemon exits this many times within this many seconds it is in
+#      a crash loop.
+#  CRASH_LOOP_HOLDOFF:
+#      How long to leave a crash looping daemon alone before trying again.
+#  STOP_TIMEOUT:
+#      How long a daemon that we have asked to stop (SIGTERM) gets before it
+#      is killed.
+#  ADOPTED_POLL_INTERVAL:
+#      How often to check that an adopted daemon we can't watch with a pidfd
+#      is still running.
+#
+RESTART_BACKOFF_START = 0.5
+RESTART_BACKOFF_MAX = 30
+STABLE_RUN_TIME = 60
+CRASH_LOOP_COUNT = 5
+CRASH_LOOP_WINDOW = 60
+CRASH_LOOP_HOLDOFF = 300
+STOP_TIMEOUT = 5
+ADOPTED_POLL_INTERVAL = 5
+
+class Daemon:
+    def __init__(self, port):
+        self.port = port
+        self.pid = None
+        self.pidfd = None
+        self.adopted = False
+        self.stopping = False
+        self.stopDeadline = None
+        self.startTime = None
+        self.restarts = 0
+        self.failures = 0
+        self.crashTimes = []
+        self.nextStart = 0
+        self.lastExit = None
+
+    def uptime(self):
+        if not self.pid or self.startTime is None: return 0
+        return time.monotonic()-self.startTime
+
+class Supervisor:
+    #
+    # daemonPath = the binary we are running
+    # commandFor = function that takes a port number and returns the argument
+    #              list to run the daemon with (including argv[0])
+    # selector   = the main loop's selector; we register pidfds for adopted
+    #              daemons with it so we hear about them exiting
+    # onRestart  = optional function called with the port number each time
+    #              a daemon is restarted
+    # prepareChild = optional function called with the port number in the
+    #              forked child just before the daemon is run
+    #
+    def __init__(self, daemonPath, commandFor, selector, onRestart=None, prepareChild=None):
+        self.logger = logging.getLogger()
+        self.daemonPath = daemonPath
+        self.daemonName = os.path.basename(daemonPath)
+        self.commandFor = commandFor
+        self.selector = selector
+        self.onRestart = onRestart
+        self.prepareChild = prepareChild
+        self.daemons = {}
+        self.lastReap = 0
+
+    #
+    # Look through /proc (once, at startup) for copies of the daemon that are
+    # already running on our ports and take them over rather than starting
+    # another one that would fail to bind to the UDP port.
+    #
+    def adoptRunning(self, ports):
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit(): continue
+            try:
+                with open(f'/proc/{entry}/cmdline', 'rb') as cmdlineFile:
+                    cmdline = cmdlineFile.read().split(b'\0')
+            except OSError:
+                continue
+
+            if os.path.basename(cmdline[0]).decode(errors='replace') != self.daemonName: continue
+            try:
+                port = int(cmdline[cmdline.index(b'--port')+1])
+            except (ValueError, IndexError):
+                continue
+            if port not in ports or port in self.daemons: continue
+
+            daemon = Daemon(port)
+            daemon.pid = int(entry)
+            daemon.adopted = True
+            daemon.startTime = time.monotonic()
+            self.daemons[port] = daemon
+            self._watch(daemon)
+            self.logger.info(f'Adopted running midi daemon on port {port} (pid {daemon.pid})')
+
+    def add(self, port):
+        if port in self.daemons: return
+        self.daemons[port] = Daemon(port)
+
+    #
+    # Stop supervising a port and terminate its daemon. reap() will clean up
+    # after it once it has actually gone, killing it if it is still there
+    # after STOP_TIMEOUT. The port can't be added again until then.
+    #
+    def remove(self, port):
+        daemon = self.daemons.get(port)
+        if not daemon: return
+
+        daemon.stopping = True
+        if not daemon.pid:
+            del self.daemons[port]
+            return
+
+        self.logger.info(f'Stopping midi daemon on port {port} (pid {daemon.pid})')
+        daemon.stopDeadline = time.monotonic()+STOP_TIMEOUT
+        try:
+            os.kill(daemon.pid, 15)
+        except ProcessLookupError:
+            pass
+
+    #
+    # Stop every daemon when we are shutting down. Waits up to timeout
+    # seconds for them to exit and then kills any that are left.
+    #
+    def stopAll(self, timeout):
+        for port in list(self.daemons):
+            self.remove(port)
+
+        deadline = time.monotonic()+timeout
+        while self.daemons and time.monotonic() < deadline:
+            time.sleep(0.1)
+            self.reap()
+
+        for daemon in list(self.daemons.values()):
+            self.logger.warning(f'Midi daemon on port {daemon.port} did not stop - killing it')
+            try:
+                os.kill(daemon.pid, 9)
+            except ProcessLookupError:
+                pass
+            self._exited(daemon, None)
+
+    #
+    # Terminate a daemon that is running but not working properly. It is
+    # restarted in the usual way once it has gone - for an adopted daemon
+    # that's when its pidfd or _alive() in reap() says so, not straight away,
+    # so the new one isn't started before the old one has let go of its port.
+    #
+    def restart(self, port):
+        daemon = self.daemons.get(port)
+        if not daemon or not daemon.pid or daemon.stopping: return
+
+        self.logger.warning(f'Restarting midi daemon on port {port} (pid {daemon.pid})')
+        try:
+            os.kill(daemon.pid, 9)
+        except ProcessLookupError:
+            pass
+
+    #
+    # Start any daemon that isn't running and whose backoff has expired.
+    #
+    def startPending(self):
+        now = time.monotonic()
+        for daemon in list(self.daemons.values()):
+            if daemon.pid or daemon.stopping: continue
+            if daemon.nextStart > now: continue
+            self._start(daemon)
+
+    #
+    # Returns the monotonic time at which startPending() or reap() next has
+    # something to do, or None if nothing is waiting.
+    #
+    def nextDeadline(self):
+        deadlines = [d.nextStart for d in self.daemons.values() if not d.pid and not d.stopping]
+        deadlines += [d.stopDeadline for d in self.daemons.values() if d.pid and d.stopDeadline]
+        if any(d.pid and d.adopted and d.pidfd is None for d in self.daemons.values()):
+            deadlines.append(self.lastReap+ADOPTED_POLL_INTERVAL)
+        if not deadlines: return None
+        return min(deadlines)
+
+    #
+    # Called from the main loop after SIGCHLD and on each pass (for adopted
+    # daemons that we have to poll). We only wait for our own children by
+    # pid so we don't steal exit statuses from anything else in this process
+    # that runs subprocesses.
+    #
+    def reap(self):
+        self.lastReap = time.monotonic()
+        for daemon in list(self.daemons.values()):
+            if not daemon.pid: continue
+            if daemon.stopDeadline and self.lastReap >= daemon.stopDeadline:
+                self.logger.warning(f'Midi daemon on port {daemon.port} did not stop - killing it')
+                daemon.stopDeadline = None
+                try:
+                    os.kill(daemon.pid, 9)
+                except ProcessLookupError:
+                    pass
+
+            if daemon.adopted:
+                if not self._alive(daemon.pid): self._exited(daemon, None)
+                continue
+
+            try:
+                pid, status = os.waitpid(daemon.pid, os.WNOHANG)
+            except ChildProcessError:
+                pid, status = daemon.pid, None
+            if pid == 0: continue
+            self._exited(daemon, status)
+
+    def status(self):
+        result = {}
+        for port, daemon in self.daemons.items():
+            if daemon.stopping: state = 'stopping'
+            elif daemon.pid: state = 'running'
+            elif daemon.nextStart > time.monotonic(): state = 'backoff'
+            else: state = 'starting'
+            result[port] = {'pid':daemon.pid, 'state':state, 'uptime':round(daemon.uptime()),
+                            'restarts':daemon.restarts, 'lastExit':daemon.lastExit}
+        return result
+
+    def _start(self, daemon):
+        port = daemon.port
+        args = self.commandFor(port)
+
+        pid = os.fork()
+        if pid == 0: # We are the child process
+            try:
+                newStdOut = os.open(f'output-{port}.log', os.O_WRONLY|os.O_CREAT|os.O_APPEND, 0o644)
+                os.dup2(newStdOut, sys.stdout.fileno())
+                os.close(newStdOut)
+                os.close(2) # Close STDERR
+                if self.prepareChild: self.prepareChild(port)
+                os.execv(self.daemonPath, args)
+            finally:
+                os._exit(127)
+
+        if daemon.startTime is not None:
+            daemon.restarts += 1
+            if self.onRestart: self.onRestart(port)
+        daemon.pid = pid
+        daemon.adopted = False
+        daemon.startTime = time.monotonic()
+        self.logger.info(f'Started midi daemon on port {port} (pid {pid}, restarts {daemon.restarts})')
+
+    def _exited(self, daemon, status):
+        now = time.monotonic()
+        runTime = daemon.uptime()
+
+        if status is None:
+            daemon.lastExit = 'unknown'
+        elif os.WIFSIGNALED(status):
+            daemon.lastExit = f'signal {os.WTERMSIG(status)}'
+        else:
+            daemon.lastExit = f'exit {os.WEXITSTATUS(status)}'
+
+        self._unwatch(daemon)
+        daemon.pid = None
+
+        if daemon.stopping:
+            self.logger.info(f'Midi daemon on port {daemon.port} stopped ({daemon.lastExit})')
+            del self.daemons[daemon.port]
+            return
+
+        if runTime >= STABLE_RUN_TIME: daemon.failures = 0
+
+        daemon.crashTimes = [t for t in daemon.crashTimes if now-t < CRASH_LOOP_WINDOW]
+        daemon.crashTimes.append(now)
+
+        if len(daemon.crashTimes) >= CRASH_LOOP_COUNT:
+            delay = CRASH_LOOP_HOLDOFF
+            daemon.crashTimes = []
+            self.logger.error(f'Midi daemon on port {daemon.port} is crash looping - waiting {delay}s before restarting')
+        elif daemon.failures == 0:
+            delay = 0
+        else:
+            delay = min(RESTART_BACKOFF_START*2**(daemon.failures-1), RESTART_BACKOFF_MAX)
+
+        daemon.failures += 1
+        daemon.nextStart = now+delay
+        self.logger.warning(f'Midi daemon on port {daemon.port} exited ({daemon.lastExit}) after {runTime:.1f}s - restarting in {delay}s')
+
+        if delay == 0: self._start(daemon)
+
+    #
+    # Adopted daemons aren't our children so SIGCHLD won't tell us when they
+    # go away. A pidfd becomes readable when the process exits so we can
+    # still react immediately; without one reap() checks for them instead.
+    #
+    def _watch(self, daemon):
+        if not hasattr(os, 'pidfd_open'): return
+        try:
+            daemon.pidfd = os.pidfd_open(daemon.pid)
+        except OSError:
+            return
+        self.selector.register(daemon.pidfd, selectors.EVENT_READ, lambda: self._exited(daemon, None))
+
+    def _unwatch(self, daemon):
+        if daemon.pidfd is None: return
+        self.selector.unregister(daemon.pidfd)
+        os.close(daemon.pidfd)
+        daemon.pidfd = None
+
+    def _alive(self, pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
@@ -0,0 +1,230 @@
+#
+# tablewriter.py
+#  Writes items to the stats table only when they have changed.
+#
+#  update-latency.py and update-participants.py run every minute and most
+#  of the time what they find is the same as last time. ChangeWriter keeps a
+#  digest (a hash of everything but the timestamps) of each item it has
+#  written in a local file and skips items whose digest hasn't changed:
+#
+#   writer = ChangeWriter(backendFor(tableName), 'latency-digest.json')
+#   writer.put({'clientId': 'Fred-5004', ...})
+#   failed = writer.flush()
+#
+#  put() only queues the item; several puts for the same key before a
+#  flush() are coalesced into the last one. An item that changes again
+#  within holdTime seconds of being written is held back until holdTime has
+#  passed (so a burst of changes is one write), and an unchanged item is
+#  written again after refreshInterval so that it doesn't expire (the table
+#  has a TTL on expiryTime).
+#
+#  Writes go in batches of 25; anything DynamoDB hands back as unprocessed
+#  is retried with exponential backoff. Items that still fail are left out
+#  of the digest so that they are tried again next time.
+#
+#  The backend does the actual writing: DynamoDBBackend for real, and
+#  MemoryBackend or SQLiteBackend to try things out without AWS. A table
+#  name of "sqlite:<file>" or "memory:" in the dynamodbtable file picks one
+#  of those instead (see backendFor()).
+#
+#  keyName is the name of the key attribute, or a tuple of names for a
+#  table with a sort key - ('series', 'minute') for the history table.
+#
+
+import os
+import json
+import time
+import random
+import sqlite3
+import hashlib
+import logging
+
+BATCH_SIZE = 25
+MAX_RETRIES = 6
+RETRY_BASE = 0.05
+RETRY_CAP = 2.0
+REFRESH_INTERVAL = 6*3600
+FORGET_AFTER = 86400
+VOLATILE_FIELDS = ('timestamp', 'expiryTime')
+HISTORY_SUFFIX = '-history'
+HISTORY_KEY = ('series', 'minute')
+
+def itemKey(item, keyName):
+    if isinstance(keyName, str): return str(item[keyName])
+    return '#'.join(str(item[name]) for name in keyName)
+
+class DynamoDBBackend:
+    def __init__(self, tableName, client=None):
+        import boto3
+        from boto3.dynamodb.types import TypeSerializer
+
+        self.tableName = tableName
+        self.client = client if client is not None else boto3.client('dynamodb')
+        self.serializer = TypeSerializer()
+
+    #
+    # Returns the items that weren't written
+    #
+    def writeBatch(self, items):
+        requests = [{'PutRequest': {'Item': {name: self.serializer.serialize(value) for name, value in item.items()}}} for item in items]
+        response = self.client.batch_write_item(RequestItems={self.tableName: requests})
+        unprocessed = response.get('UnprocessedItems', {}).get(self.tableName, [])
+        if not unprocessed: return []
+
+        keys = set(json.dumps(request['PutRequest']['Item'], sort_keys=True) for request in unprocessed)
+        return [item for item, request in zip(items, requests) if json.dumps(request['PutRequest']['Item'], sort_keys=True) in keys]
+
+#
+# A dictionary standing in for the table. unprocessedRate is the fraction
+# of items in each batch to hand back as unprocessed, to exercise the retry.
+#
+class MemoryBackend:
+    def __init__(self, keyName='clientId', unprocessedRate=0):
+        self.keyName = keyName
+        self.unprocessedRate = unprocessedRate
+        self.items = {}
+        self.writes = 0
+
+    def writeBatch(self, items):
+        unprocessed = [item for item in items if random.random() < self.unprocessedRate]
+        for item in items:
+            if any(item is failed for failed in unprocessed): continue
+            self.items[itemKey(item, self.keyName)] = dict(item)
+            self.writes += 1
+        return unprocessed
+
+class SQLiteBackend:
+    def __init__(self, filename, keyName='clientId'):
+        self.keyName = keyName
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS items (key TEXT PRIMARY KEY, item TEXT)')
+        self.connection.commit()
+
+    def writeBatch(self, items):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO items (key, item) VALUES (?, ?)',
+                                        [(itemKey(item, self.keyName), json.dumps(item, sort_keys=True)) for item in items])
+        return []
+
+    def items(self):
+        return {key: json.loads(item) for key, item in self.connection.execute('SELECT key, item FROM items')}
+
+#
+# The latency history lives in a second table next to the main one
+#
+def historyTableName(tableName):
+    if tableName == 'memory:': return tableName
+    return tableName+HISTORY_SUFFIX
+
+#
+# client is a boto3 DynamoDB client to share (and so share its connections)
+# between several writers
+#
+def backendFor(tableName, keyName='clientId', client=None):
+    if tableName.startswith('sqlite:'): return SQLiteBackend(tableName[7:], keyName)
+    if tableName == 'memory:': return MemoryBackend(keyName)
+    return DynamoDBBackend(tableName, client)
+
+def itemDigest(item, volatile=VOLATILE_FIELDS):
+    stable = {name: value for name, value in item.items() if name not in volatile}
+    return hashlib.sha1(json.dumps(stable, sort_keys=True, default=str).encode()).hexdigest()
+
+class ChangeWriter:
+    def __init__(self, backend, digestFile=None, keyName='clientId', holdTime=0, refreshInterval=REFRESH_INTERVAL,
+                 volatile=VOLATILE_FIELDS):
+        self.logger = logging.getLogger()
+        self.backend = backend
+        self.digestFile = digestFile
+        self.keyName = keyName
+        self.holdTime = holdTime
+        self.refreshInterval = refreshInterval
+        self.volatile = volatile
+        self.pending = {}
+        self.digests = self._load()
+        self.skipped = 0
+        self.written = 0
+
+    def put(self, item):
+        self.pending[itemKey(item, self.keyName)] = item
+
+    #
+    # Write whatever has changed. Returns the number of items that couldn't
+    # be written (they stay queued for the next flush).
+    #
+    def flush(self):
+        now = time.time()
+        toWrite = []
+        for key, item in list(self.pending.items()):
+            digest = itemDigest(item, self.volatile)
+            previous = self.digests.get(key)
+            if previous:
+                age = now-previous['written']
+                if previous['digest'] == digest and age < self.refreshInterval:
+                    self.skipped += 1
+                    del self.pending[key]
+                    continue
+                if age < self.holdTime: continue
+            toWrite.append((key, item, digest))
+
+        failed = 0
+        for start in range(0, len(toWrite), BATCH_SIZE):
+            batch = toWrite[start:start+BATCH_SIZE]
+            unprocessed = self._writeWithRetry([item for key, item, digest in batch])
+            for key, item, digest in batch:
+                if any(item is failedItem for failedItem in unprocessed):
+                    failed += 1
+                    continue
+                self.digests[key] = {'digest': digest, 'written': now}
+                del self.pending[key]
+                self.written += 1
+
+        if toWrite: self._save()
+        return failed
+
+    #
+    # Forget anything still queued (returns how many there were)
+    #
+    def drop(self):
+        dropped = len(self.pending)
+        self.pending = {}
+        return dropped
+
+    def _writeWithRetry(self, items):
+        for attempt in range(MAX_RETRIES):
+            try:
+                items = self.backend.writeBatch(items)
+            except Exception as e:
+                self.logger.warning(f'Batch write failed: {e}')
+            if not items: return []
+            time.sleep(random.uniform(0, min(RETRY_CAP, RETRY_BASE*2**attempt)))
+
+        self.logger.error(f'{len(items)} items not written after {MAX_RETRIES} attempts')
+        return items
+
+    def _load(self):
+        if not self.digestFile: return {}
+        try:
+            with open(self.digestFile) as digestFile:
+                return json.load(digestFile)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            self.logger.warning(f'Cannot read {self.digestFile} - writing everything: {e}')
+            return {}
+
+    #
+    # Digests of items that haven't been written for a day (the table will
+    # have expired them) are dropped so neither the file nor a long running
+    # writer (the collector in midihub.py) grows forever
+    #
+    def _save(self):
+        oldest = time.time()-FORGET_AFTER
+        self.digests = {key: entry for key, entry in self.digests.items() if entry['written'] >= oldest}
+
+        if not self.digestFile: return
+        try:
+            with open(self.digestFile+'.tmp', 'w') as digestFile:
+                json.dump(self.digests, digestFile)
+            os.replace(self.digestFile+'.tmp', self.digestFile)
+        except OSError as e:
+            self.logger.warning(f'Cannot save {self.digestFile}: {e}')
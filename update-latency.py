@@ -9,18 +9,53 @@
 #  client name, connected port and latency numbers and puts them into DynamoDB.
 #  Expects there to be a local file called "dynamodbtable" with the name of the
 #  table in it.
-#  Output to DynamoDB is the maximum, minimum and last latency for each client
-#  as well as the current timestamp.
+#  Output to DynamoDB is the last latency for each client, the average,
+#  minimum, maximum and 50th, 90th and 99th percentiles, the jitter and the
+#  current timestamp. The percentiles come from a sketch (see
+#  latencysketch.py) rather than a list of every sample. There is also a
+#  series for each port ("*-5004") with the percentiles of everyone on it.
+#
+#  The numbers go to the history table (the table name with "-history" on
+#  the end) which is keyed by series (client or port) and minute, so the
+#  stats Lambda can fetch the last N minutes of one series with a Query:
+#   {'series': 'Fred-5004', 'minute': 29871234, 'p50Latency': '12.3', ...}
+#  Each run also writes a rollup item for the whole hub with everyone's
+#  current numbers in it, which is what the latency page shows:
+#   {'series': 'hub', 'minute': 29871234, 'clients': '{"Fred-5004": {...}}'}
+#  History is kept for HISTORY_DAYS days. How the items are made is in
+#  latencyreader.py, which the collector in midihub.py uses too - when that
+#  is running there's no need to run this from cron.
+#
+#  With "--control" nothing is read from the pipe; instead each MIDI daemon
+#  listed in the "midiports" file is asked for the current latency of its
+#  peers over its control socket:
+#   update-latency.py --control
+#  That only gives us one sample per client so in this mode only the last
+#  latency is written - the maximum, minimum and average need the logs.
+#
+#  With "--incremental" nothing is read from the pipe either; the daemon
+#  logs (output-{port}.log in the current directory) are read directly but
+#  only from where we got to last time:
+#   update-latency.py --incremental
+#  The inode and offset of each log are kept in "latency-offsets.json".
+#  If a log has been replaced (rotated) we finish reading the old one if it's
+#  still around and start the new one from the beginning; if it has been
+#  truncated we start again from the beginning. Each run only costs as much
+#  as the lines that have been written since the last one. The sketches are
+#  kept in "latency-sketches.json" so the numbers written to DynamoDB are
+#  for the last 15 minutes rather than just for the new lines, and only the
+#  clients that have new samples are written.
 #
 
 import sys
 import logging
-import boto3
 import time
-import sys
+
+import rtpmidictl
+from latencyreader import LatencyTail, addLatency, readLogLatency, historyItems
+from tablewriter import ChangeWriter, backendFor, historyTableName, HISTORY_KEY
 
 logger = None
-dynamodb = boto3.resource('dynamodb')
 
 def main():
     global logger
@@ -39,47 +74,43 @@ def main():
         logger.error(f'Cannot read table name: {e}')
         sys.exit(1)
 
-    ddbTable = dynamodb.Table(tableName)
+    writer = ChangeWriter(backendFor(historyTableName(tableName), HISTORY_KEY), keyName=HISTORY_KEY)
     latencyStats = {}
+    tail = None
+
+    controlMode = '--control' in sys.argv[1:]
+    if controlMode:
+        readControlLatency(latencyStats)
+    elif '--incremental' in sys.argv[1:]:
+        tail = LatencyTail()
+        latencyStats = tail.read()
+    else:
+        readLogLatency(latencyStats, sys.stdin.buffer)
+
+    for item in historyItems(latencyStats, int(time.time()), lastOnly=controlMode):
+        writer.put(item)
+    failed = writer.flush()
+    logger.info(f'Wrote {writer.written} items')
+
+    #
+    # Only move our place in the logs on once the numbers are safely stored
+    # - if the write failed we'll read the same lines again next time.
+    #
+    if tail and not failed: tail.save()
 
-    for line in sys.stdin:
-        latencyMarker = line.find('Latency')
-        outputMarker = line.find('output')
-        msMarker = line.find(' ms')
-
-        if latencyMarker == -1 or outputMarker == -1 or msMarker == -1:
-            logger.warning('No latency info found in input - ignoring')
-            continue
-
-        msNumber = line.index(':', latencyMarker)+2
-        logMarker = line.index('.log')
-
-        try:
-            clientName = line[latencyMarker+8:msNumber-2]
-            latencyValue = float(line[msNumber:msMarker-1])
-            portNumber = int(line[outputMarker+7:logMarker])
-        except Exception as e:
-            logger.error(f'Failed to parse line: {e}')
-            logger.error(line)
-            continue
-
-        id = f'{clientName}-{portNumber}'
-        if id not in latencyStats: latencyStats[id] = []
-        latencyStats[id].append(latencyValue)
-
-    with ddbTable.batch_writer() as batch:
-        for id in latencyStats:
-            average = round(sum(latencyStats[id])/len(latencyStats[id]), 1)
-
-            now = int(time.time())
-            expiry = now+86400
+#
+# Ask each daemon for its peers - each one gives us a single latency sample
+# (the most recent one the daemon has measured).
+#
+def readControlLatency(latencyStats):
+    global logger
 
-            # Need to store floats as strings because DynamoDB doesn't support
-            # float typess here
-            item = {'clientId':id, 'timestamp':now, 'expiryTime':expiry,
-                    'lastLatency':str(latencyStats[id][-1]), 'averageLatency':str(average),
-                    'maxLatency': str(max(latencyStats[id])), 'minLatency':str(min(latencyStats[id]))}
-            batch.put_item(Item=item)
+    ports = rtpmidictl.portsFromFile('midiports', [5004, 5006])
+    for port, status in rtpmidictl.queryStatus(ports).items():
+        if status is None: continue
+        for peer in rtpmidictl.peers(status):
+            if peer['latency'] is None: continue
+            addLatency(latencyStats, peer['name'], port, peer['latency'])
 
 if __name__ == "__main__":
     main()
@@ -4,16 +4,23 @@
 # update-participants.py
 #  Get a list of MIDI participants and drop that into the DynamoDB table
 #
+#  The participants come from each MIDI daemon's control socket. If any of
+#  the daemons don't answer we read the ALSA sequencer graph instead.
+#
+#  The list is only written when it has changed (see tablewriter.py).
+#
 
 import sys
 import logging
-import boto3
-import sys
-import os
 import json
 
+import alsagraph
+import rtpmidictl
+from tablewriter import ChangeWriter, backendFor
+
+DIGEST_FILE = '../participants-digest.json'
+
 logger = None
-dynamodb = boto3.resource('dynamodb')
 
 def main():
     global logger
@@ -32,33 +39,32 @@ def main():
         logger.error(f'Cannot read table name: {e}')
         sys.exit(1)
 
-    ddbTable = dynamodb.Table(tableName)
+    writer = ChangeWriter(backendFor(tableName), DIGEST_FILE)
     participants = {}
-    currentPort = "0"
-    currentParticipants = []
-
-    output = os.popen('/usr/bin/aconnect -l').read().strip().split('\n')
-    for line in output:
-        index = line.find('rtpmidi midiHub-')
-        if index > 0:
-            if len(currentParticipants) > 0:
-                participants[currentPort] = currentParticipants
-                currentParticipants = []
-            currentPort = line[index+16:line.rindex("'")]
-            continue
 
-        if line.find('client') == 0: continue
-        if line.find('    0 ') == 0: continue
-        if line.find('Announce') > 0: continue
-        if line.find('midiHub-') > 0: continue
+    ports = rtpmidictl.portsFromFile('../midiports', [5004, 5006])
+    statuses = rtpmidictl.queryStatus(ports, directory='..')
 
-        clientName = line[7:line.rindex("'")-1]
-        currentParticipants.append(clientName)
+    if all(status is not None for status in statuses.values()):
+        for port, status in statuses.items():
+            names = [peer['name'] for peer in rtpmidictl.peers(status)]
+            if len(names) > 0:
+                participants[str(port)] = names
+    else:
+        logger.info('Not all daemons answered - reading ALSA sequencer graph')
+        try:
+            graph = alsagraph.readGraph()
+        except Exception as e:
+            logger.error(f'Failed to read ALSA sequencer graph: {e}')
+            sys.exit(1)
 
-    if len(currentParticipants) > 0:
-        participants[currentPort] = currentParticipants
+        for client in graph.hubClients():
+            names = list(client.participants.values())
+            if len(names) > 0:
+                participants[client.hubName.rsplit('-', 1)[-1]] = names
 
-    ddbTable.put_item(Item={'clientId':'Participants', 'list':json.dumps(participants)})
+    writer.put({'clientId':'Participants', 'list':json.dumps(participants, sort_keys=True)})
+    if writer.flush(): sys.exit(1)
 
 if __name__ == "__main__":
     main()